@@ -0,0 +1,107 @@
+import random
+import re
+import sys
+import timeit
+
+from classifier import DEFAULT_AD_KEYWORDS, DEFAULT_SELF_PROMO, MessageClassifier
+
+# Микробенчмарк классификатора групповых сообщений:
+#   python bench_classifier.py [кол-во сообщений]
+
+
+def legacy_classify(text):
+    # Прежняя логика из handle_message - для сравнения скорости и результатов
+    mention_pattern = r'@(\w+)|(\b\d{5,}\b)'
+    rep_pattern = r'[\+\-]\s*[РрRr][ЕеEe][ПпPp]\b'
+
+    mentions = re.findall(mention_pattern, text)
+    has_rep = re.search(rep_pattern, text)
+
+    is_ad = False
+    lower_text = text.lower()
+
+    for keyword in DEFAULT_AD_KEYWORDS:
+        if keyword in lower_text:
+            is_ad = True
+            break
+
+    for promo in DEFAULT_SELF_PROMO:
+        if promo in lower_text:
+            is_ad = True
+            break
+
+    if re.search(r'\d+\s*[\+\-]\s*[рp][еe][пp]', lower_text):
+        is_ad = True
+
+    if mentions and has_rep and not is_ad:
+        return [m[0] or m[1] for m in mentions], '+' if '+' in has_rep.group() else '-'
+    return None
+
+
+CHATTER = [
+    "всем привет", "кто сегодня онлайн?", "ахаха да", "ну такое", "го в войс",
+    "а где ссылка на канал", "спасибо!", "понял, принял", "сколько времени займет?",
+    "кто-нибудь знает как это работает", "лол", "завтра буду после обеда",
+    "скиньте правила чата пожалуйста", "ок", "это вообще законно?",
+]
+ADS = [
+    "продаю аккаунты недорого, пишите в лс", "купить карты по лучшим ценам",
+    "принимаю оплата на баланс", "у меня лучшие услуги в чате", "с меня бонус за отзыв",
+    "пушкинские карты, оплата сразу",
+]
+NAMES = ["trader_pro", "ivan2001", "MaxSeller", "anna_k", "dealer77", "best_garant", "kot_v_sapogah"]
+# Границы упоминаний: рекламное слово или "+реп" вплотную к @имени
+EDGE_CASES = [
+    "@vasyaу меня +реп", "@dealer77у меня +реп", "@annaмоя +реп", "@kotмои отзывы +реп",
+    "@ivan2001 +реп", "@trader_pro500 +реп", "@MaxSeller+реп", "@best_garantс меня +реп",
+    "@anna_k на мне +реп", "@dealer77 +реп скам", "@vasya_услуги +реп", "у меня@vasya +реп",
+]
+
+
+def make_message(rng):
+    roll = rng.random()
+    if roll < 0.80:
+        return rng.choice(CHATTER)
+    if roll < 0.88:
+        return rng.choice(ADS)
+    if roll < 0.93:
+        return f"{rng.randint(100, 5000)}+реп @{rng.choice(NAMES)}"
+    names = " ".join(f"@{rng.choice(NAMES)}" for _ in range(rng.randint(1, 3)))
+    sign = rng.choice(["+реп", "-реп", "+ rep", "+Реп"])
+    tail = rng.choice(["", " спасибо за сделку", " быстро и четко", " кинул, осторожно"])
+    return f"{names} {sign}{tail}"
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rng = random.Random(42)
+    corpus = [make_message(rng) for _ in range(count)] + EDGE_CASES
+    classifier = MessageClassifier()
+
+    def run_classifier():
+        for text in corpus:
+            result = classifier.classify(text)
+            if result.is_rep:
+                result.mentions
+
+    def run_legacy():
+        for text in corpus:
+            legacy_classify(text)
+
+    mismatches = 0
+    for text in corpus:
+        result = classifier.classify(text)
+        new = (result.mentions, result.rep_sign) if result.is_rep else None
+        if new != legacy_classify(text):
+            mismatches += 1
+            print(f"расхождение: {text!r}: {new} вместо {legacy_classify(text)}")
+
+    legacy = min(timeit.repeat(run_legacy, number=1, repeat=5))
+    current = min(timeit.repeat(run_classifier, number=1, repeat=5))
+    print(f"сообщений: {len(corpus)}, расхождений с прежней логикой: {mismatches}")
+    print(f"прежняя логика:  {legacy / len(corpus) * 1e9:8.0f} нс/сообщение")
+    print(f"классификатор:   {current / len(corpus) * 1e9:8.0f} нс/сообщение ({legacy / current:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,677 @@
+import argparse
+import asyncio
+import functools
+import json
+import random
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+from telegram import Update
+from telegram.ext import Application
+from telegram.request import BaseRequest
+
+import callbacks
+import main
+import metrics
+import queries
+from bench_classifier import make_message
+from leaderboard import LOAD_SQL
+from migrations import RECENT_WINDOW_DAYS
+from metrics import DB_ACQUIRE_SECONDS, DB_QUERY_SECONDS, TimedPool
+from outbox import Outbox
+from ratelimit import KeyedLimiter, TokenBucket
+from userwriter import UPSERT_MANY, UPSERT_ONE
+
+# Нагрузочный прогон хендлеров без Telegram и без боевой БД:
+#   python bench_load.py [--scenario group_chatter ...] [--updates 5000] [--rate 500]
+#                        [--db-latency-ms 1] [--api-latency-ms 100] [--database-url postgres://...]
+# Апдейты генерируются и проходят через PerChatUpdateProcessor и хендлеры main.py;
+# Bot API подменен FakeRequest, БД - FakeDatabase (в памяти) или локальным Postgres.
+# Локальная БД заполняется тестовыми пользователями - не указывайте боевую!
+
+BOT_ID = 1
+BOT_USERNAME = "tess_bench_bot"
+FIRST_USER_ID = 5_000_000_000
+GROUP_IDS = [-1001000000000 - i for i in range(20)]
+PHOTO_IDS = [f"AgACAgIAAxk-bench-photo-{i}" for i in range(50)]
+# Эти username "есть в Telegram", но не в БД - их находит get_chat
+TELEGRAM_ONLY = [f"tg_user_{i}" for i in range(200)]
+TELEGRAM_ONLY_FIRST_ID = 6_000_000_000
+# А этих нет нигде
+UNKNOWN = [f"nobody_{i}" for i in range(20)]
+
+
+# ==================== BOT API ====================
+class FakeRequest(BaseRequest):
+    # Отвечает на вызовы Bot API без сети и запоминает последние сообщения каждого чата,
+    # чтобы сценарии могли "нажимать" кнопки из реально отправленных клавиатур
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.messages = {}
+        self.last_message = {}
+        self._message_ids = defaultdict(lambda: 1_000_000)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.calls[api_method] += 1
+        params = request_data.parameters if request_data is not None else {}
+        handler = getattr(self, f"_{api_method}", None)
+        result = handler(params) if handler is not None else True
+        if isinstance(result, tuple):
+            return result
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    def _getMe(self, params):
+        return {"id": BOT_ID, "is_bot": True, "first_name": "TESS", "username": BOT_USERNAME}
+
+    def _getChat(self, params):
+        username = str(params.get("chat_id", "")).lstrip("@")
+        if username in TELEGRAM_ONLY:
+            user_id = TELEGRAM_ONLY_FIRST_ID + TELEGRAM_ONLY.index(username)
+            return {"id": user_id, "type": "private", "username": username}
+        return 400, json.dumps({"ok": False, "error_code": 400, "description": "Bad Request: chat not found"}).encode()
+
+    def _store(self, chat_id, message_id, **fields):
+        message = self.messages.get((chat_id, message_id))
+        if message is None:
+            message = {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+                "from": {"id": BOT_ID, "is_bot": True, "first_name": "TESS", "username": BOT_USERNAME},
+            }
+            self.messages[(chat_id, message_id)] = message
+        for key, value in fields.items():
+            if value is None:
+                message.pop(key, None)
+            else:
+                message[key] = value
+        self.last_message[chat_id] = message
+        return message
+
+    def _new_message(self, params, **fields):
+        chat_id = int(params["chat_id"])
+        self._message_ids[chat_id] += 1
+        return self._store(chat_id, self._message_ids[chat_id], reply_markup=params.get("reply_markup"), **fields)
+
+    def _edit(self, params, **fields):
+        chat_id, message_id = int(params["chat_id"]), int(params["message_id"])
+        return self._store(chat_id, message_id, reply_markup=params.get("reply_markup"), **fields)
+
+    def _sendMessage(self, params):
+        return self._new_message(params, text=params["text"])
+
+    def _sendPhoto(self, params):
+        return self._new_message(params, photo=_photo_sizes(params["photo"]), caption=params.get("caption"))
+
+    def _editMessageText(self, params):
+        return self._edit(params, text=params["text"])
+
+    def _editMessageCaption(self, params):
+        return self._edit(params, caption=params.get("caption"))
+
+    def _editMessageMedia(self, params):
+        media = params["media"]
+        return self._edit(params, photo=_photo_sizes(media["media"]), caption=media.get("caption"))
+
+    def _deleteMessage(self, params):
+        chat_id = int(params["chat_id"])
+        message = self.messages.pop((chat_id, int(params["message_id"])), None)
+        if message is not None and self.last_message.get(chat_id) is message:
+            del self.last_message[chat_id]
+        return True
+
+
+def _photo_sizes(file_id):
+    return [{"file_id": file_id, "file_unique_id": file_id[-16:], "width": 1280, "height": 720}]
+
+
+# ==================== DATABASE ====================
+class FakeConnection:
+    # Понимает ровно те запросы, которые делает main.py/userwriter.py.
+    # Незнакомый запрос - ошибка: значит, SQL поменялся и заглушку пора обновить.
+    def __init__(self, db):
+        self.db = db
+
+    async def execute(self, sql, *args):
+        await self.db.roundtrip()
+        if sql == UPSERT_ONE:
+            self.db.upsert_users([args[0]], [args[1]], args[2])
+        elif sql == UPSERT_MANY:
+            self.db.upsert_users(*args)
+        elif "INSERT INTO reputation_log" in sql:
+            from_user, to_users, rep_type, text, photo_id = args
+            for to_user in to_users:
+                self.db.add_review(from_user, to_user, rep_type, text, photo_id)
+        elif sql == queries.PENDING_ADD.sql:
+            self.db.add_pending(*args)
+        else:
+            raise NotImplementedError(f"FakeConnection.execute: {sql.strip()[:80]}")
+
+    async def fetchrow(self, sql, *args):
+        await self.db.roundtrip()
+        if "WHERE u.user_id = $1" in sql:
+            return self.db.user_row(args[0])
+        if "WHERE lower(u.username) = lower($1)" in sql:
+            return self.db.user_row(self.db.by_name.get(args[0].lower()))
+        if "WHERE r.id = $1" in sql:
+            return self.db.review_row(args[0])
+        if "DELETE FROM reputation_log WHERE id = $1" in sql:
+            return self.db.delete_review(args[0])
+        raise NotImplementedError(f"FakeConnection.fetchrow: {sql.strip()[:80]}")
+
+    async def fetch(self, sql, *args):
+        await self.db.roundtrip()
+        if "u.user_id = ANY($1::bigint[]) OR lower(u.username) = ANY($2::text[])" in sql:
+            ids = set(args[0]) | {self.db.by_name[name] for name in args[1] if name in self.db.by_name}
+            return [self.db.user_row(user_id) for user_id in ids if user_id in self.db.users]
+        if "WHERE r.to_user = $1" in sql:
+            return self.db.review_page(sql, *args)
+        if sql == queries.PENDING_ATTACH.sql:
+            rows = self.db.take_pending(args[0])
+            for row in rows:
+                if row["from_user"] != args[1]:
+                    self.db.add_review(row["from_user"], args[1], row["type"], row["message_text"],
+                                       row["photo_id"], row["created_at"])
+            return rows
+        if sql == queries.PENDING_DROP.sql:
+            return self.db.take_pending(args[0])
+        if sql == queries.PENDING_WAITING.sql:
+            return [{"username": name} for name in {row["username"].lower() for row in self.db.pending}]
+        if sql.startswith(LOAD_SQL):
+            rows = [self.db.user_row(user_id) for user_id in (args[0] if args else self.db.users)]
+            return [row for row in rows if row is not None and (args or row["positive"] or row["negative"] or row["deal_sum"])]
+        raise NotImplementedError(f"FakeConnection.fetch: {sql.strip()[:80]}")
+
+    async def fetchval(self, sql, *args):
+        await self.db.roundtrip()
+        raise NotImplementedError(f"FakeConnection.fetchval: {sql.strip()[:80]}")
+
+
+class _FakeAcquire:
+    def __init__(self, db):
+        self.db = db
+
+    async def __aenter__(self):
+        return FakeConnection(self.db)
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakePool:
+    def __init__(self, db):
+        self.db = db
+
+    def acquire(self, **kwargs):
+        return _FakeAcquire(self.db)
+
+    async def close(self):
+        pass
+
+
+class FakeDatabase:
+    # users и reputation_log в памяти; latency - имитация сетевой задержки на запрос
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.users = {}
+        self.by_name = {}
+        self.reviews = {}
+        # to_user -> ID отзывов по возрастанию (created_at, id)
+        self.by_target = defaultdict(list)
+        # pending_reputation: отзывы на username, которые ищет main.pending_resolver
+        self.pending = []
+        self._next_review_id = 1
+        self.pool = TimedPool(FakePool(self), "fake")
+
+    async def roundtrip(self):
+        await asyncio.sleep(self.latency)
+
+    def upsert_users(self, user_ids, usernames, registered):
+        for user_id, username in zip(user_ids, usernames):
+            user = self.users.get(user_id)
+            if user is None:
+                user = self.users[user_id] = {
+                    "user_id": user_id, "username": username, "registered": registered,
+                    "total_deals": 0, "deal_sum": 0, "bio": "",
+                }
+            elif user["username"] and self.by_name.get(user["username"].lower()) == user_id:
+                del self.by_name[user["username"].lower()]
+            user["username"] = username
+            if username:
+                self.by_name[username.lower()] = user_id
+
+    def add_review(self, from_user, to_user, rep_type, text, photo_id, created_at=None):
+        review_id = self._next_review_id
+        self._next_review_id += 1
+        self.reviews[review_id] = {
+            "id": review_id, "from_user": from_user, "to_user": to_user, "type": rep_type,
+            "message_text": text, "photo_id": photo_id, "created_at": created_at or datetime.now(),
+        }
+        self.by_target[to_user].append(review_id)
+        if created_at is not None:
+            self.by_target[to_user].sort(key=lambda i: (self.reviews[i]["created_at"], i))
+
+    def add_pending(self, usernames, from_user, rep_type, text, photo_id, chat_id, chat_type, message_id):
+        for username in usernames:
+            self.pending.append({
+                "username": username, "from_user": from_user, "type": rep_type, "message_text": text,
+                "photo_id": photo_id, "chat_id": chat_id, "chat_type": chat_type, "message_id": message_id,
+                "created_at": datetime.now(),
+            })
+
+    def take_pending(self, key):
+        taken = [row for row in self.pending if row["username"].lower() == key]
+        self.pending = [row for row in self.pending if row["username"].lower() != key]
+        return taken
+
+    def delete_review(self, review_id):
+        review = self.reviews.pop(review_id, None)
+        if review is None:
+            return None
+        self.by_target[review["to_user"]].remove(review_id)
+        return {"to_user": review["to_user"], "type": review["type"]}
+
+    def user_row(self, user_id):
+        # Как queries.USER_BY_ID: строка users + статистика (здесь считается на лету)
+        user = self.users.get(user_id)
+        if user is None:
+            return None
+        reviews = [self.reviews[i] for i in self.by_target.get(user_id, ())]
+        recent = datetime.now() - timedelta(days=RECENT_WINDOW_DAYS)
+        return {
+            **user,
+            "positive": sum(r["type"] == "+" for r in reviews),
+            "negative": sum(r["type"] == "-" for r in reviews),
+            "unique_reviewers": len({r["from_user"] for r in reviews}),
+            "recent_positive": sum(r["type"] == "+" and r["created_at"] > recent for r in reviews),
+            "recent_negative": sum(r["type"] == "-" and r["created_at"] > recent for r in reviews),
+            "last_review_at": reviews[-1]["created_at"] if reviews else None,
+        }
+
+    def review_row(self, review_id):
+        review = self.reviews.get(review_id)
+        if review is None:
+            return None
+        author = self.users.get(review["from_user"])
+        return {**review, "from_username": author["username"] if author else None}
+
+    def review_page(self, sql, to_user, limit, *cursor):
+        rep_type = "+" if "r.type = '+'" in sql else "-" if "r.type = '-'" in sql else None
+        rows = [self.reviews[i] for i in self.by_target.get(to_user, ())]
+        if rep_type is not None:
+            rows = [r for r in rows if r["type"] == rep_type]
+        if "<= ($3, $4)" in sql:
+            rows = [r for r in rows if (r["created_at"], r["id"]) <= cursor]
+        elif "> ($3, $4)" in sql:
+            rows = [r for r in rows if (r["created_at"], r["id"]) > cursor]
+        if "DESC" in sql:
+            rows.reverse()
+        return [self.review_row(r["id"]) for r in rows[:limit]]
+
+    async def seed(self, users, reviews):
+        self.upsert_users([u for u, _ in users], [n for _, n in users], datetime(2024, 1, 1))
+        for from_user, to_user, rep_type, text, photo_id, created_at in reviews:
+            self.add_review(from_user, to_user, rep_type, text, photo_id, created_at)
+
+    async def start(self):
+        main.db_pool = self.pool
+        main.read_router.start(self.pool)
+
+
+class PostgresDatabase:
+    # Настоящая (локальная!) БД: схема через миграции main.init_db_pool
+    def __init__(self, url):
+        self.url = url
+
+    async def seed(self, users, reviews):
+        pool = await main.init_db_pool()
+        ids = [u for u, _ in users]
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("DELETE FROM reputation_log WHERE to_user = ANY($1::bigint[])", ids)
+                await conn.execute("""
+                    INSERT INTO users (user_id, username, registered)
+                    SELECT u.user_id, u.username, '2024-01-01'
+                    FROM unnest($1::bigint[], $2::text[]) AS u(user_id, username)
+                    ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username
+                """, ids, [n for _, n in users])
+                if reviews:
+                    await conn.execute(
+                        "SELECT reputation_log_ensure_partitions($1, $2)",
+                        min(review[5] for review in reviews), max(review[5] for review in reviews),
+                    )
+                    # COPY тоже вызывает триггер user_stats
+                    await conn.copy_records_to_table(
+                        "reputation_log", records=reviews,
+                        columns=("from_user", "to_user", "type", "message_text", "photo_id", "created_at"),
+                    )
+
+    async def start(self):
+        await main.init_db_pool()
+
+
+# ==================== UPDATES ====================
+class World:
+    # Тестовые пользователи, их отзывы и генерация апдейтов
+    def __init__(self, rng, bot, request, users=2000):
+        self.rng = rng
+        self.bot = bot
+        self.request = request
+        self.user_ids = [FIRST_USER_ID + i for i in range(users)]
+        self.usernames = {user_id: f"user_{i}" for i, user_id in enumerate(self.user_ids)}
+        self._update_id = 0
+        self._message_ids = defaultdict(int)
+
+    def seed_data(self, max_reviews=60):
+        users = list(self.usernames.items())
+        reviews = []
+        start = datetime(2024, 1, 1)
+        for to_user in self.user_ids:
+            for _ in range(int(self.rng.paretovariate(1.2)) % max_reviews):
+                reviews.append((
+                    self.rng.choice(self.user_ids), to_user, self.rng.choice("++++-"),
+                    f"@{self.usernames[to_user]} +реп за сделку", self.rng.choice(PHOTO_IDS + [None]),
+                    start + timedelta(seconds=self.rng.randint(0, 300 * 86400)),
+                ))
+        return users, reviews
+
+    def user(self):
+        return self.rng.choice(self.user_ids)
+
+    def _from(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": "Bench", "username": self.usernames.get(user_id)}
+
+    def _chat(self, chat_id):
+        return {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"}
+
+    def _update(self, **payload):
+        self._update_id += 1
+        return Update.de_json({"update_id": self._update_id, **payload}, self.bot)
+
+    def message(self, chat_id, user_id, text, photo=None, reply_to=None, command=False):
+        self._message_ids[chat_id] += 1
+        message = {
+            "message_id": self._message_ids[chat_id],
+            "date": int(time.time()),
+            "chat": self._chat(chat_id),
+            "from": self._from(user_id),
+        }
+        if photo:
+            message["photo"] = _photo_sizes(photo)
+            message["caption"] = text
+        else:
+            message["text"] = text
+        if command:
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        if reply_to is not None:
+            message["reply_to_message"] = {
+                "message_id": self._message_ids[chat_id] - 1, "date": int(time.time()),
+                "chat": self._chat(chat_id), "from": self._from(reply_to), "text": "сделка прошла",
+            }
+        return self._update(message=message)
+
+    def callback(self, user_id, message, data):
+        return self._update(callback_query={
+            "id": str(self._update_id), "from": self._from(user_id),
+            "chat_instance": str(user_id), "message": message, "data": data,
+        })
+
+    def mention(self, known=0.8):
+        roll = self.rng.random()
+        if roll < known:
+            return "@" + self.usernames[self.user()]
+        if roll < known + (1 - known) / 2:
+            return "@" + self.rng.choice(TELEGRAM_ONLY)
+        return "@" + self.rng.choice(UNKNOWN)
+
+
+# ==================== SCENARIOS ====================
+# Сценарий - список "сессий"; сессия - последовательность апдейтов одного чата,
+# где следующий апдейт может зависеть от ответа бота (кнопки последнего сообщения)
+
+def group_chatter(world, count):
+    # Обычная переписка в группах: в основном болтовня, немного рекламы и +реп
+    for _ in range(count):
+        text = make_message(world.rng)
+        photo = world.rng.choice(PHOTO_IDS) if "реп" in text.lower() and world.rng.random() < 0.5 else None
+        yield [lambda text=text, photo=photo: world.message(world.rng.choice(GROUP_IDS), world.user(), text, photo)]
+
+
+def rep_spam(world, count):
+    # +реп с несколькими упоминаниями и фото - самый тяжелый групповой путь
+    for _ in range(count):
+        mentions = " ".join(world.mention() for _ in range(world.rng.randint(1, 5)))
+        # Знак перед упоминаниями: "user_1 +реп" антиспам считает рекламой (цифры перед +реп)
+        text = f"{world.rng.choice(['+реп', '+ rep', '-реп'])} {mentions} спасибо за сделку"
+        yield [lambda text=text: world.message(world.rng.choice(GROUP_IDS), world.user(), text, world.rng.choice(PHOTO_IDS))]
+
+
+def profile_lookup(world, count):
+    # /и и /топ в группах (по username, ID, ответом) и поиск пользователя в личке
+    for _ in range(count):
+        roll = world.rng.random()
+        group = world.rng.choice(GROUP_IDS)
+        if roll < 0.4:
+            yield [lambda group=group: world.message(group, world.user(), f"/и {world.mention(known=0.9)}")]
+        elif roll < 0.55:
+            yield [lambda group=group: world.message(group, world.user(), f"/и {world.user()}")]
+        elif roll < 0.65:
+            yield [lambda group=group: world.message(group, world.user(), "/и", reply_to=world.user())]
+        elif roll < 0.7:
+            yield [lambda group=group: world.message(group, world.user(), world.rng.choice(["/топ", "/топ %", "/топ сделки"]))]
+        else:
+            user_id = world.user()
+            menu = {"message_id": 1, "date": 0, "chat": world._chat(user_id), "text": "TESS"}
+            yield [
+                lambda user_id=user_id, menu=menu: world.callback(user_id, menu, "find_user"),
+                lambda user_id=user_id: world.message(user_id, user_id, world.mention(known=0.9)),
+            ]
+
+
+def review_paging(world, count, clicks=8):
+    # Открыть отзывы по ссылке из группы и полистать: номера, вперед/назад, смена раздела
+    for _ in range(max(count // (clicks + 1), 1)):
+        user_id, target = world.user(), world.user()
+        steps = [lambda user_id=user_id, target=target: world.message(
+            user_id, user_id, f"/start reviews_{target}", command=True)]
+        steps += [lambda user_id=user_id: press_button(world, user_id)] * clicks
+        yield steps
+
+
+def press_button(world, user_id):
+    message = world.request.last_message.get(user_id)
+    buttons = [
+        button["callback_data"]
+        for row in (message or {}).get("reply_markup", {}).get("inline_keyboard", [])
+        for button in row if "callback_data" in button
+    ]
+    if not buttons:
+        return None
+    back = (callbacks.MAIN_MENU, callbacks.PROFILE, callbacks.REVIEW_MENU)
+    weights = [0.2 if callbacks.decode(data)[0] in back else 1.0 for data in buttons]
+    data = world.rng.choices(buttons, weights)[0]
+    return world.callback(user_id, message, data)
+
+
+SCENARIOS = {
+    "group_chatter": group_chatter,
+    "rep_spam": rep_spam,
+    "profile_lookup": profile_lookup,
+    "review_paging": review_paging,
+}
+
+
+# ==================== RUNNER ====================
+def _total(histogram):
+    return sum(histogram.counts().values())
+
+
+def _by_label(histogram, index=0):
+    counts = Counter()
+    for key, count in histogram.counts().items():
+        counts[key[index]] += count
+    return counts
+
+
+def _percentile(values, p):
+    return values[min(int(len(values) * p), len(values) - 1)] if values else 0.0
+
+
+def _latency_line(values):
+    values.sort()
+    return (f"p50 {_percentile(values, 0.5) * 1000:.2f} мс, p99 {_percentile(values, 0.99) * 1000:.2f} мс, "
+            f"max {values[-1] * 1000 if values else 0:.2f} мс")
+
+
+async def run_session(app, steps, total, handling):
+    async def timed(coroutine):
+        start = time.perf_counter()
+        try:
+            await coroutine
+        finally:
+            handling.append(time.perf_counter() - start)
+
+    for step in steps:
+        update = step()
+        if update is None:
+            return
+        start = time.perf_counter()
+        await app.update_processor.process_update(update, timed(app.process_update(update)))
+        total.append(time.perf_counter() - start)
+        if len(steps) > 1:
+            # Следующий шаг нажимает кнопки из ответа - ждем, пока он отправлен
+            await main.outbox.drain(chat_id=update.effective_chat.id)
+
+
+async def run_scenario(app, request, name, sessions, rate=None):
+    # rate=None - все сессии сразу (пиковая нагрузка), иначе - новые сессии с частотой rate в секунду
+    total, handling = [], []
+    db_before = _total(DB_ACQUIRE_SECONDS)
+    queries_before = _by_label(DB_QUERY_SECONDS)
+    api_before = Counter(request.calls)
+
+    start = time.perf_counter()
+    tasks = []
+    for steps in sessions:
+        tasks.append(asyncio.create_task(run_session(app, steps, total, handling)))
+        if rate:
+            await asyncio.sleep(1 / rate)
+    await asyncio.gather(*tasks)
+    await main.pending_resolver.drain()
+    await main.outbox.drain()
+    await main.user_writer.flush()
+    elapsed = time.perf_counter() - start
+
+    count = len(total) or 1
+    db_calls = _total(DB_ACQUIRE_SECONDS) - db_before
+    queries = _by_label(DB_QUERY_SECONDS) - queries_before
+    api = Counter(request.calls) - api_before
+    print(f"\n== {name}: {len(total)} апдейтов за {elapsed:.2f} с - {len(total) / elapsed:,.0f} апд/с")
+    print(f"   обработка:          {_latency_line(handling)}")
+    print(f"   с ожиданием очереди: {_latency_line(total)}")
+    print(f"   БД: {db_calls / count:.2f} запросов/апдейт  "
+          + ", ".join(f"{q}={n}" for q, n in queries.most_common()))
+    print(f"   Bot API: {sum(api.values()) / count:.2f} вызовов/апдейт  "
+          + ", ".join(f"{m}={n}" for m, n in api.most_common()))
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    request = FakeRequest(args.api_latency_ms / 1000)
+    app = (
+        Application.builder()
+        .token("123456:BENCH")
+        .request(request)
+        .get_updates_request(FakeRequest())
+        .concurrent_updates(main.PerChatUpdateProcessor(args.concurrency))
+        .build()
+    )
+    main.register_handlers(app)
+    metrics.slow_query_threshold = args.slow_query_ms / 1000
+    # Лимиты отправки не измеряем - их задает Telegram, а не код
+    main.outbox = Outbox(global_rate=1e9, private_rate=1e9, group_rate=1e9, burst=1e9)
+    if args.limits:
+        main.load_shedder.start(functools.partial(main.current_load, app))
+    else:
+        # Сценарии гоняют одних и тех же пользователей намного чаще живых людей
+        main.user_limiter = KeyedLimiter(1e9, 1e9)
+        main.chat_limiter = KeyedLimiter(1e9, 1e9)
+        main.pending_resolver.bucket = TokenBucket(1e9, 1e9)
+
+    if args.database_url:
+        main.DATABASE_URL = args.database_url
+        db = PostgresDatabase(args.database_url)
+    else:
+        db = FakeDatabase(args.db_latency_ms / 1000)
+
+    world = World(rng, app.bot, request, args.users)
+    users, reviews = world.seed_data()
+    await db.seed(users, reviews)
+    await db.start()
+    print(f"пользователей: {len(users)}, отзывов: {len(reviews)}, "
+          f"БД: {'postgres' if args.database_url else f'в памяти, задержка {args.db_latency_ms} мс'}, "
+          f"параллельность: {args.concurrency}")
+
+    async with app:
+        main.user_writer.start(main.db_pool)
+        main.pending_resolver.start(
+            main.db_pool,
+            functools.partial(main.resolve_pending_username, app.bot),
+            functools.partial(main._on_pending_done, app.bot),
+        )
+        await main.leaderboard.start(main.db_pool)
+        try:
+            for name in args.scenario or SCENARIOS:
+                await run_scenario(app, request, name, list(SCENARIOS[name](world, args.updates)), args.rate)
+            if args.limits:
+                print(f"\nлимиты: пользователи {main.user_limiter.stats()}, чаты {main.chat_limiter.stats()}, "
+                      f"перегрузка {main.load_shedder.stats()}")
+            print(f"\nпоиск username в фоне: {main.pending_resolver.stats()}")
+            print("\nподготовленные запросы:")
+            for name, stats in queries.stats().items():
+                print(f"  {name:<28} {stats['calls']:>7} вызовов, {stats['avg_ms']:.3f} мс")
+        finally:
+            await main.load_shedder.stop()
+            await main.pending_resolver.stop()
+            await main.outbox.drain()
+            await main.user_writer.stop()
+            await main.leaderboard.stop()
+            if args.database_url:
+                await main.db_pool.close()
+                await main.read_pool.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон хендлеров бота")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS))
+    parser.add_argument("--updates", type=int, default=5000, help="апдейтов на сценарий")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--rate", type=float, help="новых сессий в секунду (по умолчанию - все сразу)")
+    parser.add_argument("--concurrency", type=int, default=main.MAX_CONCURRENT_UPDATES)
+    parser.add_argument("--db-latency-ms", type=float, default=0.0, help="задержка FakeDatabase на запрос")
+    parser.add_argument("--api-latency-ms", type=float, default=0.0, help="задержка FakeRequest на вызов Bot API")
+    parser.add_argument("--database-url", help="локальный Postgres вместо FakeDatabase")
+    parser.add_argument("--slow-query-ms", type=float, default=float("inf"), help="журнал медленных запросов")
+    parser.add_argument("--limits", action="store_true", help="лимиты USER_RATE/CHAT_RATE и сброс нагрузки как в боте")
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
@@ -0,0 +1,163 @@
+import argparse
+import asyncio
+import random
+import time
+
+import main
+from bench_load import _latency_line
+from migrations import REVIEW_SEARCH_CONFIG
+
+# Поиск по отзывам на большом журнале: GIN по reputation_log.search против ILIKE '%...%':
+#   python bench_search.py --database-url postgres://... [--rows 2000000] [--queries 300]
+# Журнал заполняется тестовыми отзывами один раз (пользователи FIRST_USER_ID..),
+# поэтому только локальная БД - не указывайте боевую!
+# Для заполнения нужен суперпользователь: триггер user_stats на время вставки отключается.
+
+FIRST_USER_ID = 7_200_000_000
+FROM_USER_ID = 5_000_000_001
+# Слова, которые есть почти в каждом отзыве, и слова, которые ищут
+FILLER = ["реп", "за", "сделку", "все", "быстро", "спасибо", "отлично", "рекомендую", "норм", "чётко", "честно", "удачи"]
+TERMS = [
+    "аккаунт", "steam", "скин", "нож", "кейс", "пропуск", "робуксы", "гемы", "подписка", "nitro", "spotify",
+    "ключ", "гарант", "скам", "кинул", "возврат", "предоплата", "обмен", "донат", "голда", "юси", "випка",
+    "буст", "прокачка", "рейтинг", "звезды", "тг", "премиум", "карта", "перевод", "крипта", "usdt", "рубли",
+    "500", "1000", "1500", "2000", "3000", "5000", "10000", "минута", "час", "сутки", "неделя", "телефон",
+]
+MISSING = ["арбитраж", "паспорт", "ноутбук"]
+
+SEARCH_ILIKE_SQL = """
+    SELECT r.id, r.type, r.created_at, u.username AS from_username
+    FROM reputation_log r
+    LEFT JOIN users u ON u.user_id = r.from_user
+    WHERE r.to_user = $1 AND r.message_text ILIKE '%' || $2 || '%'
+    ORDER BY r.created_at DESC, r.id DESC
+    LIMIT $3
+"""
+
+
+def _sql_array(words):
+    return "ARRAY[" + ", ".join(f"'{word}'" for word in words) + "]"
+
+
+# Скошенное распределение: у первых пользователей десятки тысяч отзывов, у большинства - единицы.
+# Искомые слова тоже неравномерны: ранние в TERMS встречаются чаще.
+SEED_SQL = f"""
+    INSERT INTO reputation_log (from_user, to_user, type, message_text, photo_id, created_at)
+    SELECT $1::bigint + (g % 1000),
+           $2::bigint + floor($3 * random() ^ 3)::bigint,
+           CASE WHEN random() < 0.9 THEN '+' ELSE '-' END,
+           '+реп ' || (f)[1 + floor(random() * cardinality(f))::int] || ' '
+                   || (t)[1 + floor(cardinality(t) * random() ^ 2)::int] || ' '
+                   || (f)[1 + floor(random() * cardinality(f))::int] || ' '
+                   || (t)[1 + floor(cardinality(t) * random() ^ 2)::int] || ' '
+                   || (f)[1 + floor(random() * cardinality(f))::int],
+           NULL,
+           NOW()::timestamp - random() * INTERVAL '700 days'
+    FROM generate_series(1, $4) AS g,
+         (SELECT {_sql_array(FILLER)} AS f, {_sql_array(TERMS)} AS t) AS words
+"""
+
+
+async def seed(conn, rows, users):
+    existing = await conn.fetchval(
+        "SELECT COUNT(*) FROM reputation_log WHERE to_user >= $1 AND to_user < $2",
+        FIRST_USER_ID, FIRST_USER_ID + users,
+    )
+    if existing >= rows:
+        print(f"журнал уже заполнен: {existing:,} отзывов")
+        return
+    await conn.execute(
+        "SELECT reputation_log_ensure_partitions(NOW()::timestamp - INTERVAL '700 days', NOW()::timestamp)"
+    )
+    await conn.execute("SET session_replication_role = replica")
+    started = time.perf_counter()
+    batch = 200_000
+    for done in range(existing, rows, batch):
+        await conn.execute(SEED_SQL, FROM_USER_ID, FIRST_USER_ID, users, min(batch, rows - done))
+        print(f"  {min(done + batch, rows):,} / {rows:,} ({time.perf_counter() - started:.0f} с)", flush=True)
+    await conn.execute("SET session_replication_role = DEFAULT")
+    # Иначе первые запросы проставляют hint bits и меряется запись, а не поиск
+    await conn.execute("VACUUM ANALYZE reputation_log")
+
+
+async def measure(label, queries, run):
+    latencies = []
+    found = 0
+    for user_id, term in queries:
+        start = time.perf_counter()
+        rows = await run(user_id, term)
+        latencies.append(time.perf_counter() - start)
+        found += bool(rows)
+    print(f"{label:<32} {_latency_line(latencies)}, с результатами {found}/{len(queries)}")
+
+
+async def run(args):
+    main.DATABASE_URL = args.database_url
+    pool = await main.init_db_pool()
+    async with pool.acquire() as conn:
+        await seed(conn, args.rows, args.users)
+        heavy = await conn.fetch("""
+            SELECT to_user, COUNT(*) AS reviews FROM reputation_log
+            WHERE to_user >= $1 AND to_user < $1 + 20
+            GROUP BY to_user ORDER BY reviews DESC
+        """, FIRST_USER_ID)
+        total = await conn.fetchval("""
+            SELECT SUM(c.reltuples)::bigint FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'reputation_log'::regclass
+        """)
+    print(f"отзывов в журнале: ~{total:,}, больше всех у {heavy[0]['to_user']}: {heavy[0]['reviews']:,}")
+
+    rng = random.Random(args.seed)
+    # Обычные пользователи и 20 самых "тяжелых", где ILIKE хуже всего;
+    # каждый десятый запрос - слово, которого в отзывах нет (ILIKE читает все отзывы пользователя)
+    groups = {
+        "обычные": [FIRST_USER_ID + rng.randrange(20, args.users) for _ in range(args.queries // 2)],
+        "тяжелые": [rng.choice(heavy)['to_user'] for _ in range(args.queries // 2)],
+    }
+    groups = {
+        group: [(user_id, rng.choice(MISSING) if rng.random() < 0.1 else rng.choice(TERMS)) for user_id in users]
+        for group, users in groups.items()
+    }
+
+    async def fulltext(user_id, term):
+        rows, _, _ = await main.search_reviews(user_id, term)
+        return rows
+
+    async def ilike(user_id, term):
+        async with pool.acquire() as conn:
+            return await conn.fetch(SEARCH_ILIKE_SQL, user_id, term, main.REVIEW_SEARCH_PAGE_SIZE + 1)
+
+    for group, queries in groups.items():
+        # Прогрев кэша страниц для обоих вариантов
+        for user_id, term in queries[:20]:
+            await fulltext(user_id, term)
+            await ilike(user_id, term)
+        await measure(f"tsvector + GIN, {group}", queries, fulltext)
+        await measure(f"ILIKE '%...%', {group}", queries, ilike)
+
+    user_id = heavy[0]['to_user']
+    async with pool.acquire() as conn:
+        for term in (TERMS[0], TERMS[-1], MISSING[0]):
+            await conn.execute("SET plan_cache_mode = force_custom_plan")
+            plan = await conn.fetch(
+                "EXPLAIN (ANALYZE, COSTS OFF, SUMMARY ON) " + main._review_search_sql("", "DESC"),
+                user_id, term, main.REVIEW_SEARCH_PAGE_SIZE + 1, *main.search_window_bounds(),
+            )
+            print(f"\nплан для {user_id} / '{term}' ({REVIEW_SEARCH_CONFIG}):")
+            print("\n".join("  " + row[0] for row in plan if "Planning" in row[0] or "Execution" in row[0]))
+    await main.db_pool.close()
+    await main.read_pool.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Бенчмарк поиска по отзывам")
+    parser.add_argument("--database-url", required=True, help="локальный Postgres")
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--users", type=int, default=20_000)
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
@@ -0,0 +1,106 @@
+import base64
+import binascii
+import struct
+from functools import lru_cache
+
+# Лимит Bot API на длину callback_data
+MAX_CALLBACK_DATA = 64
+# Признак нового формата: старые кнопки (текст через "_") с него не начинаются
+PREFIX = "~"
+
+# Разделы отзывов: в callback_data хранится индекс в этом кортеже
+REVIEW_TYPE_NAMES = ("pos", "neg", "all")
+# Курсор первой страницы отзывов (микросекунды, id)
+FIRST_PAGE = (0, 0)
+
+ROUTES = {}
+
+
+class Route:
+    # Вид кнопки: "~" + base64url(код маршрута + поля по формату struct).
+    # touches_user - обработчику нужна актуальная строка нажавшего в users.
+    __slots__ = ("code", "name", "touches_user", "_struct")
+
+    def __init__(self, code, name, fmt="", touches_user=False):
+        if code in ROUTES:
+            raise ValueError(f"Код маршрута {code} уже занят: {ROUTES[code].name}")
+        self.code = code
+        self.name = name
+        self.touches_user = touches_user
+        self._struct = struct.Struct("<B" + fmt)
+        if len(PREFIX) + (self._struct.size * 4 + 2) // 3 > MAX_CALLBACK_DATA:
+            raise ValueError(f"Маршрут {name} не помещается в {MAX_CALLBACK_DATA} байт")
+        ROUTES[code] = self
+
+    def encode(self, *values):
+        raw = self._struct.pack(self.code, *values)
+        return PREFIX + base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+    def __repr__(self):
+        return f"Route({self.name})"
+
+
+MAIN_MENU = Route(1, "main_menu")
+FIND_USER = Route(2, "find_user")
+SEND_REP = Route(3, "send_rep")
+MY_PROFILE = Route(4, "my_profile", touches_user=True)
+# user_id
+PROFILE = Route(5, "profile", "q")
+REVIEW_MENU = Route(6, "review_menu", "q")
+# раздел, user_id, курсор (мкс, id отзыва), назад
+REVIEW_PAGE = Route(7, "review_page", "Bqqq?")
+# раздел, user_id, курсор страницы (мкс, id отзыва), номер на странице
+REVIEW = Route(8, "review", "BqqqB")
+# рейтинг (индекс в leaderboard.BOARDS), страница
+LEADERBOARD = Route(9, "leaderboard", "BH")
+# user_id
+REVIEW_SEARCH = Route(10, "review_search", "q")
+# user_id, курсор (ранг, мкс, id отзыва), назад; сам запрос - в user_data
+REVIEW_SEARCH_PAGE = Route(11, "review_search_page", "qfqq?")
+
+
+@lru_cache(maxsize=4096)
+def decode(data):
+    # -> (Route, значения полей) или None для неизвестных/поврежденных данных
+    if not data.startswith(PREFIX):
+        return _decode_legacy(data)
+    try:
+        raw = base64.urlsafe_b64decode(data[len(PREFIX):] + "=" * (-(len(data) - len(PREFIX)) % 4))
+    except (binascii.Error, ValueError):
+        return None
+    route = ROUTES.get(raw[0]) if raw else None
+    if route is None or len(raw) != route._struct.size:
+        return None
+    return route, route._struct.unpack(raw)[1:]
+
+
+_LEGACY_SIMPLE = {"back_to_main": MAIN_MENU, "find_user": FIND_USER, "send_rep": SEND_REP, "my_profile": MY_PROFILE}
+
+
+def _decode_legacy(data):
+    # Кнопки в уже отправленных сообщениях остаются в старом текстовом формате
+    if data in _LEGACY_SIMPLE:
+        return _LEGACY_SIMPLE[data], ()
+    parts = data.split("_")
+    try:
+        if data.startswith("back_to_profile_"):
+            return PROFILE, (int(parts[3]),)
+        if data.startswith("back_to_review_menu_"):
+            return REVIEW_MENU, (int(parts[4]),)
+        if data.startswith("profile_reviews_"):
+            return REVIEW_MENU, (int(parts[2]),)
+        if parts[0] == "reviews":
+            # reviews_{раздел}_{user_id}
+            user_id = int(parts[2])
+            if parts[1] not in REVIEW_TYPE_NAMES:
+                return REVIEW_MENU, (user_id,)
+            return REVIEW_PAGE, (REVIEW_TYPE_NAMES.index(parts[1]), user_id, *FIRST_PAGE, False)
+        if parts[0] == "review":
+            # review_{id отзыва}_{user_id}_{раздел}_{номер среди свежих}: номер - на первой странице
+            user_id = int(parts[2])
+            if parts[3] not in REVIEW_TYPE_NAMES:
+                return REVIEW_MENU, (user_id,)
+            return REVIEW, (REVIEW_TYPE_NAMES.index(parts[3]), user_id, *FIRST_PAGE, int(parts[4]))
+    except (IndexError, ValueError):
+        pass
+    return None
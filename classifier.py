@@ -0,0 +1,103 @@
+import re
+
+DEFAULT_AD_KEYWORDS = ('купить', 'продаю', 'цены', 'оплата', 'баланс', 'карты', 'услуги', 'скам', 'принимаю', 'пушкинские')
+DEFAULT_SELF_PROMO = ('у меня', 'моя', 'мои', 'моё', 'на мне', 'с меня')
+
+# +реп / -реп (кириллица и латиница)
+REP_PATTERN = re.compile(r'[\+\-]\s*[РрRr][ЕеEe][ПпPp]\b')
+
+# Хвост "+реп" сразу после цифр (500+реп) - признак рекламы
+_DIGIT_REP_TAIL = re.compile(r'\s*[\+\-]\s*[рp][еe][пp]')
+
+
+class Classification:
+    __slots__ = ("mentions", "rep_sign", "is_ad", "digit_rep")
+
+    def __init__(self, mentions, rep_sign, is_ad, digit_rep):
+        self.mentions = mentions
+        self.rep_sign = rep_sign
+        self.is_ad = is_ad
+        self.digit_rep = digit_rep
+
+    @property
+    def is_rep(self):
+        # Сообщение, которое нужно сохранить как репутацию
+        return bool(self.mentions) and self.rep_sign is not None and not self.is_ad
+
+
+NOT_REP = Classification((), None, False, False)
+
+
+def _keyword_regex(keywords):
+    # Префиксное дерево слов -> регулярное выражение без повторного разбора общих префиксов
+    trie = {}
+    for word in keywords:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[''] = {}
+
+    def emit(node):
+        optional = '' in node
+        branches = [re.escape(ch) + emit(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        return f'(?:{body})?' if optional else body
+
+    return emit(trie)
+
+
+class MessageClassifier:
+    # Один проход одного скомпилированного регулярного выражения по тексту в нижнем регистре:
+    # упоминания (@name и ID от 5 цифр), знак репутации, рекламные слова и "500+реп"
+    def __init__(self, ad_keywords=DEFAULT_AD_KEYWORDS, self_promo=DEFAULT_SELF_PROMO):
+        keywords = {k.lower() for k in (*ad_keywords, *self_promo) if k}
+        alternatives = [
+            r'(?P<numrep>\d+\s*[\+\-]\s*[рp][еe][пp])',
+            r'(?P<rep>(?P<sign>[\+\-])\s*[рr][еe][пp]\b)',
+            r'@(?P<mention>\w+)',
+            r'(?P<id>\b\d{5,}\b)',
+        ]
+        if keywords:
+            keyword_pattern = _keyword_regex(keywords)
+            alternatives.append(f'(?P<kw>{keyword_pattern})')
+            self._keywords = re.compile(keyword_pattern)
+        else:
+            self._keywords = None
+        self._pattern = re.compile('|'.join(alternatives))
+
+    def classify(self, text):
+        # Без "+" или "-" это точно не репутация - остальное не важно
+        if '+' not in text and '-' not in text:
+            return NOT_REP
+
+        lower_text = text.lower()
+        # Упоминания берем из исходного текста, если lower() не изменил длину строки
+        source = text if len(lower_text) == len(text) else lower_text
+        mentions = []
+        rep_sign = None
+
+        for m in self._pattern.finditer(lower_text):
+            kind = m.lastgroup
+            if kind == 'mention':
+                mention = m.group('mention')
+                # Слово внутри @упоминания или "@user500 +реп" исходно тоже считались рекламой.
+                # Слово может и начинаться в упоминании, а заканчиваться после него ("@vasyaу меня"):
+                # основной проход его уже не увидит, поэтому ищем от начала упоминания до конца текста
+                if self._keywords is not None and self._keywords.search(lower_text, m.start('mention')):
+                    return Classification(mentions, rep_sign, True, False)
+                if mention[-1].isdigit() and _DIGIT_REP_TAIL.match(lower_text, m.end()):
+                    return Classification(mentions, rep_sign, True, True)
+                mentions.append(source[m.start('mention'):m.end('mention')])
+            elif kind == 'rep':
+                if rep_sign is None:
+                    rep_sign = m.group('sign')
+            elif kind == 'id':
+                mentions.append(m.group('id'))
+            elif kind == 'numrep':
+                return Classification(mentions, rep_sign, True, True)
+            else:
+                return Classification(mentions, rep_sign, True, False)
+
+        return Classification(mentions, rep_sign, False, False)
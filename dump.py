@@ -0,0 +1,332 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from datetime import datetime
+
+import asyncpg
+
+from migrations import MIGRATIONS, migrate
+from partitions import add_months
+
+# Выгрузка и загрузка users, reputation_log и его архива потоком через COPY, с постоянной памятью:
+#   python dump.py export [--dir backups] [--format csv|jsonl] [--table users ...]
+#   python dump.py import backups/users.csv backups/reputation_log.csv backups/archive_reputation_log.csv
+# Загрузка идет через временную таблицу и слияние: существующие пользователи
+# обновляются, уже существующие отзывы (по id, в том числе в архиве) пропускаются.
+# Миграции применяются только перед загрузкой; выгрузка схему не трогает и требует,
+# чтобы версия схемы БД совпадала с migrations.py.
+
+DATABASE_URL = os.environ.get("DATABASE_URL")
+
+# Таблица -> (колонки, ключ, SQL слияния из staging)
+TABLES = {
+    "users": (
+        ("user_id", "username", "registered", "total_deals", "deal_sum", "bio"),
+        "user_id",
+        """
+            INSERT INTO users (user_id, username, registered, total_deals, deal_sum, bio)
+            SELECT user_id, username, registered, total_deals, deal_sum, bio FROM staging
+            ON CONFLICT (user_id) DO UPDATE SET
+                username = EXCLUDED.username,
+                registered = EXCLUDED.registered,
+                total_deals = EXCLUDED.total_deals,
+                deal_sum = EXCLUDED.deal_sum,
+                bio = EXCLUDED.bio
+        """,
+    ),
+    "reputation_log": (
+        ("id", "from_user", "to_user", "type", "message_text", "photo_id", "created_at"),
+        "id",
+        """
+            INSERT INTO reputation_log (id, from_user, to_user, type, message_text, photo_id, created_at)
+            SELECT id, from_user, to_user, type, message_text, photo_id, created_at FROM staging
+            WHERE NOT EXISTS (
+                SELECT 1 FROM archive.reputation_log a WHERE a.id = staging.id AND a.created_at = staging.created_at
+            )
+            ON CONFLICT (id, created_at) DO NOTHING
+        """,
+    ),
+    # Отзывы, перенесенные в архив по сроку хранения (partitions.py). Статистику
+    # user_stats/reviewer_pairs для них перед слиянием дописывают ARCHIVE_IMPORT_*_SQL.
+    "archive_reputation_log": (
+        ("id", "from_user", "to_user", "type", "message_text", "photo_id", "created_at"),
+        "id",
+        """
+            INSERT INTO archive.reputation_log (id, from_user, to_user, type, message_text, photo_id, created_at)
+            SELECT id, from_user, to_user, type, message_text, photo_id, created_at FROM staging
+        """,
+    ),
+}
+# Пользователи раньше отзывов: так при загрузке сразу видны их username
+TABLE_ORDER = ("users", "reputation_log", "archive_reputation_log")
+# Имя в выгрузке -> таблица БД, если отличается
+RELATIONS = {"archive_reputation_log": "archive.reputation_log"}
+
+# Из staging архива убираются отзывы, которые уже есть в БД - в архиве или в основной таблице
+ARCHIVE_DEDUP_SQL = """
+    DELETE FROM staging s
+    WHERE EXISTS (SELECT 1 FROM archive.reputation_log a WHERE a.id = s.id AND a.created_at = s.created_at)
+       OR EXISTS (SELECT 1 FROM reputation_log r WHERE r.id = s.id AND r.created_at = s.created_at)
+"""
+
+# Загруженные в архив отзывы учитываются так же, как перенесенные туда partitions.py:
+# в общих счетчиках и в archived_*. unique_reviewers растет на новые пары (до ARCHIVE_IMPORT_PAIRS_SQL)
+ARCHIVE_IMPORT_STATS_SQL = """
+    INSERT INTO user_stats AS s (user_id, positive, negative, unique_reviewers, last_review_at,
+                                 archived_positive, archived_negative, archived_last_review_at)
+    SELECT to_user, positive, negative, new_reviewers, last_review_at, positive, negative, last_review_at
+    FROM (
+        SELECT st.to_user,
+               COUNT(*) FILTER (WHERE st.type = '+') AS positive,
+               COUNT(*) FILTER (WHERE st.type = '-') AS negative,
+               COUNT(DISTINCT COALESCE(st.from_user, 0)) FILTER (WHERE NOT EXISTS (
+                   SELECT 1 FROM reviewer_pairs p
+                   WHERE p.to_user = st.to_user AND p.from_user = COALESCE(st.from_user, 0)
+               )) AS new_reviewers,
+               MAX(st.created_at) AS last_review_at
+        FROM staging st
+        GROUP BY st.to_user
+    ) a
+    ON CONFLICT (user_id) DO UPDATE SET
+        positive = s.positive + EXCLUDED.positive,
+        negative = s.negative + EXCLUDED.negative,
+        unique_reviewers = s.unique_reviewers + EXCLUDED.unique_reviewers,
+        last_review_at = GREATEST(s.last_review_at, EXCLUDED.last_review_at),
+        archived_positive = s.archived_positive + EXCLUDED.archived_positive,
+        archived_negative = s.archived_negative + EXCLUDED.archived_negative,
+        archived_last_review_at = GREATEST(s.archived_last_review_at, EXCLUDED.archived_last_review_at)
+"""
+
+ARCHIVE_IMPORT_PAIRS_SQL = """
+    INSERT INTO reviewer_pairs AS p (to_user, from_user, reviews, archived)
+    SELECT to_user, COALESCE(from_user, 0), COUNT(*), COUNT(*)
+    FROM staging
+    GROUP BY to_user, COALESCE(from_user, 0)
+    ON CONFLICT (to_user, from_user) DO UPDATE SET
+        reviews = p.reviews + EXCLUDED.reviews,
+        archived = p.archived + EXCLUDED.archived
+"""
+
+CHUNK_SIZE = 1024 * 1024
+JSONL_BATCH = 10000
+
+
+class Progress:
+    # Печатает объем и скорость не чаще раза в interval секунд
+    def __init__(self, label, total=None, interval=2.0):
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.rows = 0
+        self.start = time.monotonic()
+        self._printed = self.start
+
+    def add(self, nbytes=0, rows=0):
+        self.done += nbytes
+        self.rows += rows
+        now = time.monotonic()
+        if now - self._printed >= self.interval:
+            self._printed = now
+            self._print(now)
+
+    def _print(self, now, final=False):
+        elapsed = max(now - self.start, 1e-9)
+        line = f"{self.label}: {self.done / 2 ** 20:,.1f} МБ ({self.done / 2 ** 20 / elapsed:,.1f} МБ/с)"
+        if self.rows:
+            line += f", {self.rows:,} строк ({self.rows / elapsed:,.0f} строк/с)"
+        if self.total and not final:
+            line += f", {self.done / self.total * 100:.0f}%"
+        print(line + (f" за {elapsed:.1f} с" if final else ""), flush=True)
+
+    def finish(self, rows=None):
+        if rows is not None:
+            self.rows = rows
+        self._print(time.monotonic(), final=True)
+
+
+def _copy_rows(status):
+    # "COPY 123" -> 123
+    return int(status.split()[-1]) if status else 0
+
+
+# ==================== EXPORT ====================
+async def export_table(conn, table, path, fmt):
+    columns, key, _ = TABLES[table]
+    query = f"SELECT {', '.join(columns)} FROM {RELATIONS.get(table, table)} ORDER BY {key}"
+    progress = Progress(f"{table} -> {path}")
+
+    with open(path, "wb") as out:
+        async def write(chunk):
+            out.write(chunk)
+            progress.add(len(chunk))
+
+        if fmt == "csv":
+            status = await conn.copy_from_query(query, output=write, format="csv", header=True)
+        else:
+            # Одна JSON-строка на запись. Символы-разделители, которых нет в JSON,
+            # отключают экранирование COPY - строки пишутся как есть.
+            status = await conn.copy_from_query(
+                f"SELECT row_to_json(t) FROM ({query}) t",
+                output=write, format="csv", delimiter="\x02", quote="\x01",
+            )
+    progress.finish(_copy_rows(status))
+
+
+async def check_schema(conn):
+    # Выгрузка не меняет схему: версия БД должна совпадать с миграциями этого кода
+    expected = MIGRATIONS[-1][0]
+    current = 0
+    if await conn.fetchval("SELECT to_regclass('schema_version')") is not None:
+        current = await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    if current != expected:
+        raise SystemExit(
+            f"Схема БД версии {current}, а dump.py рассчитан на версию {expected}. "
+            f"Выгрузка схему не меняет: берите версию кода, которая работает с этой БД"
+        )
+
+
+async def export(conn, tables, directory, fmt):
+    os.makedirs(directory, exist_ok=True)
+    # Одна транзакция REPEATABLE READ - все таблицы из одного снимка
+    async with conn.transaction(isolation="repeatable_read", readonly=True):
+        for table in tables:
+            await export_table(conn, table, os.path.join(directory, f"{table}.{fmt}"), fmt)
+
+
+# ==================== IMPORT ====================
+async def _read_chunks(path, progress):
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            progress.add(len(chunk))
+            yield chunk
+
+
+def _parse_value(column, value):
+    if value is not None and column in ("registered", "created_at"):
+        return datetime.fromisoformat(value)
+    return value
+
+
+async def _read_jsonl(path, columns, progress):
+    # Пачки записей по JSONL_BATCH строк - в памяти не больше одной пачки
+    batch = []
+    with open(path, "rb") as f:
+        for line in f:
+            progress.add(len(line))
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            batch.append(tuple(_parse_value(column, row.get(column)) for column in columns))
+            if len(batch) >= JSONL_BATCH:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+async def ensure_archive_partitions(conn):
+    # Месячные секции архива под даты из staging - с теми же именами, что дает partitions.py
+    months = await conn.fetch("SELECT DISTINCT date_trunc('month', created_at) AS month FROM staging")
+    for row in months:
+        month = row['month']
+        name = f"reputation_log_y{month:%Y}m{month:%m}"
+        if await conn.fetchval("SELECT to_regclass($1)", f"archive.{name}") is None:
+            await conn.execute(
+                f"CREATE TABLE archive.{name} PARTITION OF archive.reputation_log "
+                f"FOR VALUES FROM ('{month}') TO ('{add_months(month, 1)}')"
+            )
+
+
+async def import_table(conn, table, path):
+    columns, _, merge_sql = TABLES[table]
+    progress = Progress(f"{path} -> {table}", total=os.path.getsize(path))
+
+    async with conn.transaction():
+        await conn.execute(f"""
+            CREATE TEMP TABLE staging (LIKE {RELATIONS.get(table, table)} INCLUDING DEFAULTS) ON COMMIT DROP
+        """)
+        if path.endswith(".csv"):
+            status = await conn.copy_to_table(
+                "staging", source=_read_chunks(path, progress), columns=columns, format="csv", header=True,
+            )
+            loaded = _copy_rows(status)
+        else:
+            loaded = 0
+            async for batch in _read_jsonl(path, columns, progress):
+                await conn.copy_records_to_table("staging", records=batch, columns=columns)
+                loaded += len(batch)
+        progress.finish(loaded)
+
+        if table == "reputation_log":
+            # Месячные секции под даты из файла (старые отзывы могли уйти в архив)
+            await conn.execute("""
+                SELECT reputation_log_ensure_partitions(MIN(created_at), MAX(created_at)) FROM staging
+                HAVING COUNT(*) > 0
+            """)
+        elif table == "archive_reputation_log":
+            await conn.execute(ARCHIVE_DEDUP_SQL)
+            await ensure_archive_partitions(conn)
+            await conn.execute(ARCHIVE_IMPORT_STATS_SQL)
+            await conn.execute(ARCHIVE_IMPORT_PAIRS_SQL)
+
+        started = time.monotonic()
+        merged = _copy_rows(await conn.execute(merge_sql))
+        print(f"{table}: слито {merged:,} из {loaded:,} строк за {time.monotonic() - started:.1f} с", flush=True)
+
+        if table in ("reputation_log", "archive_reputation_log"):
+            # id пришли из файла - сдвигаем последовательность за максимальный, включая архив
+            await conn.execute("""
+                SELECT setval(pg_get_serial_sequence('reputation_log', 'id'), GREATEST(
+                    (SELECT MAX(id) FROM reputation_log), (SELECT MAX(id) FROM archive.reputation_log), 1
+                ))
+            """)
+
+
+async def import_files(conn, paths):
+    by_table = {}
+    for path in paths:
+        table = os.path.basename(path).split(".")[0]
+        if table not in TABLES or not path.endswith((".csv", ".jsonl")):
+            raise SystemExit(f"Не понимаю файл {path}: ожидается <таблица>.csv или <таблица>.jsonl")
+        by_table[table] = path
+    for table in TABLE_ORDER:
+        if table in by_table:
+            await import_table(conn, table, by_table[table])
+
+
+async def run(args):
+    conn = await asyncpg.connect(args.database_url)
+    try:
+        if args.command == "export":
+            await check_schema(conn)
+            await export(conn, args.table or TABLE_ORDER, args.dir, args.format)
+        else:
+            await migrate(conn)
+            await import_files(conn, args.files)
+    finally:
+        await conn.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Выгрузка и загрузка users/reputation_log (с архивом) через COPY")
+    parser.add_argument("--database-url", default=DATABASE_URL)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export")
+    export_parser.add_argument("--dir", default=f"dump-{datetime.now():%Y%m%d-%H%M%S}")
+    export_parser.add_argument("--format", choices=("csv", "jsonl"), default="csv")
+    export_parser.add_argument("--table", action="append", choices=TABLE_ORDER)
+
+    import_parser = commands.add_parser("import")
+    import_parser.add_argument("files", nargs="+")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
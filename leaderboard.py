@@ -0,0 +1,174 @@
+import asyncio
+import logging
+from bisect import bisect_left, insort
+
+logger = logging.getLogger(__name__)
+
+# Рейтинги: в callback_data хранится индекс в этом кортеже
+BOARDS = ("positive", "ratio", "deals")
+
+LOAD_SQL = """
+    SELECT u.user_id, u.username, u.deal_sum,
+           COALESCE(s.positive, 0) AS positive, COALESCE(s.negative, 0) AS negative
+    FROM users u
+    LEFT JOIN user_stats s ON s.user_id = u.user_id
+"""
+
+
+class Ranking:
+    # Отсортированный список ключей (..., user_id): место - бинарный поиск по ключу
+    __slots__ = ("keys", "by_user")
+
+    def __init__(self, keys=()):
+        self.keys = sorted(keys)
+        self.by_user = {key[-1]: key for key in self.keys}
+
+    def update(self, user_id, key):
+        # key=None - убрать пользователя из рейтинга
+        old = self.by_user.get(user_id)
+        if old == key:
+            return
+        if old is not None:
+            del self.keys[bisect_left(self.keys, old)]
+            del self.by_user[user_id]
+        if key is not None:
+            insort(self.keys, key)
+            self.by_user[user_id] = key
+
+    def rank(self, user_id):
+        # Место с 1 или None, если пользователя нет в рейтинге
+        key = self.by_user.get(user_id)
+        return bisect_left(self.keys, key) + 1 if key is not None else None
+
+    def slice(self, offset, limit):
+        return [key[-1] for key in self.keys[offset:offset + limit]]
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class Leaderboard:
+    # Топ пользователей в памяти процесса. Строится целиком при старте и раз в
+    # reload_interval секунд (сделки и правки других процессов), а между
+    # перезагрузками обновляется на месте при каждом добавлении/удалении отзыва.
+    def __init__(self, min_reviews=5, reload_interval=600):
+        self.min_reviews = min_reviews
+        self.reload_interval = reload_interval
+        self.pool = None
+        # user_id -> [username, positive, negative, deal_sum]
+        self.entries = {}
+        self.rankings = {board: Ranking() for board in BOARDS}
+        self.reloads = 0
+        self._task = None
+
+    def _keys(self, user_id, positive, negative, deal_sum):
+        total = positive + negative
+        return {
+            "positive": (-positive, user_id) if positive > 0 else None,
+            "ratio": (-positive / total, -positive, user_id) if total > 0 and total >= self.min_reviews else None,
+            "deals": (-deal_sum, user_id) if deal_sum > 0 else None,
+        }
+
+    def set(self, user_id, username, positive, negative, deal_sum):
+        entry = self.entries.get(user_id)
+        if entry is not None and entry[1:] == [positive, negative, deal_sum]:
+            entry[0] = username or entry[0]
+            return
+        for board, key in self._keys(user_id, positive, negative, deal_sum).items():
+            self.rankings[board].update(user_id, key)
+        if positive or negative or deal_sum:
+            self.entries[user_id] = [username or (entry[0] if entry else None), positive, negative, deal_sum]
+        else:
+            self.entries.pop(user_id, None)
+
+    def add_review(self, user_id, rep_type, delta=1, username=None):
+        # delta=-1 - отзыв удален
+        name, positive, negative, deal_sum = self.entries.get(user_id) or [username, 0, 0, 0]
+        if rep_type == '+':
+            positive = max(positive + delta, 0)
+        else:
+            negative = max(negative + delta, 0)
+        self.set(user_id, username or name, positive, negative, deal_sum)
+
+    def rename(self, user_id, username):
+        entry = self.entries.get(user_id)
+        if entry is not None and entry[0] != username:
+            entry[0] = username
+    
+    def rank(self, board, user_id):
+        return self.rankings[board].rank(user_id)
+
+    def page(self, board, page, page_size):
+        # -> ([(место, user_id, username, positive, negative, deal_sum)], всего страниц)
+        ranking = self.rankings[board]
+        offset = page * page_size
+        rows = [
+            (offset + i + 1, user_id, *self.entries[user_id])
+            for i, user_id in enumerate(ranking.slice(offset, page_size))
+        ]
+        return rows, max((len(ranking) + page_size - 1) // page_size, 1)
+
+    def load(self, rows):
+        # Полная перестройка: одна сортировка на рейтинг вместо вставок по одному
+        entries = {}
+        keys = {board: [] for board in BOARDS}
+        for row in rows:
+            user_id, positive, negative, deal_sum = row['user_id'], row['positive'], row['negative'], row['deal_sum']
+            if not (positive or negative or deal_sum):
+                continue
+            entries[user_id] = [row['username'], positive, negative, deal_sum]
+            for board, key in self._keys(user_id, positive, negative, deal_sum).items():
+                if key is not None:
+                    keys[board].append(key)
+        self.entries = entries
+        self.rankings = {board: Ranking(keys[board]) for board in BOARDS}
+        self.reloads += 1
+
+    async def reload(self):
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(
+                LOAD_SQL + "WHERE s.positive > 0 OR s.negative > 0 OR u.deal_sum > 0"
+            )
+        self.load(rows)
+        logger.info("Рейтинг загружен: %d пользователей", len(self.entries))
+
+    async def refresh(self, user_ids):
+        # Перечитать из БД отдельных пользователей (после сверки user_stats)
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(LOAD_SQL + "WHERE u.user_id = ANY($1::bigint[])", list(user_ids))
+        found = set()
+        for row in rows:
+            found.add(row['user_id'])
+            self.set(row['user_id'], row['username'], row['positive'], row['negative'], row['deal_sum'])
+        for user_id in set(user_ids) - found:
+            self.set(user_id, None, 0, 0, 0)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                await self.reload()
+            except Exception:
+                logger.exception("Не удалось перезагрузить рейтинг")
+
+    async def start(self, pool):
+        self.pool = pool
+        await self.reload()
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self):
+        return {
+            "users": len(self.entries),
+            "reloads": self.reloads,
+            **{f"ranked_{board}": len(ranking) for board, ranking in self.rankings.items()},
+        }
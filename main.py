@@ -1,154 +1,625 @@
 import os
-import re
 import logging
-from datetime import datetime
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import functools
+import html
+import time
+from datetime import datetime, timedelta
+from telegram import Chat, Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
+from telegram.error import BadRequest, TelegramError
+from telegram.request import HTTPXRequest
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
 import asyncpg
 from asyncpg import create_pool
 
+import callbacks
+import queries
+from cache import LRUCache
+from callbacks import FIRST_PAGE, REVIEW_TYPE_NAMES
+from classifier import DEFAULT_AD_KEYWORDS, DEFAULT_SELF_PROMO, REP_PATTERN, MessageClassifier
+import metrics
+from leaderboard import BOARDS, Leaderboard
+from metrics import BOT_API_SECONDS, HANDLER_ERRORS, HANDLER_SECONDS, REP_DROPPED, USER_API_LOOKUP_SECONDS, Gauge, Timer, TimedPool, timed_query
+from migrations import RECENT_WINDOW_DAYS, REVIEW_SEARCH_CONFIG, migrate, is_valid_user_id
+from outbox import Outbox
+from partitions import PartitionManager, add_months
+from pending import PendingResolver
+from resolver import UsernameResolver
+from reviewstore import ReviewPageStore
+from persistence import PostgresPersistence
+from readrouter import ReadRouter
+from reconcile import StatsReconciler
+from processing import PerChatUpdateProcessor
+from ratelimit import KeyedLimiter, LoadShedder
+from userwriter import UserWriter
+
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 
 TOKEN = os.environ.get("BOT_TOKEN")
 DATABASE_URL = os.environ.get("DATABASE_URL")
+# Реплика для чтения профилей и отзывов; не задана - отдельный read-пул к той же БД
+DATABASE_READ_URL = os.environ.get("DATABASE_READ_URL")
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", "5"))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", "10"))
+DB_READ_POOL_MIN = int(os.environ.get("DB_READ_POOL_MIN", "5"))
+DB_READ_POOL_MAX = int(os.environ.get("DB_READ_POOL_MAX", "10"))
+# Сколько секунд после записи данные пользователя читаются с primary
+READ_YOUR_WRITES_SECONDS = float(os.environ.get("READ_YOUR_WRITES_SECONDS", "5"))
 CHANNEL_LINK = "https://t.me/+QIEAfs-6HnI0NmMy"
 
+# Вебхук включается, если задан WEBHOOK_URL (публичный https-адрес бота), иначе polling
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+MAX_CONCURRENT_UPDATES = int(os.environ.get("MAX_CONCURRENT_UPDATES", "64"))
+STATE_FLUSH_INTERVAL = float(os.environ.get("STATE_FLUSH_INTERVAL", "10"))
+STATE_TTL = int(os.environ.get("STATE_TTL", "3600"))
+# Порт для /metrics в формате Prometheus (не задан - метрики не отдаются)
+METRICS_PORT = int(os.environ["METRICS_PORT"]) if os.environ.get("METRICS_PORT") else None
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+SLOW_QUERY_MS = int(os.environ.get("SLOW_QUERY_MS", "100"))
+# Лимиты исходящих сообщений (сообщений в секунду)
+SEND_GLOBAL_RATE = float(os.environ.get("SEND_GLOBAL_RATE", "30"))
+SEND_PRIVATE_RATE = float(os.environ.get("SEND_PRIVATE_RATE", "1"))
+SEND_GROUP_RATE = float(os.environ.get("SEND_GROUP_RATE", str(20 / 60)))
+# Лимиты входящих сообщений и нажатий кнопок (в секунду и размер всплеска)
+USER_RATE = float(os.environ.get("USER_RATE", "1"))
+USER_BURST = int(os.environ.get("USER_BURST", "5"))
+CHAT_RATE = float(os.environ.get("CHAT_RATE", "5"))
+CHAT_BURST = int(os.environ.get("CHAT_BURST", "20"))
+# Перегрузка: столько апдейтов в обработке или ответов в очереди outbox
+OVERLOAD_UPDATES = int(os.environ.get("OVERLOAD_UPDATES", str(MAX_CONCURRENT_UPDATES * 4)))
+OVERLOAD_OUTBOX = int(os.environ.get("OVERLOAD_OUTBOX", "500"))
+DEFERRED_MAX = int(os.environ.get("DEFERRED_MAX", "10000"))
+# Поиск неизвестных @username в фоне: задач, запросов get_chat в секунду, период пересмотра очереди
+PENDING_WORKERS = int(os.environ.get("PENDING_WORKERS", "4"))
+PENDING_API_RATE = float(os.environ.get("PENDING_API_RATE", "5"))
+PENDING_SWEEP_INTERVAL = int(os.environ.get("PENDING_SWEEP_INTERVAL", "60"))
+
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "50000"))
+USER_FLUSH_BATCH = int(os.environ.get("USER_FLUSH_BATCH", "200"))
+USER_FLUSH_INTERVAL_MS = int(os.environ.get("USER_FLUSH_INTERVAL_MS", "500"))
+PROFILE_CACHE_SIZE = int(os.environ.get("PROFILE_CACHE_SIZE", "10000"))
+PROFILE_CACHE_TTL = int(os.environ.get("PROFILE_CACHE_TTL", "300"))
+USERNAME_CACHE_SIZE = int(os.environ.get("USERNAME_CACHE_SIZE", "50000"))
+USERNAME_NEGATIVE_TTL = int(os.environ.get("USERNAME_NEGATIVE_TTL", "600"))
+REVIEW_PAGE_SIZE = 10
+REVIEW_SEARCH_PAGE_SIZE = 5
+REVIEW_SEARCH_MAX_QUERY = 200
+REVIEW_SEARCH_CANDIDATES = int(os.environ.get("REVIEW_SEARCH_CANDIDATES", "200"))
+REVIEW_STORE_PER_USER = int(os.environ.get("REVIEW_STORE_PER_USER", "8"))
+REVIEW_STORE_BYTES = int(os.environ.get("REVIEW_STORE_BYTES", str(8 * 1024 * 1024)))
+STATS_RECONCILE_INTERVAL = int(os.environ.get("STATS_RECONCILE_INTERVAL", "3600"))
+STATS_RECONCILE_CHUNK = int(os.environ.get("STATS_RECONCILE_CHUNK", "500"))
+LEADERBOARD_PAGE_SIZE = int(os.environ.get("LEADERBOARD_PAGE_SIZE", "10"))
+LEADERBOARD_MIN_REVIEWS = int(os.environ.get("LEADERBOARD_MIN_REVIEWS", "5"))
+LEADERBOARD_RELOAD_INTERVAL = int(os.environ.get("LEADERBOARD_RELOAD_INTERVAL", "600"))
+LEADERBOARD_CACHE_TTL = int(os.environ.get("LEADERBOARD_CACHE_TTL", "30"))
+# Секции reputation_log старше стольких месяцев уходят в схему archive; 0 - хранить все
+REPUTATION_RETENTION_MONTHS = int(os.environ.get("REPUTATION_RETENTION_MONTHS", "0"))
+PARTITIONS_AHEAD_MONTHS = int(os.environ.get("PARTITIONS_AHEAD_MONTHS", "3"))
+# Списки слов антиспама через запятую; по умолчанию - встроенные
+AD_KEYWORDS = [k.strip() for k in os.environ["AD_KEYWORDS"].split(",")] if os.environ.get("AD_KEYWORDS") else DEFAULT_AD_KEYWORDS
+SELF_PROMO = [k.strip() for k in os.environ["SELF_PROMO"].split(",")] if os.environ.get("SELF_PROMO") else DEFAULT_SELF_PROMO
+
 # ==================== DATABASE POOL ====================
 db_pool = None
+read_pool = None
+read_router = ReadRouter(READ_YOUR_WRITES_SECONDS)
+user_writer = UserWriter(USER_CACHE_SIZE, USER_FLUSH_BATCH, USER_FLUSH_INTERVAL_MS / 1000)
+# user_id -> {"user": запись, "": карточка, "<ссылка>": карточка со ссылкой}
+profile_cache = LRUCache(PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL)
+resolver = UsernameResolver(USERNAME_CACHE_SIZE, USERNAME_NEGATIVE_TTL)
+# Отзывы на неизвестные @username ждут в pending_reputation, пока их не найдут через API
+pending_resolver = PendingResolver(PENDING_WORKERS, PENDING_API_RATE, sweep_interval=PENDING_SWEEP_INTERVAL)
+message_classifier = MessageClassifier(AD_KEYWORDS, SELF_PROMO)
+# Открытые пользователями страницы отзывов (только ID) для переходов по номерам
+review_store = ReviewPageStore(REVIEW_STORE_PER_USER, REVIEW_STORE_BYTES)
+outbox = Outbox(SEND_GLOBAL_RATE, SEND_PRIVATE_RATE, SEND_GROUP_RATE)
+user_limiter = KeyedLimiter(USER_RATE, USER_BURST)
+chat_limiter = KeyedLimiter(CHAT_RATE, CHAT_BURST)
+# Под перегрузкой разбор "+реп" откладывается, отвечаем только на запросы профилей
+load_shedder = LoadShedder(max_deferred=DEFERRED_MAX)
+stats_reconciler = StatsReconciler(STATS_RECONCILE_CHUNK, interval=STATS_RECONCILE_INTERVAL)
+leaderboard = Leaderboard(LEADERBOARD_MIN_REVIEWS, LEADERBOARD_RELOAD_INTERVAL)
+partition_manager = PartitionManager(REPUTATION_RETENTION_MONTHS, PARTITIONS_AHEAD_MONTHS)
+# (рейтинг, страница) -> (текст, всего страниц); место пользователя дописывается отдельно
+leaderboard_cache = LRUCache(256, ttl=LEADERBOARD_CACHE_TTL)
+
+def _on_user_change(user_id, username):
+    profile_cache.pop(user_id)
+    read_router.wrote(user_id)
+    resolver.remember(user_id, username)
+    leaderboard.rename(user_id, username)
+
+user_writer.on_change = _on_user_change
+
+async def _on_stats_fixed(user_ids):
+    for user_id in user_ids:
+        profile_cache.pop(user_id)
+    await leaderboard.refresh(user_ids)
 
 async def init_db_pool():
-    global db_pool
-    db_pool = await create_pool(DATABASE_URL, min_size=5, max_size=10)
+    global db_pool, read_pool
+    if db_pool is not None:
+        return db_pool
+    db_pool = TimedPool(await create_pool(DATABASE_URL, min_size=DB_POOL_MIN, max_size=DB_POOL_MAX), "primary")
+    # Чтения не ждут соединений, занятых записью отзывов
+    read_pool = TimedPool(
+        await create_pool(DATABASE_READ_URL or DATABASE_URL, min_size=DB_READ_POOL_MIN, max_size=DB_READ_POOL_MAX),
+        "read",
+    )
+    read_router.start(db_pool, read_pool)
 
     async with db_pool.acquire() as conn:
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id BIGINT PRIMARY KEY,
-                username TEXT,
-                registered TIMESTAMP DEFAULT NOW(),
-                positive INT DEFAULT 0,
-                negative INT DEFAULT 0,
-                total_deals INT DEFAULT 0,
-                deal_sum BIGINT DEFAULT 0,
-                bio TEXT DEFAULT ''
-            )
-        """)
-        
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS reputation_log (
-                id SERIAL PRIMARY KEY,
-                from_user BIGINT,
-                to_user BIGINT,
-                type TEXT CHECK (type IN ('+', '-')),
-                message_text TEXT,
-                photo_id TEXT,
-                created_at TIMESTAMP DEFAULT NOW()
-            )
-        """)
-        
-        await conn.execute("UPDATE users SET positive = 0 WHERE positive < 0")
-        await conn.execute("UPDATE users SET negative = 0 WHERE negative < 0")
-        
-        await conn.execute("DELETE FROM users WHERE user_id > 9000000000 OR (user_id < 1000000000 AND user_id > 0)")
-        await conn.execute("DELETE FROM reputation_log WHERE from_user > 9000000000 OR (from_user < 1000000000 AND from_user > 0)")
-        await conn.execute("DELETE FROM reputation_log WHERE to_user > 9000000000 OR (to_user < 1000000000 AND to_user > 0)")
+        applied = await migrate(conn)
 
-    print("✅ БД готова, отрицательные счетчики сброшены")
+    if applied:
+        print(f"✅ БД готова, применены миграции: {', '.join(map(str, applied))}")
+    else:
+        print("✅ БД готова")
+    return db_pool
 
+@timed_query("get_user")
 async def get_user(user_id):
-    async with db_pool.acquire() as conn:
-        return await conn.fetchrow("SELECT * FROM users WHERE user_id = $1", user_id)
+    await user_writer.ensure_flushed(user_id)
+    async with read_router.pool_for(user_id).acquire() as conn:
+        user = await queries.USER_BY_ID.fetchrow(conn, user_id)
+    if user:
+        user_writer.remember(user['user_id'], user['username'])
+        resolver.remember(user['user_id'], user['username'])
+    return user
 
 async def get_user_by_username(username, context=None):
+    # Повторные и одновременные запросы одного username обслуживает resolver;
+    # отрицательный результат кэшируется, только если проверяли и Telegram API.
+    # Временная ошибка API (сеть, flood limit) - тоже None, но без записи в кэш:
+    # resolver пробрасывает исключение раньше, чем запоминает отсутствие
+    try:
+        return await resolver.resolve(
+            username,
+            get_user,
+            lambda name: _load_user_by_username(name, context),
+            cache_negative=context is not None,
+        )
+    except TelegramError as e:
+        print(f"Не удалось найти пользователя @{username} в Telegram: {e}")
+        return None
+
+async def _load_user_by_username(username, context=None):
     # Сначала ищем в БД
-    async with db_pool.acquire() as conn:
-        user = await conn.fetchrow("SELECT * FROM users WHERE username ILIKE $1", username)
-    
-    # Если нашли в БД - возвращаем
+    user = await _find_user_by_username(username)
     if user:
         return user
     
     # Если не нашли и есть context - пробуем найти через Telegram API
     if context:
-        try:
-            chat = await context.bot.get_chat(f"@{username}")
-            if chat:
-                # Создаем пользователя в БД
-                await create_user(chat.id, chat.username or username)
-                # Возвращаем свежесозданного пользователя
-                async with db_pool.acquire() as conn:
-                    return await conn.fetchrow("SELECT * FROM users WHERE user_id = $1", chat.id)
-        except Exception as e:
-            print(f"Не удалось найти пользователя @{username} в Telegram: {e}")
+        return await _fetch_user_via_api(username, context.bot)
     
     return None
 
+@timed_query("get_user_by_username")
+async def _find_user_by_username(username):
+    # Только БД: поиск через Telegram API меряется отдельно, в USER_API_LOOKUP_SECONDS
+    await user_writer.ensure_flushed_username(username)
+    async with read_router.pool_for().acquire() as conn:
+        user = await queries.USER_BY_USERNAME.fetchrow(conn, username)
+    if user:
+        user_writer.remember(user['user_id'], user['username'])
+    return user
+
+async def _fetch_user_via_api(username, bot):
+    # -> пользователь из Telegram API (создается в БД) или None, если такого нет
+    # ("Chat not found"); остальные ошибки API пробрасываются
+    resolver.api_calls += 1
+    with Timer(USER_API_LOOKUP_SECONDS):
+        try:
+            chat = await bot.get_chat(f"@{username}")
+        except BadRequest as e:
+            if "not found" not in e.message.lower():
+                raise
+            print(f"Не удалось найти пользователя @{username} в Telegram: {e}")
+            return None
+        # Создаем пользователя в БД и возвращаем свежесозданного
+        await create_user(chat.id, chat.username or username)
+        return await get_user(chat.id)
+
+async def resolve_pending_username(bot, username):
+    # Для pending_resolver: БД, затем Telegram API; временные ошибки API (сеть, flood limit)
+    # пробрасываются - отложенные отзывы остаются ждать следующей попытки
+    async def load(name):
+        return await _find_user_by_username(name) or await _fetch_user_via_api(name, bot)
+    return await resolver.resolve(username, get_user, load)
+
+@timed_query("resolve_mentions")
+async def resolve_mentions(mentions):
+    # Все упоминания одного сообщения одним запросом к БД, без Telegram API:
+    # кого нет в БД, ищет pending_resolver в фоне.
+    # mentions - строки (username или числовой ID); возвращает {упоминание: UserRef или None}
+    ids = [int(m) for m in mentions if m.isdigit()]
+    names = [m.lower() for m in mentions if not m.isdigit() and m.lower() not in resolver.negative]
+
+    result = {m: None for m in mentions}
+    if ids or names:
+        await user_writer.ensure_flushed_many(ids, names)
+        async with read_router.pool_for(*ids).acquire() as conn:
+            rows = await queries.USER_REFS.fetch(conn, ids, names)
+        by_id = {row['user_id']: row for row in rows}
+        by_name = {(row['username'] or "").lower(): row for row in rows}
+        for row in rows:
+            user_writer.remember(row['user_id'], row['username'])
+            resolver.remember(row['user_id'], row['username'])
+        for m in mentions:
+            result[m] = by_id.get(int(m)) if m.isdigit() else by_name.get(m.lower())
+    return result
+
+@timed_query("create_user")
 async def create_user(user_id, username):
-    async with db_pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO users (user_id, username, registered)
-            VALUES ($1, $2, $3)
-            ON CONFLICT (user_id) DO UPDATE SET username = $2
-        """, user_id, username, datetime.now())
+    # Пишет сразу, но пропускает пользователей, которые уже есть в БД с тем же username
+    await user_writer.write(user_id, username)
+
+def touch_user(user_id, username):
+    # Отложенная пакетная запись для горячих путей (start, кнопки, сообщения)
+    user_writer.touch(user_id, username)
 
+@timed_query("update_reputation")
 async def update_reputation(to_user, from_user, rep_type, message_text, photo_id):
+    await update_reputation_many([to_user], from_user, rep_type, message_text, photo_id)
+
+@timed_query("update_reputation_many")
+async def update_reputation_many(to_users, from_user, rep_type, message_text, photo_id):
+    # Все записи одним оператором; user_stats обновляет триггер в той же транзакции.
+    # Такие ID раньше удалялись при каждом старте - теперь просто не пишем их.
+    # Строки user_stats/reviewer_pairs триггер блокирует в порядке вставки: по возрастанию
+    # user_id, как и сверка (reconcile.py), чтобы "@a @b +реп" и "@b @a +реп" из разных
+    # чатов не взаимоблокировались; повтор одного упоминания - один отзыв
+    if not is_valid_user_id(from_user):
+        return
+    to_users = sorted({u for u in to_users if is_valid_user_id(u)})
+    if not to_users:
+        return
     async with db_pool.acquire() as conn:
-        if rep_type == '+':
-            await conn.execute("UPDATE users SET positive = positive + 1 WHERE user_id = $1", to_user)
+        await queries.ADD_REVIEWS.execute(conn, from_user, to_users, rep_type, message_text, photo_id)
+    read_router.wrote(from_user, *to_users)
+    for to_user in to_users:
+        profile_cache.pop(to_user)
+        leaderboard.add_review(to_user, rep_type, username=user_writer.known.get(to_user))
+
+async def _on_pending_done(bot, username, user, rows):
+    # Итог фонового поиска username: кэши - как в update_reputation_many,
+    # плюс ответ на каждое сообщение, где ждал отзыв
+    if user is not None:
+        saved = [row for row in rows if row['from_user'] != user['user_id']]
+        if saved:
+            read_router.wrote(user['user_id'], *(row['from_user'] for row in saved))
+            profile_cache.pop(user['user_id'])
+            for row in saved:
+                leaderboard.add_review(user['user_id'], row['type'], username=user['username'])
+    for row in rows:
+        if user is None:
+            text = f"<b>🚫 Пользователь не найден:</b> @{username}"
+        elif row['from_user'] == user['user_id']:
+            text = "<b>🚫 Нельзя отправить репутацию самому себе</b>"
         else:
-            await conn.execute("UPDATE users SET negative = negative + 1 WHERE user_id = $1", to_user)
-        await conn.execute("""
-            INSERT INTO reputation_log (from_user, to_user, type, message_text, photo_id)
-            VALUES ($1, $2, $3, $4, $5)
-        """, from_user, to_user, rep_type, message_text, photo_id)
-
-async def delete_review_by_id(review_id):
+            text = f"<b>✅ Репутация сохранена:</b> @{user['username'] or username}"
+        outbox.call(Chat(row['chat_id'], row['chat_type']), functools.partial(
+            bot.send_message, row['chat_id'], text, parse_mode="HTML",
+            reply_to_message_id=row['message_id'], allow_sending_without_reply=True,
+        ))
+
+@timed_query("delete_review_by_id")
+async def delete_review_by_id(review_id, created_at):
     async with db_pool.acquire() as conn:
-        review = await conn.fetchrow("SELECT * FROM reputation_log WHERE id = $1", review_id)
-        if review:
-            if review['type'] == '+':
-                await conn.execute("UPDATE users SET positive = GREATEST(positive - 1, 0) WHERE user_id = $1", review['to_user'])
-            else:
-                await conn.execute("UPDATE users SET negative = GREATEST(negative - 1, 0) WHERE user_id = $1", review['to_user'])
-            await conn.execute("DELETE FROM reputation_log WHERE id = $1", review_id)
-            return True
+        deleted = await queries.DELETE_REVIEW.fetchrow(conn, review_id, created_at)
+    if deleted is None:
         return False
+    read_router.wrote(deleted['to_user'])
+    profile_cache.pop(deleted['to_user'])
+    leaderboard.add_review(deleted['to_user'], deleted['type'], delta=-1)
+    return True
+
+# ==================== REVIEWS ====================
+CURSOR_EPOCH = datetime(1970, 1, 1)
+
+def encode_cursor(created_at, review_id):
+    # Ключ keyset-пагинации (created_at, id) для callback_data: (микросекунды, id)
+    micros = (created_at - CURSOR_EPOCH) // timedelta(microseconds=1)
+    return micros, review_id
+
+def decode_cursor(micros, review_id):
+    return CURSOR_EPOCH + timedelta(microseconds=micros), review_id
+
+@timed_query("get_review")
+async def get_review(review_id, created_at):
+    async with read_router.pool_for().acquire() as conn:
+        return await queries.REVIEW_BY_ID.fetchrow(conn, review_id, created_at)
+
+@timed_query("get_review_page")
+async def get_review_page(to_user, review_type, cursor=None, backward=False):
+    # Возвращает (отзывы, есть_предыдущая, курсор_следующей).
+    # cursor=None - первая страница; иначе страница начинается с cursor включительно,
+    # а при backward=True - это страница перед cursor (более новые отзывы)
+    limit = REVIEW_PAGE_SIZE
+    async with read_router.pool_for(to_user).acquire() as conn:
+        if cursor is None:
+            rows = await queries.REVIEW_PAGES[review_type, "first"].fetch(conn, to_user, limit + 1)
+            has_prev = False
+        elif not backward:
+            rows = await queries.REVIEW_PAGES[review_type, "older"].fetch(conn, to_user, limit + 1, *cursor)
+            has_prev = True
+        else:
+            rows = await queries.REVIEW_PAGES[review_type, "newer"].fetch(conn, to_user, limit + 1, *cursor)
+            if len(rows) < limit:
+                # Начало списка сдвинулось (удаления) - просто показываем первую страницу
+                return await get_review_page(to_user, review_type)
+            has_prev = len(rows) > limit
+            rows = rows[:limit]
+            rows.reverse()
+            # Следующая страница начинается ровно с того отзыва, от которого шли назад
+            return rows, has_prev, encode_cursor(*cursor)
+
+    next_cursor = encode_cursor(rows[limit]['created_at'], rows[limit]['id']) if len(rows) > limit else None
+    return rows[:limit], has_prev, next_cursor
+
+# Границы совпадений в ts_headline: заменяются на <b></b> после экранирования текста
+SEARCH_MARK_START, SEARCH_MARK_STOP = "\x02", "\x03"
+SEARCH_FIRST_PAGE = (0.0, *FIRST_PAGE)
+
+# Прямо в условии, а не через CROSS JOIN: иначе в общем плане подготовленного
+# запроса (asyncpg) tsquery не становится условием GIN-индекса
+SEARCH_TSQUERY = f"websearch_to_tsquery('{REVIEW_SEARCH_CONFIG}', $2)"
+# Окна поиска свежих совпадений: с начала текущего месяца, затем 2, 4, 8, 16 месяцев и все остальное
+SEARCH_WINDOW_MONTHS = (0, 2, 6, 14, 30)
+# Номер первого параметра курсора: после $1-$3 и границ окон
+SEARCH_CURSOR_PARAM = 4 + len(SEARCH_WINDOW_MONTHS)
+
+def _search_window_sql(lower, upper):
+    bounds = "".join(
+        f" AND r.created_at {op} ${param}" for op, param in ((">=", lower), ("<", upper)) if param is not None
+    )
+    return f"""(
+                SELECT r.id, r.type, r.created_at, r.from_user, r.message_text,
+                       ts_rank_cd(r.search, {SEARCH_TSQUERY}) AS rank
+                FROM reputation_log r
+                WHERE r.to_user = $1 AND r.search @@ {SEARCH_TSQUERY}{bounds}
+                ORDER BY r.created_at DESC
+                LIMIT {REVIEW_SEARCH_CANDIDATES}
+            )"""
+
+def _review_search_sql(condition, order):
+    # Совпадения ищет GIN-индекс по reputation_log.search. Ранжируются только
+    # REVIEW_SEARCH_CANDIDATES самых свежих совпадений: у пользователя с десятками
+    # тысяч отзывов частое слово встречается в тысячах из них, и ts_rank_cd по всем -
+    # это сотни миллисекунд. Свежие совпадения набираются по окнам SEARCH_WINDOW_MONTHS
+    # от новых к старым: UNION ALL выполняет ветки по порядку и останавливается на LIMIT,
+    # так что старые секции не читаются, когда хватило новых. Границы окон - параметры,
+    # а не LATERAL по месяцам: с ними план каждой ветки знает свои секции и число строк.
+    # При равном ранге новые отзывы выше; ts_headline считается только для LIMIT строк.
+    # matches - сколько совпадений ранжировано: если ровно REVIEW_SEARCH_CANDIDATES, более
+    # старые листанием не достать, и результаты помечаются (get_review_search_text).
+    windows = len(SEARCH_WINDOW_MONTHS)
+    candidates = "\n            UNION ALL\n            ".join(
+        _search_window_sql(4 + i if i < windows else None, 3 + i if i > 0 else None) for i in range(windows + 1)
+    )
+    return f"""
+        WITH candidates AS MATERIALIZED (
+            {candidates}
+            LIMIT {REVIEW_SEARCH_CANDIDATES}
+        ), page AS (
+            SELECT c.id, c.type, c.created_at, c.from_user, c.message_text, c.rank FROM candidates c
+            WHERE TRUE{condition}
+            ORDER BY c.rank {order}, c.created_at {order}, c.id {order}
+            LIMIT $3
+        )
+        SELECT c.id, c.type, c.created_at, u.username AS from_username, c.rank,
+               (SELECT COUNT(*) FROM candidates) AS matches,
+               ts_headline('{REVIEW_SEARCH_CONFIG}', COALESCE(c.message_text, ''), {SEARCH_TSQUERY},
+                           'StartSel={SEARCH_MARK_START}, StopSel={SEARCH_MARK_STOP}, MaxWords=25, MinWords=8, MaxFragments=2') AS snippet
+        FROM page c
+        LEFT JOIN users u ON u.user_id = c.from_user
+        ORDER BY c.rank {order}, c.created_at {order}, c.id {order}
+    """
+
+def search_window_bounds(now=None):
+    month = (now or datetime.now()).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    return [add_months(month, -months) for months in SEARCH_WINDOW_MONTHS]
+
+def encode_search_cursor(row):
+    # (ранг, микросекунды, id): ранг - float4, в callback_data хранится без потерь
+    return (row['rank'], *encode_cursor(row['created_at'], row['id']))
+
+@timed_query("search_reviews")
+async def search_reviews(to_user, search_text, cursor=None, backward=False):
+    # Как get_review_page, но по запросу и в порядке ранга среди свежих совпадений. cursor - (ранг, created_at, id)
+    limit = REVIEW_SEARCH_PAGE_SIZE
+    keyset = f"(c.rank, c.created_at, c.id) {{}} (${SEARCH_CURSOR_PARAM}::real, ${SEARCH_CURSOR_PARAM + 1}, ${SEARCH_CURSOR_PARAM + 2})"
+    if cursor is None:
+        sql, args = _review_search_sql("", "DESC"), ()
+    elif not backward:
+        sql, args = _review_search_sql(" AND " + keyset.format("<="), "DESC"), cursor
+    else:
+        sql, args = _review_search_sql(" AND " + keyset.format(">"), "ASC"), cursor
+    async with read_router.pool_for(to_user).acquire() as conn:
+        # Общий план не знает ни пользователя, ни границ окон: у "тяжелых" он перебирает
+        # все их отзывы вместо GIN и не отсекает секции. План на конкретные параметры - ~4 мс.
+        # Настройка сессии, а не транзакции: без BEGIN/COMMIT на два запроса меньше, а при
+        # возврате в пул asyncpg делает RESET ALL. На весь пул не ставится - страницы отзывов
+        # с общим планом в разы быстрее, чем с планированием по всем секциям на каждый вызов
+        await conn.execute("SET plan_cache_mode = force_custom_plan")
+        rows = await conn.fetch(sql, to_user, search_text, limit + 1, *search_window_bounds(), *args)
+    if cursor is None:
+        has_prev = False
+    elif not backward:
+        has_prev = True
+    else:
+        if len(rows) < limit:
+            return await search_reviews(to_user, search_text)
+        has_prev = len(rows) > limit
+        rows = rows[:limit]
+        rows.reverse()
+        return rows, has_prev, (cursor[0], *encode_cursor(*cursor[1:]))
+
+    next_cursor = encode_search_cursor(rows[limit]) if len(rows) > limit else None
+    return rows[:limit], has_prev, next_cursor
+
+# ==================== PROFILES ====================
+def render_profile(user, profile_link=None):
+    total = user["positive"] + user["negative"]
+    if total > 0:
+        positive_percent = (user["positive"] / total * 100)
+        negative_percent = (user["negative"] / total * 100)
+    else:
+        positive_percent = 0.0
+        negative_percent = 0.0
+
+    reg_date = user["registered"].strftime("%d %B %Y года.")
+
+    stats = f"🏆 {user['positive']} шт. · {positive_percent:.1f}% положительных · {negative_percent:.1f}% отрицательных"
+    if profile_link:
+        stats = f"<a href='{profile_link}'>{stats}</a>"
+
+    activity = ""
+    if user["last_review_at"]:
+        activity = (
+            f"📈 За {RECENT_WINDOW_DAYS} дней: +{user['recent_positive']} / -{user['recent_negative']} · "
+            f"от {user['unique_reviewers']} польз. · последний {user['last_review_at'].strftime('%d.%m.%Y')}\n"
+        )
+
+    return (
+        f"👤 @{user['username']} (ID: {user['user_id']})\n\n"
+        f"<blockquote>{stats}\n{activity}"
+        f"🛡 {user['total_deals']} шт. • {user['deal_sum']} RUB сумма сделок</blockquote>\n\n"
+        f"ВНИМАТЕЛЬНО СМОТРИТЕ ПОЛЕ «О СЕБЕ» ‼️\n\n"
+        f"💳 Депозит: отсутствует\n\n"
+        f"📆 Зарегистрирован {reg_date}"
+    )
+
+async def get_profile_text(user_id, profile_link=None, user=None):
+    # Карточка из кэша; запись из БД берется, только если ее нет в кэше и не передана
+    card = profile_cache.get(user_id)
+    if card is None:
+        if user is None:
+            user = await get_user(user_id)
+            if not user:
+                return None
+        card = {"user": user}
+        profile_cache.set(user_id, card)
+
+    key = profile_link or ""
+    text = card.get(key)
+    if text is None:
+        text = card[key] = render_profile(card["user"], profile_link)
+    return text
+
+# ==================== LEADERBOARD ====================
+LEADERBOARD_TITLES = {
+    "positive": "🏆 Топ по репутации",
+    "ratio": "⭐ Топ по доле положительных",
+    "deals": "💰 Топ по сумме сделок",
+}
+LEADERBOARD_BUTTONS = ("Репутация", "% положительных", "Сделки")
+# /топ [аргумент] в группах
+TOP_COMMAND_BOARDS = {"": "positive", "%": "ratio", "процент": "ratio", "сделки": "deals"}
+
+def render_leaderboard_row(board, place, user_id, username, positive, negative, deal_sum):
+    name = f"@{username}" if username else f"ID {user_id}"
+    if board == "positive":
+        value = f"{positive} шт."
+    elif board == "ratio":
+        value = f"{positive / (positive + negative) * 100:.1f}% из {positive + negative}"
+    else:
+        value = f"{deal_sum} RUB"
+    return f"{place}. {name} — {value}"
+
+def get_leaderboard_text(board, page, user_id):
+    # Страница рейтинга из кэша + место пользователя (бинарный поиск, без БД)
+    cached = leaderboard_cache.get((board, page))
+    if cached is None:
+        rows, pages = leaderboard.page(board, page, LEADERBOARD_PAGE_SIZE)
+        lines = [f"<b>{LEADERBOARD_TITLES[board]}</b>", ""]
+        lines += [render_leaderboard_row(board, *row) for row in rows] or ["Пока пусто"]
+        cached = ("\n".join(lines), pages)
+        leaderboard_cache.set((board, page), cached)
+    text, pages = cached
+
+    rank = leaderboard.rank(board, user_id)
+    if rank:
+        text += f"\n\nВаше место: {rank} из {len(leaderboard.rankings[board])}"
+    elif board == "ratio":
+        text += f"\n\nВ рейтинг попадают пользователи от {LEADERBOARD_MIN_REVIEWS} отзывов"
+    return text, pages
 
 # ==================== KEYBOARDS ====================
 def get_main_menu():
     keyboard = [
-        [InlineKeyboardButton("Найти пользователя", callback_data="find_user")],
-        [InlineKeyboardButton("Отправить репутацию", callback_data="send_rep")],
-        [InlineKeyboardButton("Мой профиль", callback_data="my_profile")],
+        [InlineKeyboardButton("Найти пользователя", callback_data=callbacks.FIND_USER.encode())],
+        [InlineKeyboardButton("Отправить репутацию", callback_data=callbacks.SEND_REP.encode())],
+        [InlineKeyboardButton("Мой профиль", callback_data=callbacks.MY_PROFILE.encode())],
+        [InlineKeyboardButton("🏆 Топ пользователей", callback_data=callbacks.LEADERBOARD.encode(0, 0))],
         [InlineKeyboardButton("Перейти в TESS", url=CHANNEL_LINK)]
     ]
     return InlineKeyboardMarkup(keyboard)
 
 def get_back_button():
-    return InlineKeyboardMarkup([[InlineKeyboardButton("Назад", callback_data="back_to_main")]])
+    return InlineKeyboardMarkup([[InlineKeyboardButton("Назад", callback_data=callbacks.MAIN_MENU.encode())]])
 
 def get_profile_reviews_button(user_id):
     keyboard = [
-        [InlineKeyboardButton("Отзывы", callback_data=f"profile_reviews_{user_id}")],
-        [InlineKeyboardButton("Назад", callback_data="back_to_main")]
+        [InlineKeyboardButton("Отзывы", callback_data=callbacks.REVIEW_MENU.encode(user_id))],
+        [InlineKeyboardButton("Назад", callback_data=callbacks.MAIN_MENU.encode())]
     ]
     return InlineKeyboardMarkup(keyboard)
 
+def _review_page_button(type_code, user_id, cursor=FIRST_PAGE, backward=False):
+    return callbacks.REVIEW_PAGE.encode(type_code, user_id, *cursor, backward)
+
 def get_review_menu_keyboard(user_id):
     keyboard = [
-        [InlineKeyboardButton("Положительные", callback_data=f"reviews_pos_{user_id}")],
-        [InlineKeyboardButton("Отрицательные", callback_data=f"reviews_neg_{user_id}")],
-        [InlineKeyboardButton("Все", callback_data=f"reviews_all_{user_id}")],
-        [InlineKeyboardButton("Назад", callback_data=f"back_to_profile_{user_id}")]
+        [InlineKeyboardButton("Положительные", callback_data=_review_page_button(0, user_id))],
+        [InlineKeyboardButton("Отрицательные", callback_data=_review_page_button(1, user_id))],
+        [InlineKeyboardButton("Все", callback_data=_review_page_button(2, user_id))],
+        [InlineKeyboardButton("🔍 Поиск по отзывам", callback_data=callbacks.REVIEW_SEARCH.encode(user_id))],
+        [InlineKeyboardButton("Назад", callback_data=callbacks.PROFILE.encode(user_id))]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+def get_leaderboard_keyboard(board_code, page, pages):
+    boards = [
+        InlineKeyboardButton(("• " if code == board_code else "") + label, callback_data=callbacks.LEADERBOARD.encode(code, 0))
+        for code, label in enumerate(LEADERBOARD_BUTTONS)
     ]
+    keyboard = [boards]
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("◀️", callback_data=callbacks.LEADERBOARD.encode(board_code, page - 1)))
+    if page + 1 < pages:
+        nav.append(InlineKeyboardButton("▶️", callback_data=callbacks.LEADERBOARD.encode(board_code, page + 1)))
+    if nav:
+        keyboard.append(nav)
+    keyboard.append([InlineKeyboardButton("Назад", callback_data=callbacks.MAIN_MENU.encode())])
+    return InlineKeyboardMarkup(keyboard)
+
+def get_review_search_keyboard(user_id, first_cursor=None, has_prev=False, next_cursor=None):
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton("◀️", callback_data=callbacks.REVIEW_SEARCH_PAGE.encode(user_id, *first_cursor, True)))
+    if next_cursor:
+        nav.append(InlineKeyboardButton("▶️", callback_data=callbacks.REVIEW_SEARCH_PAGE.encode(user_id, *next_cursor, False)))
+    keyboard = [nav] if nav else []
+    keyboard.append([InlineKeyboardButton("🔍 Новый поиск", callback_data=callbacks.REVIEW_SEARCH.encode(user_id))])
+    keyboard.append([InlineKeyboardButton("Назад", callback_data=callbacks.REVIEW_MENU.encode(user_id))])
     return InlineKeyboardMarkup(keyboard)
 
-def get_review_numbers_keyboard(reviews, user_id, review_type, current_index=0):
+def get_review_numbers_keyboard(page, user_id, review_type):
+    # Кнопки несут курсор страницы: FIRST_PAGE для первой, иначе ключ первого отзыва страницы
+    page_cursor = page.first_cursor if page.has_prev else FIRST_PAGE
+    type_code = REVIEW_TYPE_NAMES.index(review_type)
     keyboard = []
     row = []
     
-    for i, review in enumerate(reviews, 1):
-        btn = InlineKeyboardButton(str(i), callback_data=f"review_{review['id']}_{user_id}_{review_type}_{i-1}")
+    for i in range(1, len(page.ids) + 1):
+        btn = InlineKeyboardButton(str(i), callback_data=callbacks.REVIEW.encode(type_code, user_id, *page_cursor, i - 1))
         row.append(btn)
         
         if len(row) == 5:
@@ -157,11 +628,198 @@ def get_review_numbers_keyboard(reviews, user_id, review_type, current_index=0):
     
     if row:
         keyboard.append(row)
+
+    nav = []
+    if page.has_prev:
+        nav.append(InlineKeyboardButton("◀️", callback_data=_review_page_button(type_code, user_id, page.first_cursor, True)))
+    if page.next_cursor:
+        nav.append(InlineKeyboardButton("▶️", callback_data=_review_page_button(type_code, user_id, page.next_cursor)))
+    if nav:
+        keyboard.append(nav)
     
-    keyboard.append([InlineKeyboardButton("Назад", callback_data=f"back_to_review_menu_{user_id}")])
+    keyboard.append([InlineKeyboardButton("Назад", callback_data=callbacks.REVIEW_MENU.encode(user_id))])
     return InlineKeyboardMarkup(keyboard)
 
+def render_review(review):
+    date = review['created_at'].strftime("%d.%m.%Y %H:%M")
+    rep_text = "положительный" if review['type'] == '+' else "отрицательный"
+    return (
+        f"ID: {review['id']}\n"
+        f"От: @{review['from_username'] or 'Скрытый профиль'}\n"
+        f"Тип: {rep_text}\n"
+        f"Дата: {date}\n"
+        f"Текст: {review['message_text'] if review['message_text'] else 'Нет текста'}"
+    )
+
+def render_search_result(row):
+    snippet = html.escape(row['snippet'] or "").replace(SEARCH_MARK_START, "<b>").replace(SEARCH_MARK_STOP, "</b>")
+    sign = "👍" if row['type'] == '+' else "👎"
+    date = row['created_at'].strftime("%d.%m.%Y")
+    return f"{sign} {date} · @{row['from_username'] or 'Скрытый профиль'} · ID {row['id']}\n{snippet}"
+
+async def get_review_search_text(target_user_id, search_text, cursor=SEARCH_FIRST_PAGE, backward=False):
+    # -> (текст, клавиатура) страницы результатов поиска
+    rows, has_prev, next_cursor = await search_reviews(
+        target_user_id, search_text,
+        (cursor[0], *decode_cursor(*cursor[1:])) if cursor != SEARCH_FIRST_PAGE else None, backward=backward
+    )
+    title = f"<b>🔍 Поиск по отзывам: {html.escape(search_text)}</b>"
+    if not rows:
+        return f"{title}\n\nНичего не найдено", get_review_search_keyboard(target_user_id)
+    if rows[0]['matches'] >= REVIEW_SEARCH_CANDIDATES:
+        title += (
+            f"\n<i>Совпадений много: показаны {REVIEW_SEARCH_CANDIDATES} самых свежих. "
+            f"Уточните запрос, чтобы найти более старые отзывы</i>"
+        )
+    text = title + "\n\n" + "\n\n".join(render_search_result(row) for row in rows)
+    return text, get_review_search_keyboard(target_user_id, encode_search_cursor(rows[0]), has_prev, next_cursor)
+
+# Все исходящие вызовы идут через outbox (лимиты Telegram, RetryAfter, склейка ответов).
+# Хендлеры не ждут доставки: вызовы одного чата выполняются по порядку постановки.
+def edit_text(query, text, **kwargs):
+    return outbox.call(query.message.chat, lambda: edit_ignoring_unchanged(query.edit_message_text(text, **kwargs)))
+
+def show_review_text(query, text, reply_markup):
+    # Фото-сообщение нельзя превратить в текстовое через edit_message_text
+    if query.message.photo:
+        outbox.call(query.message.chat, query.message.delete)
+        outbox.call(query.message.chat, lambda: query.message.reply_text(text, parse_mode="HTML", reply_markup=reply_markup))
+    else:
+        edit_text(query, text, parse_mode="HTML", reply_markup=reply_markup)
+
+def show_review(query, review, reply_markup):
+    # Переход внутри одного режима (фото -> фото, текст -> текст) - правка сообщения
+    # на месте. Bot API не умеет менять текстовое сообщение на фото и обратно,
+    # поэтому только при смене режима сообщение пересоздается.
+    caption = render_review(review)
+    chat = query.message.chat
+
+    if not review['photo_id']:
+        show_review_text(query, caption, reply_markup)
+    elif not query.message.photo:
+        outbox.call(chat, query.message.delete)
+        outbox.call(chat, lambda: query.message.reply_photo(photo=review['photo_id'], caption=caption, parse_mode="HTML", reply_markup=reply_markup))
+    elif query.message.photo[-1].file_id == review['photo_id']:
+        outbox.call(chat, lambda: edit_ignoring_unchanged(query.edit_message_caption(caption=caption, parse_mode="HTML", reply_markup=reply_markup)))
+    else:
+        media = InputMediaPhoto(media=review['photo_id'], caption=caption, parse_mode="HTML")
+        outbox.call(chat, lambda: edit_ignoring_unchanged(query.edit_message_media(media=media, reply_markup=reply_markup)))
+
+async def edit_ignoring_unchanged(edit):
+    # Повторное нажатие той же кнопки - не ошибка
+    try:
+        return await edit
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+
+# ==================== FILTERS ====================
+def is_profile_command(text):
+    return text == "/и" or (text.startswith("/и ") and len(text.split()) >= 2)
+
+def is_top_command(text):
+    return text == "/топ" or text.startswith("/топ ")
+
+class RelevantMessageFilter(filters.MessageFilter):
+    # Отсекает групповые сообщения без /и, /топ и без "@упоминание +реп" до вызова
+    # handle_message: только проверки в памяти, без await и без обращений к БД
+    def __init__(self):
+        super().__init__(name="RelevantMessageFilter")
+        self.passed = 0
+        self.dropped = 0
+
+    def filter(self, message):
+        if message.chat.type == "private":
+            self.passed += 1
+            return True
+
+        text = (message.caption or message.text or "").strip()
+        if text and (is_profile_command(text) or is_top_command(text) or message_classifier.classify(text).is_rep):
+            self.passed += 1
+            return True
+
+        self.dropped += 1
+        return False
+
+relevant_messages = RelevantMessageFilter()
+
+def allow_update(user_id, chat_id):
+    # Проверяется до любых обращений к БД и Bot API; лишнее молча отбрасывается
+    now = time.monotonic()
+    if not user_limiter.allow(user_id, now):
+        return False
+    return chat_id == user_id or chat_limiter.allow(chat_id, now)
+
+def current_load(app):
+    # Доля порога перегрузки: 1.0 и больше - перегрузка
+    pending = getattr(app.update_processor, "pending", 0)
+    return max(pending / OVERLOAD_UPDATES, outbox.depth / OVERLOAD_OUTBOX)
+
+# ==================== METRICS ====================
+class InstrumentedRequest(HTTPXRequest):
+    # Время каждого вызова Bot API по методу и HTTP-статусу
+    async def do_request(self, url, method, *args, **kwargs):
+        start = time.perf_counter()
+        status = "error"
+        try:
+            status, payload = await super().do_request(url, method, *args, **kwargs)
+            return status, payload
+        finally:
+            BOT_API_SECONDS.observe(time.perf_counter() - start, method=url.rsplit("/", 1)[-1], status=status)
+
+def callback_route(update, context):
+    decoded = callbacks.decode(update.callback_query.data or "")
+    return decoded[0].name if decoded else "unknown"
+
+def message_route(update, context):
+    message = update.message
+    if message.chat.type != "private":
+        text = (message.caption or message.text or "").strip()
+        if is_profile_command(text):
+            return "group_profile"
+        return "group_top" if is_top_command(text) else "group_rep"
+    return context.user_data.get("state") or "private_other"
+
+def instrumented(name, route=None):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(update, context):
+            with Timer(HANDLER_SECONDS, HANDLER_ERRORS, handler=name, route=route(update, context) if route else name):
+                return await func(update, context)
+        return wrapper
+    return decorator
+
+def _component_stats():
+    values = {}
+    components = {
+        "user_writer": {"pending": len(user_writer.pending), "known": len(user_writer.known),
+                        "flushes": user_writer.flushes, "flushed_rows": user_writer.flushed_rows},
+        "profile_cache": {"size": len(profile_cache), "hits": profile_cache.hits, "misses": profile_cache.misses},
+        "resolver": resolver.stats(),
+        "pending_resolver": pending_resolver.stats(),
+        "review_store": review_store.stats(),
+        "outbox": outbox.stats(),
+        "stats_reconciler": stats_reconciler.stats(),
+        "leaderboard": leaderboard.stats(),
+        "partitions": partition_manager.stats(),
+        "read_router": read_router.stats(),
+        "message_filter": {"passed": relevant_messages.passed, "dropped": relevant_messages.dropped},
+        "user_limiter": user_limiter.stats(),
+        "chat_limiter": chat_limiter.stats(),
+        "load_shedder": load_shedder.stats(),
+    }
+    for pool in (db_pool, read_pool):
+        if pool is not None:
+            components[f"pool_{pool.name}"] = pool.stats()
+    for component, stats in components.items():
+        for stat, value in stats.items():
+            values[(component, stat)] = value
+    return values
+
+metrics.registry.register(Gauge("tess_component", "Состояние кэшей, очередей и пулов", _component_stats, ("component", "stat")))
+
 # ==================== HANDLERS ====================
+@instrumented("start")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.chat.type != "private":
         return
@@ -169,235 +827,183 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     username = update.effective_user.username or "no_username"
 
-    await create_user(user_id, username)
+    touch_user(user_id, username)
     
     args = context.args
     if args and args[0].startswith("reviews_"):
         target_user_id = int(args[0].replace("reviews_", ""))
         context.user_data["review_user_id"] = target_user_id
         text = "<b>🔎 Выберите раздел:</b>"
-        await update.message.reply_text(text, parse_mode="HTML", reply_markup=get_review_menu_keyboard(target_user_id))
+        outbox.reply(update.message, text, parse_mode="HTML", reply_markup=get_review_menu_keyboard(target_user_id))
         return
 
     text = "<b>TESS - твоя гарантия безопасности!</b>\n\nЗдесь ты можешь делиться репутацией и в будущем проводить сделки."
-    await update.message.reply_text(text, parse_mode="HTML", reply_markup=get_main_menu())
+    outbox.reply(update.message, text, parse_mode="HTML", reply_markup=get_main_menu())
 
+@instrumented("button_handler", callback_route)
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
+    if not allow_update(query.from_user.id, query.message.chat.id):
+        # Без ответа кнопка "крутится" у клиента, пока Telegram не сдастся
+        await query.answer("Слишком часто, подождите")
+        return
     await query.answer()
 
     if query.message.chat.type != "private":
         return
 
+    decoded = callbacks.decode(query.data or "")
+    if decoded is None:
+        return
+    route, values = decoded
+
+    # Пользователь уже записан при /start; запись нужна только маршрутам, читающим его строку
+    if route.touches_user:
+        touch_user(query.from_user.id, query.from_user.username or "no_username")
+
+    await CALLBACK_HANDLERS[route](query, context, *values)
+
+# ==================== CALLBACKS ====================
+# Маршрут кнопки (callbacks.Route) -> обработчик(query, context, *поля маршрута)
+CALLBACK_HANDLERS = {}
+
+def on_callback(route):
+    def decorator(func):
+        CALLBACK_HANDLERS[route] = func
+        return func
+    return decorator
+
+@on_callback(callbacks.MAIN_MENU)
+async def on_main_menu(query, context):
+    text = "<b>TESS - твоя гарантия безопасности!</b>\n\nЗдесь ты можешь делиться репутацией и в будущем проводить сделки."
+    edit_text(query, text, parse_mode="HTML", reply_markup=get_main_menu())
+
+@on_callback(callbacks.FIND_USER)
+async def on_find_user(query, context):
+    context.user_data["state"] = "awaiting_find_username"
+    edit_text(query, "<b>🔎 Введите username или ID пользователя, которого хотите найти</b>", parse_mode="HTML", reply_markup=get_back_button())
+
+@on_callback(callbacks.SEND_REP)
+async def on_send_rep(query, context):
+    context.user_data["state"] = "awaiting_send_rep_username"
+    edit_text(query, "<b>🔎 Введите username или ID пользователя для того, чтобы отправить ему репутацию</b>", parse_mode="HTML", reply_markup=get_back_button())
+
+@on_callback(callbacks.MY_PROFILE)
+async def on_my_profile(query, context):
     user_id = query.from_user.id
-    username = query.from_user.username or "no_username"
-    await create_user(user_id, username)
+    text = await get_profile_text(user_id)
 
-    if query.data == "back_to_main":
-        text = "<b>TESS - твоя гарантия безопасности!</b>\n\nЗдесь ты можешь делиться репутацией и в будущем проводить сделки."
-        await query.edit_message_text(text, parse_mode="HTML", reply_markup=get_main_menu())
+    if not text:
+        edit_text(query, "<b>🚫 Ошибка: профиль не найден</b>", parse_mode="HTML", reply_markup=get_back_button())
         return
 
-    if query.data.startswith("back_to_profile_"):
-        target_user_id = int(query.data.split("_")[3])
-        user = await get_user(target_user_id)
-        
-        total = user["positive"] + user["negative"]
-        if total > 0:
-            positive_percent = (user["positive"] / total * 100)
-            negative_percent = (user["negative"] / total * 100)
-        else:
-            positive_percent = 0.0
-            negative_percent = 0.0
-
-        reg_date = user["registered"].strftime("%d %B %Y года.")
-
-        text = (
-            f"👤 @{user['username']} (ID: {target_user_id})\n\n"
-            f"<blockquote>🏆 {user['positive']} шт. · {positive_percent:.1f}% положительных · {negative_percent:.1f}% отрицательных\n"
-            f"🛡 {user['total_deals']} шт. • {user['deal_sum']} RUB сумма сделок</blockquote>\n\n"
-            f"ВНИМАТЕЛЬНО СМОТРИТЕ ПОЛЕ «О СЕБЕ» ‼️\n\n"
-            f"💳 Депозит: отсутствует\n\n"
-            f"📆 Зарегистрирован {reg_date}"
-        )
-        
-        await query.edit_message_text(text, parse_mode="HTML", reply_markup=get_profile_reviews_button(target_user_id))
-        return
+    edit_text(query, text, parse_mode="HTML", reply_markup=get_profile_reviews_button(user_id))
 
-    if query.data.startswith("back_to_review_menu_"):
-        target_user_id = int(query.data.split("_")[4])
-        text = "<b>🔎 Выберите раздел:</b>"
-        if query.message.photo:
-            await query.message.delete()
-            await query.message.reply_text(text, parse_mode="HTML", reply_markup=get_review_menu_keyboard(target_user_id))
-        else:
-            await query.edit_message_text(text, parse_mode="HTML", reply_markup=get_review_menu_keyboard(target_user_id))
+@on_callback(callbacks.PROFILE)
+async def on_profile(query, context, target_user_id):
+    text = await get_profile_text(target_user_id)
+    if not text:
+        edit_text(query, "<b>🚫 Пользователь не найден</b>", parse_mode="HTML", reply_markup=get_back_button())
         return
+    edit_text(query, text, parse_mode="HTML", reply_markup=get_profile_reviews_button(target_user_id))
+
+@on_callback(callbacks.REVIEW_MENU)
+async def on_review_menu(query, context, target_user_id):
+    show_review_text(query, "<b>🔎 Выберите раздел:</b>", get_review_menu_keyboard(target_user_id))
+
+@on_callback(callbacks.REVIEW_SEARCH)
+async def on_review_search(query, context, target_user_id):
+    context.user_data["state"] = "awaiting_review_search"
+    context.user_data["search_user"] = target_user_id
+    show_review_text(
+        query,
+        "<b>🔍 Введите слова для поиска по отзывам</b>\n\nНапример: <i>скам</i>, <i>5000</i>, <i>\"аккаунт steam\" -возврат</i>",
+        InlineKeyboardMarkup([[InlineKeyboardButton("Назад", callback_data=callbacks.REVIEW_MENU.encode(target_user_id))]]),
+    )
+
+@on_callback(callbacks.REVIEW_SEARCH_PAGE)
+async def on_review_search_page(query, context, target_user_id, rank, micros, review_id, backward):
+    # Запрос живет в user_data: после нового поиска старые кнопки страниц не подходят
+    search_text = context.user_data.get("search_query")
+    if not search_text or context.user_data.get("search_user") != target_user_id:
+        await on_review_search(query, context, target_user_id)
+        return
+    text, reply_markup = await get_review_search_text(target_user_id, search_text, (rank, micros, review_id), backward)
+    show_review_text(query, text, reply_markup)
 
-    if query.data.startswith("profile_reviews_"):
-        target_user_id = int(query.data.split("_")[2])
-        text = "<b>🔎 Выберите раздел:</b>"
-        await query.edit_message_text(text, parse_mode="HTML", reply_markup=get_review_menu_keyboard(target_user_id))
+@on_callback(callbacks.REVIEW_PAGE)
+async def on_review_page(query, context, type_code, target_user_id, micros, review_id, backward):
+    if type_code >= len(REVIEW_TYPE_NAMES):
+        await on_review_menu(query, context, target_user_id)
         return
+    await show_review_page(query, REVIEW_TYPE_NAMES[type_code], target_user_id, (micros, review_id), backward=backward)
 
-    if query.data.startswith("reviews_"):
-        parts = query.data.split("_")
-        review_type = parts[1]
-        target_user_id = int(parts[2])
-        
-        async with db_pool.acquire() as conn:
-            if review_type == "pos":
-                reviews = await conn.fetch("SELECT * FROM reputation_log WHERE to_user = $1 AND type = '+' ORDER BY created_at DESC LIMIT 20", target_user_id)
-            elif review_type == "neg":
-                reviews = await conn.fetch("SELECT * FROM reputation_log WHERE to_user = $1 AND type = '-' ORDER BY created_at DESC LIMIT 20", target_user_id)
-            else:
-                reviews = await conn.fetch("SELECT * FROM reputation_log WHERE to_user = $1 ORDER BY created_at DESC LIMIT 20", target_user_id)
-        
-        if not reviews:
-            await query.edit_message_text("<b>Отзывов нет</b>", parse_mode="HTML", reply_markup=get_review_menu_keyboard(target_user_id))
-            return
-        
-        context.user_data[f"reviews_{target_user_id}"] = reviews
-        context.user_data[f"review_type_{target_user_id}"] = review_type
-        
-        first_review = reviews[0]
-        from_user = await get_user(first_review['from_user'])
-        date = first_review['created_at'].strftime("%d.%m.%Y %H:%M")
-        rep_text = "положительный" if first_review['type'] == '+' else "отрицательный"
-        
-        caption = (
-            f"ID: {first_review['id']}\n"
-            f"От: @{from_user['username'] if from_user else 'Скрытый профиль'}\n"
-            f"Тип: {rep_text}\n"
-            f"Дата: {date}\n"
-            f"Текст: {first_review['message_text'] if first_review['message_text'] else 'Нет текста'}"
-        )
-        
-        if first_review['photo_id']:
-            await query.message.delete()
-            msg = await query.message.reply_photo(
-                photo=first_review['photo_id'],
-                caption=caption,
-                parse_mode="HTML",
-                reply_markup=get_review_numbers_keyboard(reviews, target_user_id, review_type, 0)
-            )
-            context.user_data[f"review_msg_{target_user_id}"] = msg.message_id
-        else:
-            await query.edit_message_text(
-                caption,
-                parse_mode="HTML",
-                reply_markup=get_review_numbers_keyboard(reviews, target_user_id, review_type, 0)
-            )
+@on_callback(callbacks.REVIEW)
+async def on_review(query, context, type_code, target_user_id, micros, review_id, review_index):
+    if type_code >= len(REVIEW_TYPE_NAMES):
+        await on_review_menu(query, context, target_user_id)
         return
-    
-    if query.data.startswith("review_"):
-        parts = query.data.split("_")
-        review_id = int(parts[1])
-        target_user_id = int(parts[2])
-        review_type = parts[3]
-        review_index = int(parts[4])
-        
-        async with db_pool.acquire() as conn:
-            review = await conn.fetchrow("SELECT * FROM reputation_log WHERE id = $1", review_id)
-        
-        if not review:
-            await query.edit_message_text("<b>Отзыв не найден</b>", parse_mode="HTML")
+    review_type = REVIEW_TYPE_NAMES[type_code]
+    page_cursor = (micros, review_id)
+
+    # Страница уже открыта: ключ отзыва из хранилища, полная строка - одним запросом
+    page = review_store.get(query.from_user.id, (review_type, target_user_id, page_cursor))
+    if page is not None and review_index < len(page.ids):
+        created_at, review_id = decode_cursor(page.created[review_index], page.ids[review_index])
+        review = await get_review(review_id, created_at)
+        if review is not None:
+            show_review(query, review, get_review_numbers_keyboard(page, target_user_id, review_type))
             return
-        
-        reviews = context.user_data.get(f"reviews_{target_user_id}")
-        if not reviews:
-            async with db_pool.acquire() as conn:
-                if review_type == "pos":
-                    reviews = await conn.fetch("SELECT * FROM reputation_log WHERE to_user = $1 AND type = '+' ORDER BY created_at DESC LIMIT 20", target_user_id)
-                elif review_type == "neg":
-                    reviews = await conn.fetch("SELECT * FROM reputation_log WHERE to_user = $1 AND type = '-' ORDER BY created_at DESC LIMIT 20", target_user_id)
-                else:
-                    reviews = await conn.fetch("SELECT * FROM reputation_log WHERE to_user = $1 ORDER BY created_at DESC LIMIT 20", target_user_id)
-            context.user_data[f"reviews_{target_user_id}"] = reviews
-        
-        from_user = await get_user(review['from_user'])
-        date = review['created_at'].strftime("%d.%m.%Y %H:%M")
-        rep_text = "положительный" if review['type'] == '+' else "отрицательный"
-        
-        caption = (
-            f"ID: {review['id']}\n"
-            f"От: @{from_user['username'] if from_user else 'Скрытый профиль'}\n"
-            f"Тип: {rep_text}\n"
-            f"Дата: {date}\n"
-            f"Текст: {review['message_text'] if review['message_text'] else 'Нет текста'}"
-        )
-        
-        if review['photo_id']:
-            if query.message.photo:
-                await query.message.delete()
-                msg = await query.message.reply_photo(
-                    photo=review['photo_id'],
-                    caption=caption,
-                    parse_mode="HTML",
-                    reply_markup=get_review_numbers_keyboard(reviews, target_user_id, review_type, review_index)
-                )
-                context.user_data[f"review_msg_{target_user_id}"] = msg.message_id
-            else:
-                await query.message.delete()
-                msg = await query.message.reply_photo(
-                    photo=review['photo_id'],
-                    caption=caption,
-                    parse_mode="HTML",
-                    reply_markup=get_review_numbers_keyboard(reviews, target_user_id, review_type, review_index)
-                )
-                context.user_data[f"review_msg_{target_user_id}"] = msg.message_id
-        else:
-            await query.edit_message_text(
-                caption,
-                parse_mode="HTML",
-                reply_markup=get_review_numbers_keyboard(reviews, target_user_id, review_type, review_index)
-            )
-        return
-
-    if query.data == "find_user":
-        context.user_data["state"] = "awaiting_find_username"
-        await query.edit_message_text("<b>🔎 Введите username или ID пользователя, которого хотите найти</b>", parse_mode="HTML", reply_markup=get_back_button())
-
-    elif query.data == "send_rep":
-        context.user_data["state"] = "awaiting_send_rep_username"
-        await query.edit_message_text("<b>🔎 Введите username или ID пользователя для того, чтобы отправить ему репутацию</b>", parse_mode="HTML", reply_markup=get_back_button())
 
-    elif query.data == "my_profile":
-        user_id = query.from_user.id
-        user = await get_user(user_id)
-
-        if not user:
-            await query.edit_message_text("<b>🚫 Ошибка: профиль не найден</b>", parse_mode="HTML", reply_markup=get_back_button())
-            return
+    await show_review_page(query, review_type, target_user_id, page_cursor, review_index)
+
+@on_callback(callbacks.LEADERBOARD)
+async def on_leaderboard(query, context, board_code, page):
+    if board_code >= len(BOARDS):
+        board_code = 0
+    text, pages = get_leaderboard_text(BOARDS[board_code], page, query.from_user.id)
+    if page >= pages:
+        # Рейтинг стал короче, чем страница из кнопки
+        page = pages - 1
+        text, pages = get_leaderboard_text(BOARDS[board_code], page, query.from_user.id)
+    edit_text(query, text, parse_mode="HTML", reply_markup=get_leaderboard_keyboard(board_code, page, pages))
+
+async def show_review_page(query, review_type, target_user_id, cursor, review_index=0, backward=False):
+    # cursor - FIRST_PAGE или ключ отзыва, с которого начинается страница (backward - перед которым)
+    rows, has_prev, next_cursor = await get_review_page(
+        target_user_id, review_type, decode_cursor(*cursor) if cursor != FIRST_PAGE else None, backward=backward
+    )
+
+    if not rows:
+        show_review_text(query, "<b>Отзывов нет</b>", get_review_menu_keyboard(target_user_id))
+        return
 
-        total = user["positive"] + user["negative"]
-        if total > 0:
-            positive_percent = (user["positive"] / total * 100)
-            negative_percent = (user["negative"] / total * 100)
-        else:
-            positive_percent = 0.0
-            negative_percent = 0.0
-
-        reg_date = user["registered"].strftime("%d %B %Y года.")
-
-        text = (
-            f"👤 @{user['username']} (ID: {user_id})\n\n"
-            f"<blockquote>🏆 {user['positive']} шт. · {positive_percent:.1f}% положительных · {negative_percent:.1f}% отрицательных\n"
-            f"🛡 {user['total_deals']} шт. • {user['deal_sum']} RUB сумма сделок</blockquote>\n\n"
-            f"ВНИМАТЕЛЬНО СМОТРИТЕ ПОЛЕ «О СЕБЕ» ‼️\n\n"
-            f"💳 Депозит: отсутствует\n\n"
-            f"📆 Зарегистрирован {reg_date}"
-        )
+    if review_index >= len(rows):
+        show_review_text(query, "<b>Отзыв не найден</b>", get_review_menu_keyboard(target_user_id))
+        return
 
-        await query.edit_message_text(text, parse_mode="HTML", reply_markup=get_profile_reviews_button(user_id))
+    first_cursor = encode_cursor(rows[0]['created_at'], rows[0]['id'])
+    page = review_store.put(
+        query.from_user.id, (review_type, target_user_id, first_cursor if has_prev else FIRST_PAGE),
+        [row['id'] for row in rows], [encode_cursor(row['created_at'], row['id'])[0] for row in rows],
+        first_cursor, has_prev, next_cursor
+    )
+    show_review(query, rows[review_index], get_review_numbers_keyboard(page, target_user_id, review_type))
 
+@instrumented("handle_message", message_route)
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     username = update.effective_user.username or "no_username"
     state = context.user_data.get("state")
     chat_type = update.message.chat.type
 
-    await create_user(user_id, username)
+    if not allow_update(user_id, update.message.chat.id):
+        if REP_PATTERN.search(update.message.text or update.message.caption or ""):
+            REP_DROPPED.inc(reason="rate_limited")
+        return
+    overloaded = load_shedder.overloaded
+
+    touch_user(user_id, username)
 
     text = ""
     if update.message.text:
@@ -405,62 +1011,52 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.caption:
         text = update.message.caption.strip()
 
+    # ===== /топ (ТОЛЬКО ГРУППЫ) =====
+    if chat_type != "private" and text and is_top_command(text):
+        board = TOP_COMMAND_BOARDS.get(text[len("/топ"):].strip().lower())
+        if board is None or overloaded:
+            return
+        top_text, _ = get_leaderboard_text(board, 0, user_id)
+        outbox.reply(update.message, top_text, parse_mode="HTML")
+        return
+
     # ===== ЭМУЛЯЦИЯ /и (ТОЛЬКО ГРУППЫ) =====
-    if chat_type != "private" and text and (text.strip() == "/и" or (text.startswith("/и ") and len(text.split()) >= 2)):
+    if chat_type != "private" and text and is_profile_command(text):
         parts = text.split()
+        user_data = None
 
         if update.message.reply_to_message:
             target_user = update.message.reply_to_message.from_user
             target_id = target_user.id
             target_username = target_user.username or f"id{target_id}"
             await create_user(target_id, target_username)
-            user_data = await get_user(target_id)
 
         elif len(parts) > 1:
             target = parts[1].lower().replace("@", "")
 
-            async with db_pool.acquire() as conn:
-                if target.isdigit():
-                    user_data = await conn.fetchrow("SELECT * FROM users WHERE user_id = $1", int(target))
-                else:
-                    user_data = await get_user_by_username(target, context)
-
-            if not user_data:
-                await update.message.reply_text("<b>🚫 Пользователь не найден</b>", parse_mode="HTML")
-                return
+            if target.isdigit():
+                target_id = int(target)
+            else:
+                user_data = await get_user_by_username(target, context)
+                target_id = user_data['user_id'] if user_data else None
 
         elif text.strip() == "/и":
-            user_data = await get_user(user_id)
+            target_id = user_id
         else:
             return
 
-        if user_data:
-            total = user_data["positive"] + user_data["negative"]
-            if total > 0:
-                positive_percent = (user_data["positive"] / total * 100)
-                negative_percent = (user_data["negative"] / total * 100)
-            else:
-                positive_percent = 0.0
-                negative_percent = 0.0
-
-            reg_date = user_data["registered"].strftime("%d %B %Y года.")
-            
-            bot_username = (await context.bot.get_me()).username
-            profile_link = f"https://t.me/{bot_username}?start=reviews_{user_data['user_id']}"
-
-            profile_text = (
-                f"👤 @{user_data['username']} (ID: {user_data['user_id']})\n\n"
-                f"<blockquote><a href='{profile_link}'>🏆 {user_data['positive']} шт. · {positive_percent:.1f}% положительных · {negative_percent:.1f}% отрицательных</a>\n"
-                f"🛡 {user_data['total_deals']} шт. • {user_data['deal_sum']} RUB сумма сделок</blockquote>\n\n"
-                f"ВНИМАТЕЛЬНО СМОТРИТЕ ПОЛЕ «О СЕБЕ» ‼️\n\n"
-                f"💳 Депозит: отсутствует\n\n"
-                f"📆 Зарегистрирован {reg_date}"
-            )
-
-            keyboard = [[InlineKeyboardButton("Приобрести префикс", url="https://t.me/prade147")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text(profile_text, parse_mode="HTML", reply_markup=reply_markup)
+        bot_username = await resolver.bot_username(context.bot)
+        profile_link = f"https://t.me/{bot_username}?start=reviews_{target_id}"
+        profile_text = await get_profile_text(target_id, profile_link, user_data) if target_id is not None else None
+
+        if not profile_text:
+            if len(parts) > 1 and not update.message.reply_to_message:
+                outbox.reply(update.message, "<b>🚫 Пользователь не найден</b>", parse_mode="HTML")
+            return
 
+        keyboard = [[InlineKeyboardButton("Приобрести префикс", url="https://t.me/prade147")]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        outbox.reply(update.message, profile_text, parse_mode="HTML", reply_markup=reply_markup)
         return
 
     # ===== ЛИЧКА =====
@@ -470,34 +1066,31 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 target = text.lower().replace("@", "")
 
                 if target.isdigit():
-                    user = await get_user(int(target))
+                    target_id = int(target)
+                    profile_text = await get_profile_text(target_id)
                 else:
                     user = await get_user_by_username(target, context)
+                    target_id = user['user_id'] if user else None
+                    profile_text = await get_profile_text(target_id, user=user) if user else None
 
-                if user:
-                    total = user["positive"] + user["negative"]
-                    if total > 0:
-                        positive_percent = (user["positive"] / total * 100)
-                        negative_percent = (user["negative"] / total * 100)
-                    else:
-                        positive_percent = 0.0
-                        negative_percent = 0.0
-                    reg_date = user["registered"].strftime("%d %B %Y года.")
-
-                    profile_text = (
-                        f"👤 @{user['username']} (ID: {user['user_id']})\n\n"
-                        f"<blockquote>🏆 {user['positive']} шт. · {positive_percent:.1f}% положительных · {negative_percent:.1f}% отрицательных\n"
-                        f"🛡 {user['total_deals']} шт. • {user['deal_sum']} RUB сумма сделок</blockquote>\n\n"
-                        f"ВНИМАТЕЛЬНО СМОТРИТЕ ПОЛЕ «О СЕБЕ» ‼️\n\n"
-                        f"💳 Депозит: отсутствует\n\n"
-                        f"📆 Зарегистрирован {reg_date}"
-                    )
-                    await update.message.reply_text(profile_text, parse_mode="HTML", reply_markup=get_profile_reviews_button(user['user_id']))
+                if profile_text:
+                    outbox.reply(update.message, profile_text, parse_mode="HTML", reply_markup=get_profile_reviews_button(target_id))
                 else:
-                    await update.message.reply_text("<b>🚫 Пользователь не найден</b>", parse_mode="HTML", reply_markup=get_back_button())
+                    outbox.reply(update.message, "<b>🚫 Пользователь не найден</b>", parse_mode="HTML", reply_markup=get_back_button())
 
                 context.user_data["state"] = None
 
+            elif state == "awaiting_review_search":
+                target_user_id = context.user_data.get("search_user")
+                search_text = text[:REVIEW_SEARCH_MAX_QUERY]
+                context.user_data["state"] = None
+                if target_user_id:
+                    context.user_data["search_query"] = search_text
+                    result_text, reply_markup = await get_review_search_text(target_user_id, search_text)
+                    outbox.reply(update.message, result_text, parse_mode="HTML", reply_markup=reply_markup)
+                else:
+                    outbox.reply(update.message, "<b>🚫 Поиск устарел, откройте отзывы заново</b>", parse_mode="HTML", reply_markup=get_back_button())
+
             elif state == "awaiting_send_rep_username":
                 target = text.lower().replace("@", "")
 
@@ -511,145 +1104,216 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     context.user_data["target_user"] = user['user_id']
                     context.user_data["target_username"] = user['username']
                     context.user_data["state"] = "awaiting_rep_text"
-                    await update.message.reply_text(
+                    outbox.reply(
+                        update.message,
                         f"✅ Пользователь @{user['username']} выбран. Теперь отправьте сообщение с +реп или -реп",
                         parse_mode="HTML",
                         reply_markup=get_back_button()
                     )
                 else:
-                    await update.message.reply_text("<b>🚫 Пользователь не найден</b>", parse_mode="HTML", reply_markup=get_back_button())
+                    outbox.reply(update.message, "<b>🚫 Пользователь не найден</b>", parse_mode="HTML", reply_markup=get_back_button())
                     context.user_data["state"] = None
 
             elif state == "awaiting_rep_text":
                 target_user_id = context.user_data.get("target_user")
-                target_username = context.user_data.get("target_username")
 
                 if not target_user_id:
-                    await update.message.reply_text("<b>🚫 Ошибка: выберите пользователя сначала</b>", parse_mode="HTML", reply_markup=get_back_button())
+                    outbox.reply(update.message, "<b>🚫 Ошибка: выберите пользователя сначала</b>", parse_mode="HTML", reply_markup=get_back_button())
                     context.user_data["state"] = None
                     return
 
-                rep_pattern = r'[\+\-]\s*[РрRr][ЕеEe][ПпPp]\b'
-                has_rep = re.search(rep_pattern, text)
+                # Как "+реп" в группах: под перегрузкой разбор и запись откладываются
+                if overloaded:
+                    if not load_shedder.defer(functools.partial(process_direct_rep, update, context, text, target_user_id)):
+                        REP_DROPPED.inc(reason="overflow")
+                else:
+                    await process_direct_rep(update, context, text, target_user_id)
 
-                if not has_rep:
-                    await update.message.reply_text("<b>🚫 В сообщении должен быть +реп или -реп</b>", parse_mode="HTML", reply_markup=get_back_button())
-                    return
+    # ===== ПАРСИНГ РЕПУТАЦИИ С ЗАЩИТОЙ ОТ РЕКЛАМЫ =====
+    if text:
+        # ===== АНТИСПАМ: упоминания, +реп и проверка на рекламу за один проход =====
+        result = message_classifier.classify(text)
 
-                if not update.message.photo:
-                    await update.message.reply_text(
-                        "<b>🚫 Прикрепите фото</b>",
-                        parse_mode="HTML"
-                    )
-                    return
+        if result.is_rep and state != "awaiting_rep_text":
+            if overloaded:
+                if not load_shedder.defer(functools.partial(process_rep_message, update, context, text, result)):
+                    REP_DROPPED.inc(reason="overflow")
+            else:
+                await process_rep_message(update, context, text, result)
 
-                rep_type = '+' if '+' in has_rep.group() else '-'
-                photo_id = update.message.photo[-1].file_id if update.message.photo else None
+async def process_direct_rep(update, context, text, target_user_id):
+    # Отзыв из лички на пользователя, выбранного в "Отправить репутацию"; под перегрузкой
+    # вызывается позже из load_shedder - если выбор к тому времени сменился или отзыв
+    # уже сохранен, сообщение устарело
+    if context.user_data.get("state") != "awaiting_rep_text" or context.user_data.get("target_user") != target_user_id:
+        return
+    user_id = update.effective_user.id
 
-                if target_user_id != user_id:
-                    await update_reputation(target_user_id, user_id, rep_type, text, photo_id)
-                    await update.message.reply_text(
-                        "<b>✅ Репутация сохранена</b>",
-                        parse_mode="HTML"
-                    )
-                else:
-                    await update.message.reply_text(
-                        "<b>🚫 Нельзя отправить репутацию самому себе</b>",
-                        parse_mode="HTML"
-                    )
+    has_rep = REP_PATTERN.search(text)
 
-                context.user_data.pop("target_user", None)
-                context.user_data.pop("target_username", None)
-                context.user_data["state"] = None
+    if not has_rep:
+        outbox.reply(update.message, "<b>🚫 В сообщении должен быть +реп или -реп</b>", parse_mode="HTML", reply_markup=get_back_button())
+        return
 
-    # ===== ПАРСИНГ РЕПУТАЦИИ С ЗАЩИТОЙ ОТ РЕКЛАМЫ =====
-    if text:
-        mention_pattern = r'@(\w+)|(\b\d{5,}\b)'
-        rep_pattern = r'[\+\-]\s*[РрRr][ЕеEe][ПпPp]\b'
-        
-        mentions = re.findall(mention_pattern, text)
-        has_rep = re.search(rep_pattern, text)
-        
-        # ===== АНТИСПАМ: проверка на рекламу =====
-        ad_keywords = ['купить', 'продаю', 'цены', 'оплата', 'баланс', 'карты', 'услуги', 'скам', 'принимаю', 'пушкинские']
-        self_promo = ['у меня', 'моя', 'мои', 'моё', 'на мне', 'с меня']
-        
-        is_ad = False
-        lower_text = text.lower()
-        
-        for keyword in ad_keywords:
-            if keyword in lower_text:
-                is_ad = True
-                break
-                
-        for promo in self_promo:
-            if promo in lower_text:
-                is_ad = True
-                break
-        
-        # Проверка на цифры перед +реп (500+реп)
-        if re.search(r'\d+\s*[\+\-]\s*[рp][еe][пp]', lower_text):
-            is_ad = True
-
-        if mentions and has_rep and state != "awaiting_rep_text" and not is_ad:
-            if not update.message.photo:
-                await update.message.reply_text(
-                    "<b>🚫 Прикрепите фото</b>",
-                    parse_mode="HTML"
-                )
-                return
-
-            rep_type = '+' if '+' in has_rep.group() else '-'
-            photo_id = update.message.photo[-1].file_id if update.message.photo else None
-
-            # Определяем настоящего отправителя
-            if update.message.forward_from:
-                from_user_id = update.message.forward_from.id
-                from_username = update.message.forward_from.username or "Скрытый профиль"
-                await create_user(from_user_id, from_username)
-            else:
-                from_user_id = 0
-                from_username = "Скрытый профиль"
+    if not update.message.photo:
+        outbox.reply(
+            update.message,
+            "<b>🚫 Прикрепите фото</b>",
+            parse_mode="HTML"
+        )
+        return
 
-            for mention in mentions:
-                target_username = mention[0] or mention[1]
+    rep_type = '+' if '+' in has_rep.group() else '-'
+    photo_id = update.message.photo[-1].file_id if update.message.photo else None
 
-                async with db_pool.acquire() as conn:
-                    if str(target_username).isdigit():
-                        target_user = await conn.fetchrow("SELECT * FROM users WHERE user_id = $1", int(target_username))
-                    else:
-                        target_user = await get_user_by_username(target_username, context)
+    if target_user_id != user_id:
+        await update_reputation(target_user_id, user_id, rep_type, text, photo_id)
+        outbox.reply(
+            update.message,
+            "<b>✅ Репутация сохранена</b>",
+            parse_mode="HTML"
+        )
+    else:
+        outbox.reply(
+            update.message,
+            "<b>🚫 Нельзя отправить репутацию самому себе</b>",
+            parse_mode="HTML"
+        )
 
-                if not target_user:
-                    await update.message.reply_text("<b>🚫 Пользователь не найден</b>", parse_mode="HTML")
-                    continue
+    context.user_data.pop("target_user", None)
+    context.user_data.pop("target_username", None)
+    context.user_data["state"] = None
+
+async def process_rep_message(update, context, text, result):
+    # "@упоминание +реп" из группы или лички; под перегрузкой вызывается позже из load_shedder
+    if not update.message.photo:
+        outbox.reply(
+            update.message,
+            "<b>🚫 Прикрепите фото</b>",
+            parse_mode="HTML"
+        )
+        return
 
-                await create_user(target_user['user_id'], target_user['username'])
+    rep_type = result.rep_sign
+    photo_id = update.message.photo[-1].file_id if update.message.photo else None
+
+    # Определяем настоящего отправителя
+    if update.message.forward_from:
+        from_user_id = update.message.forward_from.id
+        from_username = update.message.forward_from.username or "Скрытый профиль"
+        touch_user(from_user_id, from_username)
+    else:
+        from_user_id = 0
+        from_username = "Скрытый профиль"
+
+    targets = list(dict.fromkeys(result.mentions))
+    resolved = await resolve_mentions(targets)
+
+    saved, not_found, pending, to_users = [], [], [], []
+    self_rep = False
+    for target in targets:
+        target_user = resolved[target]
+        if not target_user:
+            # Незнакомый username ищем в фоне, если Telegram его уже не отверг
+            if target.isdigit() or target.lower() in resolver.negative:
+                not_found.append(target)
+            elif target.lower() not in (name.lower() for name in pending):
+                pending.append(target)
+        elif target_user['user_id'] == from_user_id:
+            self_rep = True
+        elif target_user['user_id'] not in to_users:
+            to_users.append(target_user['user_id'])
+            saved.append(target_user['username'] or target)
+
+    if to_users:
+        await update_reputation_many(to_users, from_user_id, rep_type, text, photo_id)
+    if pending:
+        await pending_resolver.add(
+            pending, from_user_id, rep_type, text, photo_id, update.message.chat, update.message.message_id
+        )
 
-                if target_user['user_id'] != from_user_id:
-                    await update_reputation(target_user['user_id'], from_user_id, rep_type, text, photo_id)
-                    await update.message.reply_text(
-                        "<b>✅ Репутация сохранена</b>",
-                        parse_mode="HTML"
-                    )
-                else:
-                    await update.message.reply_text(
-                        "<b>🚫 Нельзя отправить репутацию самому себе</b>",
-                        parse_mode="HTML"
-                    )
+    # Один ответ на сообщение вместо ответа на каждое упоминание
+    lines = []
+    if saved:
+        if len(targets) == 1:
+            lines.append("<b>✅ Репутация сохранена</b>")
+        else:
+            lines.append("<b>✅ Репутация сохранена:</b> " + ", ".join(f"@{name}" for name in saved))
+    if pending:
+        if len(targets) == 1:
+            lines.append("<b>⏳ Ищем пользователя, репутация сохранится после проверки</b>")
+        else:
+            lines.append("<b>⏳ Ищем, репутация сохранится после проверки:</b> " + ", ".join(f"@{name}" for name in pending))
+    if not_found:
+        if len(targets) == 1:
+            lines.append("<b>🚫 Пользователь не найден</b>")
+        else:
+            lines.append("<b>🚫 Пользователь не найден:</b> " + ", ".join(f"@{name}" for name in not_found))
+    if self_rep:
+        lines.append("<b>🚫 Нельзя отправить репутацию самому себе</b>")
+    outbox.reply(update.message, "\n".join(lines), parse_mode="HTML")
+
+def register_handlers(app):
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CallbackQueryHandler(button_handler))
+    app.add_handler(MessageHandler((filters.TEXT | filters.PHOTO) & ~filters.COMMAND & relevant_messages, handle_message))
 
 async def post_init(app):
     await init_db_pool()
+    user_writer.start(db_pool)
+    stats_reconciler.start(db_pool, _on_stats_fixed)
+    load_shedder.start(functools.partial(current_load, app))
+    partition_manager.start(db_pool)
+    pending_resolver.start(
+        db_pool, functools.partial(resolve_pending_username, app.bot), functools.partial(_on_pending_done, app.bot)
+    )
+    await leaderboard.start(db_pool)
+    metrics.slow_query_threshold = SLOW_QUERY_MS / 1000
+    if METRICS_PORT:
+        await metrics.start_http_server(METRICS_PORT, METRICS_HOST)
+        print(f"📈 Метрики: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
     print("✅ Бот запущен, пул соединений готов")
 
-def main():
-    app = Application.builder().token(TOKEN).post_init(post_init).build()
+async def post_shutdown(app):
+    print(f"Групповых сообщений отфильтровано: {relevant_messages.dropped}, обработано: {relevant_messages.passed}")
+    print(f"Хранилище страниц отзывов: {review_store.memory_usage()} байт")
+    await load_shedder.stop()
+    await pending_resolver.stop()
+    await outbox.drain()
+    await stats_reconciler.stop()
+    await partition_manager.stop()
+    await leaderboard.stop()
+    await user_writer.stop()
+    if db_pool is not None:
+        await db_pool.close()
+    if read_pool is not None:
+        await read_pool.close()
 
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CallbackQueryHandler(button_handler))
-    app.add_handler(MessageHandler((filters.TEXT | filters.PHOTO) & ~filters.COMMAND, handle_message))
-
-    app.run_polling()
+def main():
+    app = (
+        Application.builder()
+        .token(TOKEN)
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .concurrent_updates(PerChatUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        # Пул создается при загрузке состояния, т.е. еще до post_init
+        .persistence(PostgresPersistence(init_db_pool, STATE_FLUSH_INTERVAL, STATE_TTL))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+
+    register_handlers(app)
+
+    if WEBHOOK_URL:
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        app.run_polling()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,247 @@
+import asyncio
+import functools
+import logging
+import time
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.label_names, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        # ключ меток -> [счетчики по корзинам..., +Inf, сумма]
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        series = self._values.get(key)
+        if series is None:
+            series = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def counts(self):
+        # {(значения меток): число наблюдений}
+        return {key: sum(series[:-1]) for key, series in self._values.items()}
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, series in self._values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, ('le', bound))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {series[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+
+class Gauge:
+    # Значение снимается в момент запроса /metrics: collect() -> {(значения меток): число}
+    def __init__(self, name, help_text, collect, labels=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self.collect = collect
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for key, value in self.collect().items():
+            lines.append(f"{self.name}{_format_labels(self.label_names, key)} {value}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def expose(self):
+        lines = []
+        for metric in self.metrics:
+            try:
+                lines.extend(metric.expose())
+            except Exception:
+                logger.exception("Не удалось собрать метрику %s", metric.name)
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+HANDLER_SECONDS = registry.register(Histogram(
+    "tess_handler_seconds", "Время обработки апдейта", ("handler", "route")))
+HANDLER_ERRORS = registry.register(Counter(
+    "tess_handler_errors_total", "Исключения в хендлерах", ("handler", "route")))
+DB_QUERY_SECONDS = registry.register(Histogram(
+    "tess_db_query_seconds", "Время запросов к БД (вместе с ожиданием соединения)", ("query",)))
+DB_STATEMENT_SECONDS = registry.register(Histogram(
+    "tess_db_statement_seconds", "Выполнение подготовленных запросов queries.py (без ожидания соединения)", ("statement",)))
+DB_ACQUIRE_SECONDS = registry.register(Histogram(
+    "tess_db_pool_acquire_seconds", "Ожидание свободного соединения в пуле", ("pool",)))
+REP_DROPPED = registry.register(Counter(
+    "tess_rep_dropped_total", "Сообщения «+реп», отброшенные лимитом частоты или переполнением очереди", ("reason",)))
+BOT_API_SECONDS = registry.register(Histogram(
+    "tess_bot_api_seconds", "Время вызовов Bot API", ("method", "status")))
+USER_API_LOOKUP_SECONDS = registry.register(Histogram(
+    "tess_user_api_lookup_seconds", "Поиск пользователя через Telegram API: get_chat и запись найденного в БД"))
+
+# Порог журнала медленных запросов, секунды
+slow_query_threshold = 0.1
+
+
+class Timer:
+    # with Timer(HANDLER_SECONDS, HANDLER_ERRORS, handler=..., route=...): ...
+    __slots__ = ("histogram", "labels", "start", "errors")
+
+    def __init__(self, histogram, errors=None, **labels):
+        self.histogram = histogram
+        self.errors = errors
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        if exc_type is not None and self.errors is not None and not issubclass(exc_type, asyncio.CancelledError):
+            self.errors.inc(**self.labels)
+        return False
+
+
+def _describe_args(args):
+    # Только типы и размеры списков: значения (текст отзыва, photo_id) в журнал не попадают
+    return ", ".join(
+        f"{type(arg).__name__}[{len(arg)}]" if isinstance(arg, (list, tuple, set, dict)) else type(arg).__name__
+        for arg in args
+    )
+
+
+def timed_query(name):
+    # Декоратор для DB-хелперов: гистограмма + журнал медленных вызовов
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                DB_QUERY_SECONDS.observe(elapsed, query=name)
+                if elapsed >= slow_query_threshold:
+                    logger.warning("Медленный запрос %s: %.0f мс, аргументы (%s)", name, elapsed * 1000, _describe_args(args))
+        return wrapper
+    return decorator
+
+
+class _TimedAcquire:
+    __slots__ = ("_ctx", "_pool")
+
+    def __init__(self, ctx, pool):
+        self._ctx = ctx
+        self._pool = pool
+
+    async def __aenter__(self):
+        start = time.perf_counter()
+        self._pool.waiting += 1
+        try:
+            conn = await self._ctx.__aenter__()
+        finally:
+            self._pool.waiting -= 1
+        DB_ACQUIRE_SECONDS.observe(time.perf_counter() - start, pool=self._pool.name)
+        return conn
+
+    async def __aexit__(self, *exc):
+        return await self._ctx.__aexit__(*exc)
+
+
+class TimedPool:
+    # Обертка asyncpg-пула: измеряет ожидание в acquire(), остальное - как у пула
+    def __init__(self, pool, name="primary"):
+        self._pool = pool
+        self.name = name
+        # Сколько корутин сейчас ждут соединение
+        self.waiting = 0
+
+    def acquire(self, **kwargs):
+        return _TimedAcquire(self._pool.acquire(**kwargs), self)
+
+    def stats(self):
+        # Насыщение пула: занято size - idle из max, waiting ждут в очереди
+        return {
+            "size": self._pool.get_size(),
+            "idle": self._pool.get_idle_size(),
+            "max": self._pool.get_max_size(),
+            "waiting": self.waiting,
+        }
+
+    def __getattr__(self, item):
+        return getattr(self._pool, item)
+
+
+async def _handle_http(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", registry.expose().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception:
+        logger.exception("Ошибка при отдаче метрик")
+    finally:
+        writer.close()
+
+
+async def start_http_server(port, host="127.0.0.1"):
+    # GET /metrics в текстовом формате Prometheus
+    return await asyncio.start_server(_handle_http, host, port)
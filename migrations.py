@@ -0,0 +1,362 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Произвольный ключ advisory-lock, чтобы несколько воркеров не мигрировали одновременно
+MIGRATION_LOCK_ID = 7419203841
+
+# Диапазон ID, который раньше вычищался при каждом старте
+INVALID_USER_ID_SQL = "{col} > 9000000000 OR ({col} < 1000000000 AND {col} > 0)"
+
+
+# Окно "недавних" отзывов в user_stats (recent_positive/recent_negative)
+RECENT_WINDOW_DAYS = 30
+RECENT_WINDOW_SQL = f"INTERVAL '{RECENT_WINDOW_DAYS} days'"
+
+# Поиск по тексту отзывов: конфигурация и выражение колонки reputation_log.search
+REVIEW_SEARCH_CONFIG = "russian"
+REVIEW_SEARCH_TSVECTOR = f"to_tsvector('{REVIEW_SEARCH_CONFIG}', COALESCE(message_text, ''))"
+
+
+def is_valid_user_id(user_id):
+    return not (user_id > 9000000000 or 0 < user_id < 1000000000)
+
+
+# (версия, название, SQL). Уже применённые версии никогда не меняются -
+# новые изменения схемы добавляются только в конец списка.
+MIGRATIONS = [
+    (1, "initial schema", """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            registered TIMESTAMP DEFAULT NOW(),
+            positive INT DEFAULT 0,
+            negative INT DEFAULT 0,
+            total_deals INT DEFAULT 0,
+            deal_sum BIGINT DEFAULT 0,
+            bio TEXT DEFAULT ''
+        );
+
+        CREATE TABLE IF NOT EXISTS reputation_log (
+            id SERIAL PRIMARY KEY,
+            from_user BIGINT,
+            to_user BIGINT,
+            type TEXT CHECK (type IN ('+', '-')),
+            message_text TEXT,
+            photo_id TEXT,
+            created_at TIMESTAMP DEFAULT NOW()
+        );
+    """),
+    (2, "purge invalid user ids", f"""
+        DELETE FROM users WHERE {INVALID_USER_ID_SQL.format(col="user_id")};
+        DELETE FROM reputation_log WHERE {INVALID_USER_ID_SQL.format(col="from_user")};
+        DELETE FROM reputation_log WHERE {INVALID_USER_ID_SQL.format(col="to_user")};
+    """),
+    (3, "non-negative reputation counters", """
+        UPDATE users SET positive = 0 WHERE positive < 0;
+        UPDATE users SET negative = 0 WHERE negative < 0;
+        ALTER TABLE users ADD CONSTRAINT users_positive_non_negative CHECK (positive >= 0);
+        ALTER TABLE users ADD CONSTRAINT users_negative_non_negative CHECK (negative >= 0);
+    """),
+    (4, "review and username indexes", """
+        CREATE INDEX IF NOT EXISTS reputation_log_to_user_type_created_idx
+            ON reputation_log (to_user, type, created_at DESC);
+        CREATE INDEX IF NOT EXISTS reputation_log_to_user_created_idx
+            ON reputation_log (to_user, created_at DESC);
+        CREATE INDEX IF NOT EXISTS users_username_lower_idx
+            ON users (lower(username));
+    """),
+    (5, "keyset review pagination indexes", """
+        CREATE INDEX IF NOT EXISTS reputation_log_to_user_type_created_id_idx
+            ON reputation_log (to_user, type, created_at DESC, id DESC);
+        CREATE INDEX IF NOT EXISTS reputation_log_to_user_created_id_idx
+            ON reputation_log (to_user, created_at DESC, id DESC);
+        DROP INDEX IF EXISTS reputation_log_to_user_type_created_idx;
+        DROP INDEX IF EXISTS reputation_log_to_user_created_idx;
+    """),
+    (6, "conversation state persistence", """
+        CREATE TABLE IF NOT EXISTS user_state (
+            user_id BIGINT PRIMARY KEY,
+            data JSONB NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+        );
+        CREATE INDEX IF NOT EXISTS user_state_updated_at_idx ON user_state (updated_at);
+    """),
+    (7, "incremental user stats", f"""
+        -- Пока считаем начальные значения, новые отзывы не пишутся
+        LOCK TABLE reputation_log IN SHARE ROW EXCLUSIVE MODE;
+
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id BIGINT PRIMARY KEY,
+            positive INT NOT NULL DEFAULT 0 CHECK (positive >= 0),
+            negative INT NOT NULL DEFAULT 0 CHECK (negative >= 0),
+            unique_reviewers INT NOT NULL DEFAULT 0 CHECK (unique_reviewers >= 0),
+            recent_positive INT NOT NULL DEFAULT 0 CHECK (recent_positive >= 0),
+            recent_negative INT NOT NULL DEFAULT 0 CHECK (recent_negative >= 0),
+            last_review_at TIMESTAMP,
+            reconciled_at TIMESTAMP
+        );
+
+        -- Сколько отзывов from_user оставил to_user: нужно для unique_reviewers при удалениях
+        CREATE TABLE IF NOT EXISTS reviewer_pairs (
+            to_user BIGINT NOT NULL,
+            from_user BIGINT NOT NULL,
+            reviews INT NOT NULL,
+            PRIMARY KEY (to_user, from_user)
+        );
+
+        INSERT INTO reviewer_pairs (to_user, from_user, reviews)
+        SELECT to_user, COALESCE(from_user, 0), COUNT(*)
+        FROM reputation_log
+        GROUP BY to_user, COALESCE(from_user, 0);
+
+        INSERT INTO user_stats (user_id, positive, negative, unique_reviewers,
+                                recent_positive, recent_negative, last_review_at, reconciled_at)
+        SELECT to_user,
+               COUNT(*) FILTER (WHERE type = '+'),
+               COUNT(*) FILTER (WHERE type = '-'),
+               COUNT(DISTINCT COALESCE(from_user, 0)),
+               COUNT(*) FILTER (WHERE type = '+' AND created_at > NOW() - {RECENT_WINDOW_SQL}),
+               COUNT(*) FILTER (WHERE type = '-' AND created_at > NOW() - {RECENT_WINDOW_SQL}),
+               MAX(created_at),
+               NOW()
+        FROM reputation_log
+        GROUP BY to_user;
+
+        CREATE OR REPLACE FUNCTION user_stats_on_review() RETURNS trigger AS $$
+        DECLARE
+            recent BOOLEAN;
+            pair_reviews INT;
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                recent := NEW.created_at > NOW() - {RECENT_WINDOW_SQL};
+                INSERT INTO reviewer_pairs AS p (to_user, from_user, reviews)
+                VALUES (NEW.to_user, COALESCE(NEW.from_user, 0), 1)
+                ON CONFLICT (to_user, from_user) DO UPDATE SET reviews = p.reviews + 1
+                RETURNING p.reviews INTO pair_reviews;
+
+                INSERT INTO user_stats AS s (user_id, positive, negative, unique_reviewers,
+                                             recent_positive, recent_negative, last_review_at)
+                VALUES (NEW.to_user, (NEW.type = '+')::int, (NEW.type = '-')::int, 1,
+                        (recent AND NEW.type = '+')::int, (recent AND NEW.type = '-')::int, NEW.created_at)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    positive = s.positive + EXCLUDED.positive,
+                    negative = s.negative + EXCLUDED.negative,
+                    unique_reviewers = s.unique_reviewers + (pair_reviews = 1)::int,
+                    recent_positive = s.recent_positive + EXCLUDED.recent_positive,
+                    recent_negative = s.recent_negative + EXCLUDED.recent_negative,
+                    last_review_at = GREATEST(s.last_review_at, EXCLUDED.last_review_at);
+                RETURN NULL;
+            END IF;
+
+            recent := OLD.created_at > NOW() - {RECENT_WINDOW_SQL};
+            UPDATE reviewer_pairs SET reviews = reviews - 1
+            WHERE to_user = OLD.to_user AND from_user = COALESCE(OLD.from_user, 0)
+            RETURNING reviews INTO pair_reviews;
+            IF pair_reviews <= 0 THEN
+                DELETE FROM reviewer_pairs WHERE to_user = OLD.to_user AND from_user = COALESCE(OLD.from_user, 0);
+            END IF;
+
+            -- Счетчики не уходят в минус: расхождения исправляет сверка (reconcile.py)
+            UPDATE user_stats SET
+                positive = GREATEST(positive - (OLD.type = '+')::int, 0),
+                negative = GREATEST(negative - (OLD.type = '-')::int, 0),
+                unique_reviewers = GREATEST(unique_reviewers - (COALESCE(pair_reviews, 1) <= 0)::int, 0),
+                recent_positive = GREATEST(recent_positive - (recent AND OLD.type = '+')::int, 0),
+                recent_negative = GREATEST(recent_negative - (recent AND OLD.type = '-')::int, 0),
+                last_review_at = CASE
+                    WHEN last_review_at > OLD.created_at THEN last_review_at
+                    ELSE (SELECT MAX(created_at) FROM reputation_log WHERE to_user = OLD.to_user)
+                END
+            WHERE user_id = OLD.to_user;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER reputation_log_user_stats
+            AFTER INSERT OR DELETE ON reputation_log
+            FOR EACH ROW EXECUTE FUNCTION user_stats_on_review();
+
+        -- Денормализованные счетчики в users больше не ведутся
+        ALTER TABLE users DROP COLUMN positive, DROP COLUMN negative;
+    """),
+    (8, "monthly partitioned reputation_log", f"""
+        LOCK TABLE reputation_log IN ACCESS EXCLUSIVE MODE;
+
+        -- Старая таблица уступает имена новой; последовательность id переживает ее удаление
+        ALTER TABLE reputation_log RENAME TO reputation_log_unpartitioned;
+        ALTER INDEX reputation_log_pkey RENAME TO reputation_log_unpartitioned_pkey;
+        ALTER SEQUENCE reputation_log_id_seq OWNED BY NONE;
+        ALTER SEQUENCE reputation_log_id_seq AS BIGINT;
+
+        -- Ключ секционирования обязан входить в первичный ключ
+        CREATE TABLE reputation_log (
+            id BIGINT NOT NULL DEFAULT nextval('reputation_log_id_seq'),
+            from_user BIGINT,
+            to_user BIGINT,
+            type TEXT CHECK (type IN ('+', '-')),
+            message_text TEXT,
+            photo_id TEXT,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at);
+        ALTER SEQUENCE reputation_log_id_seq OWNED BY reputation_log.id;
+
+        -- Месячные секции reputation_log_yГГГГmММ для всех месяцев [from_ts, to_ts].
+        -- Секции по умолчанию нет: с ней Postgres не читает секции по порядку
+        -- created_at, поэтому будущие месяцы создаются заранее (partitions.py).
+        CREATE OR REPLACE FUNCTION reputation_log_ensure_partitions(from_ts TIMESTAMP, to_ts TIMESTAMP)
+        RETURNS INT AS $$
+        DECLARE
+            part_start TIMESTAMP := date_trunc('month', from_ts);
+            created INT := 0;
+            part_name TEXT;
+        BEGIN
+            WHILE part_start <= to_ts LOOP
+                part_name := 'reputation_log_' || to_char(part_start, '"y"YYYY"m"MM');
+                IF to_regclass(part_name) IS NULL THEN
+                    EXECUTE format(
+                        'CREATE TABLE %I PARTITION OF reputation_log FOR VALUES FROM (%L) TO (%L)',
+                        part_name, part_start, part_start + INTERVAL '1 month'
+                    );
+                    created := created + 1;
+                END IF;
+                part_start := part_start + INTERVAL '1 month';
+            END LOOP;
+            RETURN created;
+        END
+        $$ LANGUAGE plpgsql;
+
+        SELECT reputation_log_ensure_partitions(
+            LEAST(MIN(created_at), NOW()::timestamp), NOW()::timestamp + INTERVAL '3 months'
+        ) FROM reputation_log_unpartitioned;
+
+        -- Триггера на новой таблице еще нет - user_stats не пересчитывается
+        INSERT INTO reputation_log (id, from_user, to_user, type, message_text, photo_id, created_at)
+        SELECT id, from_user, to_user, type, message_text, photo_id, COALESCE(created_at, NOW())
+        FROM reputation_log_unpartitioned;
+        DROP TABLE reputation_log_unpartitioned;
+
+        CREATE INDEX reputation_log_to_user_type_created_id_idx
+            ON reputation_log (to_user, type, created_at DESC, id DESC);
+        CREATE INDEX reputation_log_to_user_created_id_idx
+            ON reputation_log (to_user, created_at DESC, id DESC);
+
+        -- Архив: отцепленные по сроку хранения секции, доступны для чтения
+        CREATE SCHEMA IF NOT EXISTS archive;
+        CREATE TABLE archive.reputation_log (LIKE reputation_log) PARTITION BY RANGE (created_at);
+
+        -- Отзывы из архива продолжают учитываться в статистике пользователя
+        ALTER TABLE user_stats
+            ADD COLUMN archived_positive INT NOT NULL DEFAULT 0 CHECK (archived_positive >= 0),
+            ADD COLUMN archived_negative INT NOT NULL DEFAULT 0 CHECK (archived_negative >= 0),
+            ADD COLUMN archived_last_review_at TIMESTAMP;
+        ALTER TABLE reviewer_pairs ADD COLUMN archived INT NOT NULL DEFAULT 0;
+
+        -- То же, что в миграции 7, но последний отзыв после удаления ищется и в архиве
+        CREATE OR REPLACE FUNCTION user_stats_on_review() RETURNS trigger AS $$
+        DECLARE
+            recent BOOLEAN;
+            pair_reviews INT;
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                recent := NEW.created_at > NOW() - {RECENT_WINDOW_SQL};
+                INSERT INTO reviewer_pairs AS p (to_user, from_user, reviews)
+                VALUES (NEW.to_user, COALESCE(NEW.from_user, 0), 1)
+                ON CONFLICT (to_user, from_user) DO UPDATE SET reviews = p.reviews + 1
+                RETURNING p.reviews INTO pair_reviews;
+
+                INSERT INTO user_stats AS s (user_id, positive, negative, unique_reviewers,
+                                             recent_positive, recent_negative, last_review_at)
+                VALUES (NEW.to_user, (NEW.type = '+')::int, (NEW.type = '-')::int, 1,
+                        (recent AND NEW.type = '+')::int, (recent AND NEW.type = '-')::int, NEW.created_at)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    positive = s.positive + EXCLUDED.positive,
+                    negative = s.negative + EXCLUDED.negative,
+                    unique_reviewers = s.unique_reviewers + (pair_reviews = 1)::int,
+                    recent_positive = s.recent_positive + EXCLUDED.recent_positive,
+                    recent_negative = s.recent_negative + EXCLUDED.recent_negative,
+                    last_review_at = GREATEST(s.last_review_at, EXCLUDED.last_review_at);
+                RETURN NULL;
+            END IF;
+
+            recent := OLD.created_at > NOW() - {RECENT_WINDOW_SQL};
+            UPDATE reviewer_pairs SET reviews = reviews - 1
+            WHERE to_user = OLD.to_user AND from_user = COALESCE(OLD.from_user, 0)
+            RETURNING reviews INTO pair_reviews;
+            IF pair_reviews <= 0 THEN
+                DELETE FROM reviewer_pairs WHERE to_user = OLD.to_user AND from_user = COALESCE(OLD.from_user, 0);
+            END IF;
+
+            UPDATE user_stats SET
+                positive = GREATEST(positive - (OLD.type = '+')::int, 0),
+                negative = GREATEST(negative - (OLD.type = '-')::int, 0),
+                unique_reviewers = GREATEST(unique_reviewers - (COALESCE(pair_reviews, 1) <= 0)::int, 0),
+                recent_positive = GREATEST(recent_positive - (recent AND OLD.type = '+')::int, 0),
+                recent_negative = GREATEST(recent_negative - (recent AND OLD.type = '-')::int, 0),
+                last_review_at = CASE
+                    WHEN last_review_at > OLD.created_at THEN last_review_at
+                    ELSE COALESCE(
+                        (SELECT MAX(created_at) FROM reputation_log WHERE to_user = OLD.to_user),
+                        archived_last_review_at
+                    )
+                END
+            WHERE user_id = OLD.to_user;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER reputation_log_user_stats
+            AFTER INSERT OR DELETE ON reputation_log
+            FOR EACH ROW EXECUTE FUNCTION user_stats_on_review();
+    """),
+    (9, "review full-text search", f"""
+        -- Колонка есть и у архива: иначе отцепленные секции к нему не прикрепить
+        ALTER TABLE reputation_log ADD COLUMN search tsvector
+            GENERATED ALWAYS AS ({REVIEW_SEARCH_TSVECTOR}) STORED;
+        ALTER TABLE archive.reputation_log ADD COLUMN search tsvector
+            GENERATED ALWAYS AS ({REVIEW_SEARCH_TSVECTOR}) STORED;
+        CREATE INDEX reputation_log_search_idx ON reputation_log USING GIN (search);
+    """),
+    (10, "pending reputation for unresolved usernames", """
+        -- Отзывы на @username, которого еще ищут через Telegram API (pending.py);
+        -- chat_id/message_id - куда ответить, когда поиск закончится
+        CREATE TABLE pending_reputation (
+            id BIGSERIAL PRIMARY KEY,
+            username TEXT NOT NULL,
+            from_user BIGINT,
+            type TEXT CHECK (type IN ('+', '-')),
+            message_text TEXT,
+            photo_id TEXT,
+            chat_id BIGINT,
+            chat_type TEXT,
+            message_id BIGINT,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW()
+        );
+        CREATE INDEX pending_reputation_username_idx ON pending_reputation (lower(username));
+    """),
+]
+
+
+async def migrate(conn):
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INT PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT NOW()
+        )
+    """)
+
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock($1)", MIGRATION_LOCK_ID)
+        current = await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+        applied = []
+        for version, name, sql in MIGRATIONS:
+            if version <= current:
+                continue
+            logger.info("Применяется миграция %d: %s", version, name)
+            await conn.execute(sql)
+            await conn.execute("INSERT INTO schema_version (version, name) VALUES ($1, $2)", version, name)
+            applied.append(version)
+
+    return applied
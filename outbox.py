@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from telegram.error import RetryAfter, TimedOut
+
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class _Job:
+    __slots__ = ("call", "texts", "kwargs", "reply_to", "future", "enqueued", "attempts")
+
+    def __init__(self, call, texts=None, kwargs=None, reply_to=None):
+        self.call = call
+        self.texts = texts
+        self.kwargs = kwargs
+        self.reply_to = reply_to
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued = time.monotonic()
+        self.attempts = 0
+
+
+class _ChatQueue:
+    __slots__ = ("jobs", "bucket", "worker", "replies")
+
+    def __init__(self, bucket):
+        self.jobs = deque()
+        self.bucket = bucket
+        self.worker = None
+        # message_id -> еще не отправленный ответ на это сообщение (для склейки)
+        self.replies = {}
+
+
+class Outbox:
+    # Очередь исходящих вызовов Bot API: общий лимит и лимит на чат (token bucket),
+    # повтор после RetryAfter, склейка нескольких ответов на одно сообщение.
+    # Вызовы одного чата выполняются строго по порядку постановки.
+    def __init__(self, global_rate=30, private_rate=1, group_rate=20 / 60, burst=3, max_retries=3):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.merged = 0
+        self.depth = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self._chats = {}
+        self._created = 0
+
+    def reply(self, message, text, **kwargs):
+        # Ответ на сообщение. Несколько ответов без клавиатуры на одно и то же
+        # сообщение, еще стоящих в очереди, отправляются одним сообщением.
+        chat = self._chat(message.chat)
+        job = chat.replies.get(message.message_id)
+        if job is not None and job.kwargs == kwargs and "reply_markup" not in kwargs:
+            job.texts.append(text)
+            self.merged += 1
+            return job.future
+
+        job = _Job(lambda text, kw: message.reply_text(text, **kw), [text], kwargs, message.message_id)
+        if "reply_markup" not in kwargs:
+            chat.replies[message.message_id] = job
+        self._enqueue(message.chat.id, chat, job)
+        return job.future
+
+    def call(self, chat, factory):
+        # Любой другой вызов (edit_message_text, delete, ...): factory() -> корутина
+        queue = self._chat(chat)
+        job = _Job(factory)
+        self._enqueue(chat.id, queue, job)
+        return job.future
+
+    def _chat(self, chat):
+        queue = self._chats.get(chat.id)
+        if queue is None:
+            self._created += 1
+            if self._created % 1000 == 0:
+                self._prune()
+            rate = self.private_rate if chat.type == "private" else self.group_rate
+            queue = self._chats[chat.id] = _ChatQueue(TokenBucket(rate, self.burst))
+        return queue
+
+    def _prune(self):
+        # Забываем простаивающие чаты с полным запасом токенов
+        for chat_id, queue in list(self._chats.items()):
+            if queue.worker is None and not queue.jobs and queue.bucket.is_full():
+                del self._chats[chat_id]
+
+    def _enqueue(self, chat_id, chat, job):
+        chat.jobs.append(job)
+        self.depth += 1
+        if chat.worker is None:
+            chat.worker = asyncio.get_running_loop().create_task(self._run(chat_id, chat))
+
+    async def _run(self, chat_id, chat):
+        try:
+            while chat.jobs:
+                job = chat.jobs.popleft()
+                if job.reply_to is not None and chat.replies.get(job.reply_to) is job:
+                    del chat.replies[job.reply_to]
+                self.depth -= 1
+                await self._execute(chat, job)
+        finally:
+            chat.worker = None
+            if not chat.jobs and chat.bucket.is_full():
+                self._chats.pop(chat_id, None)
+
+    async def _execute(self, chat, job):
+        while True:
+            now = time.monotonic()
+            wait = max(chat.bucket.reserve(now), self.global_bucket.reserve(now))
+            if wait > 0:
+                await asyncio.sleep(wait)
+            job.attempts += 1
+            try:
+                if job.texts is not None:
+                    result = await job.call("\n".join(job.texts), job.kwargs)
+                else:
+                    result = await job.call()
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+                chat.bucket.pause(retry_after)
+                if job.attempts <= self.max_retries:
+                    self.retries += 1
+                    logger.warning("Flood limit, повтор через %.1f с", retry_after)
+                    continue
+                self._fail(job, e)
+            except TimedOut as e:
+                if job.attempts <= self.max_retries:
+                    self.retries += 1
+                    continue
+                self._fail(job, e)
+            except Exception as e:
+                self._fail(job, e)
+            else:
+                latency = time.monotonic() - job.enqueued
+                self.sent += 1
+                self.latency_sum += latency
+                self.latency_max = max(self.latency_max, latency)
+                if not job.future.done():
+                    job.future.set_result(result)
+            return
+
+    def _fail(self, job, error):
+        self.failed += 1
+        logger.error("Не удалось отправить сообщение: %s", error)
+        if not job.future.done():
+            job.future.set_exception(error)
+            # Ошибка уже залогирована - не ругаемся на "неполученное исключение"
+            job.future.exception()
+
+    async def drain(self, timeout=10, chat_id=None):
+        # Ждет отправки всего, что уже в очереди (или только очереди одного чата)
+        chats = self._chats.values() if chat_id is None else [self._chats[chat_id]] if chat_id in self._chats else []
+        workers = [chat.worker for chat in chats if chat.worker is not None]
+        if workers:
+            await asyncio.wait(workers, timeout=timeout)
+
+    def stats(self):
+        return {
+            "depth": self.depth,
+            "chats": len(self._chats),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+            "merged": self.merged,
+            "latency_avg": self.latency_sum / self.sent if self.sent else 0.0,
+            "latency_max": self.latency_max,
+        }
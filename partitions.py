@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import re
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Чтобы обслуживание секций не шло в нескольких воркерах одновременно
+PARTITION_LOCK_ID = 7419203842
+
+PARTITION_NAME = re.compile(r"^reputation_log_y(\d{4})m(\d{2})$")
+
+# Секции reputation_log: прикрепленные и отцепленные, но еще не перенесенные в архив
+PARTITIONS_SQL = """
+    SELECT c.relname, c.relispartition
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = current_schema() AND c.relkind = 'r' AND c.relname ~ '^reputation_log_y[0-9]{4}m[0-9]{2}$'
+"""
+
+# Генерируемые колонки (search) при переносе строк не перечисляются
+ARCHIVE_COLUMNS = "id, from_user, to_user, type, message_text, photo_id, created_at"
+
+ARCHIVE_COUNTERS_SQL = """
+    UPDATE user_stats s SET
+        archived_positive = s.archived_positive + a.positive,
+        archived_negative = s.archived_negative + a.negative,
+        archived_last_review_at = GREATEST(s.archived_last_review_at, a.last_review_at)
+    FROM (
+        SELECT to_user,
+               COUNT(*) FILTER (WHERE type = '+') AS positive,
+               COUNT(*) FILTER (WHERE type = '-') AS negative,
+               MAX(created_at) AS last_review_at
+        FROM {table}
+        GROUP BY to_user
+    ) a
+    WHERE s.user_id = a.to_user
+"""
+
+ARCHIVE_PAIRS_SQL = """
+    UPDATE reviewer_pairs p SET archived = p.archived + a.reviews
+    FROM (
+        SELECT to_user, COALESCE(from_user, 0) AS from_user, COUNT(*) AS reviews
+        FROM {table}
+        GROUP BY to_user, COALESCE(from_user, 0)
+    ) a
+    WHERE p.to_user = a.to_user AND p.from_user = a.from_user
+"""
+
+
+def partition_month(name):
+    match = PARTITION_NAME.match(name)
+    return datetime(int(match[1]), int(match[2]), 1)
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+class PartitionManager:
+    # Месячные секции reputation_log: заранее создает секции на months_ahead
+    # месяцев вперед и, если задан retention_months, переносит секции старше
+    # этого срока в схему archive. Статистика пользователей (user_stats.archived_*,
+    # reviewer_pairs.archived) продолжает учитывать перенесенные отзывы.
+    def __init__(self, retention_months=0, months_ahead=3, interval=86400):
+        self.pool = None
+        self.retention_months = retention_months
+        self.months_ahead = months_ahead
+        self.interval = interval
+        self.created = 0
+        self.archived = 0
+        self.live = 0
+        self._task = None
+
+    async def ensure_ahead(self, conn):
+        created = await conn.fetchval(
+            "SELECT reputation_log_ensure_partitions(NOW()::timestamp, NOW()::timestamp + make_interval(months => $1))",
+            self.months_ahead,
+        )
+        self.created += created
+        return created
+
+    async def archive_partition(self, conn, name, attached):
+        # Отцепление CONCURRENTLY не блокирует запись в reputation_log, но идет вне
+        # транзакции; если процесс упадет после него, перенос завершит следующий проход -
+        # отцепленная секция остается в основной схеме, пока не попадет в архив.
+        if attached:
+            await conn.execute(f"ALTER TABLE reputation_log DETACH PARTITION {name} CONCURRENTLY")
+        month = partition_month(name)
+        async with conn.transaction():
+            await conn.execute(ARCHIVE_COUNTERS_SQL.format(table=name))
+            await conn.execute(ARCHIVE_PAIRS_SQL.format(table=name))
+            if await conn.fetchval("SELECT to_regclass($1)", f"archive.{name}") is None:
+                await conn.execute(f"ALTER TABLE {name} SET SCHEMA archive")
+                await conn.execute(
+                    f"ALTER TABLE archive.reputation_log ATTACH PARTITION archive.{name} "
+                    f"FOR VALUES FROM ('{month}') TO ('{add_months(month, 1)}')"
+                )
+            else:
+                # Месяц уже в архиве (например, старые отзывы догрузили через dump.py)
+                await conn.execute(
+                    f"INSERT INTO archive.{name} ({ARCHIVE_COLUMNS}) SELECT {ARCHIVE_COLUMNS} FROM {name}"
+                )
+                await conn.execute(f"DROP TABLE {name}")
+        self.archived += 1
+        logger.info("Секция %s перенесена в архив", name)
+
+    async def maintain(self):
+        # -> (создано секций, перенесено в архив) или None, если обслуживание идет в другом воркере
+        async with self.pool.acquire() as conn:
+            if not await conn.fetchval("SELECT pg_try_advisory_lock($1)", PARTITION_LOCK_ID):
+                return None
+            try:
+                created = await self.ensure_ahead(conn)
+                partitions = await conn.fetch(PARTITIONS_SQL)
+                archived = 0
+                cutoff = add_months(datetime.now().replace(day=1), -self.retention_months)
+                for row in sorted(partitions, key=lambda row: row['relname']):
+                    expired = self.retention_months > 0 and partition_month(row['relname']) < cutoff
+                    if expired or not row['relispartition']:
+                        await self.archive_partition(conn, row['relname'], row['relispartition'])
+                        archived += 1
+                self.live = len(partitions) - archived
+                return created, archived
+            finally:
+                await conn.execute("SELECT pg_advisory_unlock($1)", PARTITION_LOCK_ID)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.maintain()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Обслуживание секций reputation_log прервано, повтор через %d с", self.interval)
+            await asyncio.sleep(self.interval)
+
+    def start(self, pool):
+        self.pool = pool
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self):
+        return {"live": self.live, "created": self.created, "archived": self.archived}
@@ -0,0 +1,143 @@
+import asyncio
+import logging
+
+from telegram.error import RetryAfter
+
+import queries
+from migrations import is_valid_user_id
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class PendingResolver:
+    # Отзывы на @username, которых еще нет в БД: хендлер сразу пишет их в pending_reputation,
+    # а пользователя через Telegram API ищут workers фоновых задач, не чаще rate запросов
+    # в секунду. Каждый username стоит в очереди один раз, сколько бы отзывов на него ни ждало.
+    # Раз в sweep_interval очередь дополняется из таблицы: так подхватываются отзывы после
+    # рестарта, переполнения очереди и временных ошибок API.
+    def __init__(self, workers=4, rate=5, burst=5, max_queued=10000, sweep_interval=60):
+        self.pool = None
+        self.workers = workers
+        self.bucket = TokenBucket(rate, burst)
+        self.max_queued = max_queued
+        self.sweep_interval = sweep_interval
+        self.added = 0
+        self.attached = 0
+        self.dropped = 0
+        self.failed = 0
+        self._queue = asyncio.Queue()
+        self._queued = set()
+        self._resolve = None
+        self._on_done = None
+        self._tasks = []
+
+    async def add(self, usernames, from_user, rep_type, message_text, photo_id, chat, message_id):
+        async with self.pool.acquire() as conn:
+            await queries.PENDING_ADD.execute(
+                conn, usernames, from_user, rep_type, message_text, photo_id, chat.id, chat.type, message_id
+            )
+        self.added += len(usernames)
+        for username in usernames:
+            self._enqueue(username.lower())
+
+    def _enqueue(self, key):
+        if key in self._queued or len(self._queued) >= self.max_queued:
+            return
+        self._queued.add(key)
+        self._queue.put_nowait(key)
+
+    async def process(self, key):
+        # -> найденный пользователь или None; ошибки API пробрасываются, отзывы остаются ждать
+        wait = self.bucket.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        try:
+            user = await self._resolve(key)
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+            self.bucket.pause(retry_after)
+            raise
+        if user is not None and not is_valid_user_id(user['user_id']):
+            user = None
+        async with self.pool.acquire() as conn:
+            if user is not None:
+                rows = await queries.PENDING_ATTACH.fetch(conn, key, user['user_id'])
+                self.attached += sum(row['from_user'] != user['user_id'] for row in rows)
+            else:
+                rows = await queries.PENDING_DROP.fetch(conn, key)
+                self.dropped += len(rows)
+        if rows and self._on_done is not None:
+            await self._on_done(key, user, rows)
+        return user
+
+    async def _worker(self):
+        while True:
+            key = await self._queue.get()
+            try:
+                await self.process(key)
+            except asyncio.CancelledError:
+                raise
+            except RetryAfter as e:
+                self.failed += 1
+                logger.warning("Flood limit при поиске @%s (%s), повтор через %d с", key, e, self.sweep_interval)
+            except Exception:
+                self.failed += 1
+                logger.exception("Не удалось найти @%s, повтор через %d с", key, self.sweep_interval)
+            finally:
+                self._queued.discard(key)
+                self._queue.task_done()
+
+    async def sweep(self):
+        async with self.pool.acquire() as conn:
+            rows = await queries.PENDING_WAITING.fetch(conn)
+        for row in rows:
+            self._enqueue(row['username'])
+        return len(rows)
+
+    async def _run_sweeps(self):
+        while True:
+            try:
+                await self.sweep()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Не удалось прочитать pending_reputation, повтор через %d с", self.sweep_interval)
+            await asyncio.sleep(self.sweep_interval)
+
+    def start(self, pool, resolve, on_done=None):
+        # await resolve(username) -> пользователь или None, если его нет и в Telegram;
+        # await on_done(username, пользователь или None, строки отложенных отзывов) - ответы в чаты
+        self.pool = pool
+        self._resolve = resolve
+        self._on_done = on_done
+        if not self._tasks:
+            loop = asyncio.get_running_loop()
+            self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+            self._tasks.append(loop.create_task(self._run_sweeps()))
+
+    async def drain(self, timeout=10):
+        # Ждет, пока разберут уже поставленные в очередь username
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+
+    def stats(self):
+        return {
+            "queued": len(self._queued),
+            "added": self.added,
+            "attached": self.attached,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
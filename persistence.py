@@ -0,0 +1,171 @@
+import asyncio
+import json
+import logging
+import time
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+# Из user_data сохраняется только состояние диалога - остальное пересобирается на лету
+PERSISTED_KEYS = ("state", "target_user", "target_username", "search_user", "search_query")
+
+EXPIRE_SQL = "DELETE FROM user_state WHERE updated_at < NOW() - $1::int * INTERVAL '1 second'"
+
+
+def compact_state(user_data):
+    return {key: user_data[key] for key in PERSISTED_KEYS if user_data.get(key) is not None}
+
+
+class PostgresPersistence(BasePersistence):
+    # Хранит компактное состояние диалогов в таблице user_state.
+    # PTB вызывает update_user_data для измененных пользователей раз в update_interval
+    # секунд; все такие вызовы одного цикла записываются одним запросом.
+    def __init__(self, pool_factory, update_interval=10, ttl=3600):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.pool_factory = pool_factory
+        self.ttl = ttl
+        self.writes = 0
+        self.expired = 0
+        self._written = {}
+        self._pending = {}
+        self._last_seen = {}
+        self._write_task = None
+        self._write_lock = asyncio.Lock()
+        self._last_expire = time.monotonic()
+
+    async def get_user_data(self):
+        pool = await self.pool_factory()
+        async with pool.acquire() as conn:
+            await conn.execute(EXPIRE_SQL, self.ttl)
+            rows = await conn.fetch("SELECT user_id, data::text AS data FROM user_state")
+        now = time.monotonic()
+        user_data = {}
+        for row in rows:
+            state = json.loads(row['data'])
+            user_data[row['user_id']] = state
+            self._written[row['user_id']] = state
+            self._last_seen[row['user_id']] = now
+        logger.info("Загружено состояние %d пользователей", len(user_data))
+        return user_data
+
+    async def update_user_data(self, user_id, data):
+        state = compact_state(data)
+        if self._written.get(user_id, {}) == state:
+            self._pending.pop(user_id, None)
+            return
+        self._pending[user_id] = state
+        if self._write_task is None:
+            # Запись стартует после того, как PTB передаст всех измененных пользователей цикла
+            self._write_task = asyncio.get_running_loop().create_task(self._write_pending())
+
+    async def refresh_user_data(self, user_id, user_data):
+        # Вызывается перед обработкой каждого апдейта пользователя: сбрасываем зависшие диалоги
+        now = time.monotonic()
+        last_seen = self._last_seen.get(user_id)
+        self._last_seen[user_id] = now
+        if last_seen is not None and now - last_seen > self.ttl:
+            expired = False
+            for key in PERSISTED_KEYS:
+                if user_data.pop(key, None) is not None:
+                    expired = True
+            if expired:
+                self.expired += 1
+                self._pending[user_id] = {}
+
+    async def drop_user_data(self, user_id):
+        self._pending[user_id] = {}
+        self._last_seen.pop(user_id, None)
+        await self._write_pending()
+
+    async def _write_pending(self):
+        async with self._write_lock:
+            self._write_task = None
+            if not self._pending:
+                return
+            batch = self._pending
+            self._pending = {}
+            upserts = {user_id: state for user_id, state in batch.items() if state}
+            deletes = [user_id for user_id, state in batch.items() if not state]
+            try:
+                pool = await self.pool_factory()
+                async with pool.acquire() as conn:
+                    async with conn.transaction():
+                        if upserts:
+                            await conn.execute("""
+                                INSERT INTO user_state (user_id, data, updated_at)
+                                SELECT s.user_id, s.data::jsonb, NOW()
+                                FROM unnest($1::bigint[], $2::text[]) AS s(user_id, data)
+                                ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data, updated_at = NOW()
+                            """, list(upserts), [json.dumps(state, ensure_ascii=False) for state in upserts.values()])
+                        if deletes:
+                            await conn.execute("DELETE FROM user_state WHERE user_id = ANY($1::bigint[])", deletes)
+            except Exception:
+                logger.exception("Не удалось сохранить состояние %d пользователей", len(batch))
+                for user_id, state in batch.items():
+                    self._pending.setdefault(user_id, state)
+                return
+            for user_id, state in batch.items():
+                if state:
+                    self._written[user_id] = state
+                else:
+                    self._written.pop(user_id, None)
+            self.writes += 1
+            await self._expire_idle()
+
+    async def _expire_idle(self):
+        # Не чаще раза в ttl/10: чистим просроченные строки и забываем неактивных пользователей
+        now = time.monotonic()
+        if now - self._last_expire < self.ttl / 10:
+            return
+        self._last_expire = now
+        for user_id, last_seen in list(self._last_seen.items()):
+            if now - last_seen > self.ttl:
+                del self._last_seen[user_id]
+                self._written.pop(user_id, None)
+        try:
+            pool = await self.pool_factory()
+            async with pool.acquire() as conn:
+                await conn.execute(EXPIRE_SQL, self.ttl)
+        except Exception:
+            logger.exception("Не удалось удалить просроченные состояния")
+
+    async def flush(self):
+        await self._write_pending()
+
+    # Остальные виды данных не сохраняются (store_data выше)
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
@@ -0,0 +1,66 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    # Параллельная обработка апдейтов (не больше max_concurrent_updates одновременно),
+    # но апдейты одного чата (в личке - одного пользователя) идут строго по очереди,
+    # чтобы диалог через context.user_data["state"] не ломался
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        # ключ -> [Lock, число апдейтов, ждущих или выполняющихся под ним]
+        self._locks = {}
+        # Все принятые и еще не обработанные апдейты (мера перегрузки)
+        self.pending = 0
+
+    @staticmethod
+    def order_key(update):
+        if isinstance(update, Update):
+            if update.effective_chat is not None:
+                return update.effective_chat.id
+            if update.effective_user is not None:
+                return ("user", update.effective_user.id)
+        return None
+
+    @asynccontextmanager
+    async def _ordered(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    async def process_update(self, update, coroutine):
+        # Очередь чата - до общего семафора: ждущие апдейты одного чата не занимают слоты
+        key = self.order_key(update)
+        self.pending += 1
+        try:
+            if key is None:
+                await super().process_update(update, coroutine)
+                return
+            async with self._ordered(key):
+                await super().process_update(update, coroutine)
+        finally:
+            self.pending -= 1
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def active_chats(self):
+        return len(self._locks)
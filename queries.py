@@ -0,0 +1,254 @@
+import argparse
+import asyncio
+import os
+import time
+
+import asyncpg
+
+from metrics import DB_STATEMENT_SECONDS
+
+# Именованные запросы горячих путей с явным списком колонок; строки результата
+# разбираются в классы со __slots__. Текст запроса постоянный, поэтому кэш asyncpg
+# готовит его один раз на соединение и дальше только выполняет - в том числе между
+# acquire из пула (PreparedStatement из conn.prepare после возврата соединения
+# в пул недействителен). Общие планы всех запросов (Postgres 16+):
+#   python queries.py [--database-url postgres://...] [--statement user_by_id ...]
+
+DATABASE_URL = os.environ.get("DATABASE_URL")
+
+# name -> Statement
+STATEMENTS = {}
+
+# EXPLAIN с $1.. без значений параметров возможен только в динамическом SQL
+GENERIC_PLAN_FUNCTION = """
+    CREATE FUNCTION pg_temp.generic_plan(query text) RETURNS SETOF text LANGUAGE plpgsql AS $$
+    BEGIN
+        RETURN QUERY EXECUTE 'EXPLAIN (GENERIC_PLAN, COSTS OFF) ' || query;
+    END
+    $$
+"""
+
+
+class Row:
+    # Строка результата: колонки перечислены в __slots__ подкласса.
+    # row['колонка'] работает как у asyncpg.Record
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    @classmethod
+    def decode(cls, record):
+        return cls(*(record[name] for name in cls.__slots__))
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+    def __repr__(self):
+        values = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({values})"
+
+
+class UserRef(Row):
+    # Упоминание в "+реп": для записи отзыва статистика не нужна
+    __slots__ = ("user_id", "username")
+
+
+class User(Row):
+    # Профиль: users + счетчики user_stats
+    __slots__ = (
+        "user_id", "username", "registered", "total_deals", "deal_sum", "bio",
+        "positive", "negative", "unique_reviewers", "recent_positive", "recent_negative", "last_review_at",
+    )
+
+
+class Review(Row):
+    __slots__ = ("id", "from_user", "type", "message_text", "photo_id", "created_at", "from_username")
+
+
+class DeletedReview(Row):
+    __slots__ = ("to_user", "type")
+
+
+class PendingReply(Row):
+    # Отложенный отзыв, на который нужно ответить в чат после поиска username
+    __slots__ = ("from_user", "type", "chat_id", "chat_type", "message_id")
+
+
+class PendingUsername(Row):
+    __slots__ = ("username",)
+
+
+class Statement:
+    __slots__ = ("name", "sql", "row_type", "calls", "seconds")
+
+    def __init__(self, name, sql, row_type):
+        self.name = name
+        self.sql = sql
+        self.row_type = row_type
+        self.calls = 0
+        self.seconds = 0.0
+        STATEMENTS[name] = self
+
+    async def _run(self, conn, method, args):
+        start = time.perf_counter()
+        try:
+            return await getattr(conn, method)(self.sql, *args)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.calls += 1
+            self.seconds += elapsed
+            DB_STATEMENT_SECONDS.observe(elapsed, statement=self.name)
+
+    async def fetch(self, conn, *args):
+        return [self.row_type.decode(record) for record in await self._run(conn, "fetch", args)]
+
+    async def fetchrow(self, conn, *args):
+        record = await self._run(conn, "fetchrow", args)
+        return None if record is None else self.row_type.decode(record)
+
+    async def execute(self, conn, *args):
+        return await self._run(conn, "execute", args)
+
+
+# Пользователь вместе со статистикой отзывов (user_stats ведется триггером на reputation_log)
+USER_COLUMNS = """
+    SELECT u.user_id, u.username, u.registered, u.total_deals, u.deal_sum, u.bio,
+           COALESCE(s.positive, 0) AS positive, COALESCE(s.negative, 0) AS negative,
+           COALESCE(s.unique_reviewers, 0) AS unique_reviewers,
+           COALESCE(s.recent_positive, 0) AS recent_positive,
+           COALESCE(s.recent_negative, 0) AS recent_negative,
+           s.last_review_at
+    FROM users u
+    LEFT JOIN user_stats s ON s.user_id = u.user_id
+"""
+
+USER_BY_ID = Statement("user_by_id", USER_COLUMNS + "WHERE u.user_id = $1", User)
+USER_BY_USERNAME = Statement("user_by_username", USER_COLUMNS + "WHERE lower(u.username) = lower($1)", User)
+# Все упоминания сообщения сразу; $2 - username в нижнем регистре
+USER_REFS = Statement("user_refs", """
+    SELECT u.user_id, u.username
+    FROM users u
+    WHERE u.user_id = ANY($1::bigint[]) OR lower(u.username) = ANY($2::text[])
+""", UserRef)
+
+REVIEW_COLUMNS = """
+    SELECT r.id, r.from_user, r.type, r.message_text, r.photo_id, r.created_at,
+           u.username AS from_username
+    FROM reputation_log r
+    LEFT JOIN users u ON u.user_id = r.from_user
+"""
+
+# Отзыв по ключу (id, created_at): по created_at из всех месячных секций остается одна.
+# Автор - подзапросом: с LEFT JOIN общий план (оценка по всем секциям) читает users целиком
+REVIEW_BY_ID = Statement("review_by_id", """
+    SELECT r.id, r.from_user, r.type, r.message_text, r.photo_id, r.created_at,
+           (SELECT u.username FROM users u WHERE u.user_id = r.from_user) AS from_username
+    FROM reputation_log r
+    WHERE r.id = $1 AND r.created_at = $2
+""", Review)
+DELETE_REVIEW = Statement(
+    "delete_review", "DELETE FROM reputation_log WHERE id = $1 AND created_at = $2 RETURNING to_user, type",
+    DeletedReview,
+)
+
+# Отзывы одного сообщения на несколько пользователей - одним оператором;
+# user_stats обновляет триггер в той же транзакции, блокируя строки по порядку to_user
+ADD_REVIEWS = Statement("add_reviews", """
+    INSERT INTO reputation_log (from_user, to_user, type, message_text, photo_id)
+    SELECT $1, t.to_user, $3, $4, $5
+    FROM unnest($2::bigint[]) AS t(to_user)
+    ORDER BY t.to_user
+""", None)
+
+# pending_reputation: отзывы на @username, которых еще нет в БД (см. pending.py).
+# Отзывы одного сообщения на несколько неизвестных username - одним оператором
+PENDING_ADD = Statement("pending_add", """
+    INSERT INTO pending_reputation (username, from_user, type, message_text, photo_id, chat_id, chat_type, message_id)
+    SELECT t.username, $2, $3, $4, $5, $6, $7, $8
+    FROM unnest($1::text[]) AS t(username)
+""", None)
+# Отложенные отзывы найденного пользователя переносятся в reputation_log (кроме отзывов
+# самому себе) с исходным временем; user_stats обновляет триггер в той же транзакции
+PENDING_ATTACH = Statement("pending_attach", """
+    WITH taken AS (
+        DELETE FROM pending_reputation
+        WHERE lower(username) = $1
+        RETURNING from_user, type, message_text, photo_id, chat_id, chat_type, message_id, created_at
+    ), saved AS (
+        INSERT INTO reputation_log (from_user, to_user, type, message_text, photo_id, created_at)
+        SELECT from_user, $2, type, message_text, photo_id, created_at FROM taken
+        WHERE from_user IS DISTINCT FROM $2
+    )
+    SELECT from_user, type, chat_id, chat_type, message_id FROM taken
+""", PendingReply)
+PENDING_DROP = Statement("pending_drop", """
+    DELETE FROM pending_reputation
+    WHERE lower(username) = $1
+    RETURNING from_user, type, chat_id, chat_type, message_id
+""", PendingReply)
+PENDING_WAITING = Statement(
+    "pending_waiting", "SELECT DISTINCT lower(username) AS username FROM pending_reputation", PendingUsername
+)
+
+REVIEW_TYPES = {"pos": "+", "neg": "-", "all": None}
+# Страницы отзывов по ключу (created_at, id), $3-$4 - курсор. Отдельное условие
+# на r.created_at отсекает месячные секции reputation_log по другую сторону
+# курсора - сравнение кортежей для этого не годится.
+REVIEW_PAGE_MODES = {
+    "first": ("", "DESC"),
+    "older": (" AND r.created_at <= $3 AND (r.created_at, r.id) <= ($3, $4)", "DESC"),
+    "newer": (" AND r.created_at >= $3 AND (r.created_at, r.id) > ($3, $4)", "ASC"),
+}
+
+
+def _review_page_sql(review_type, mode):
+    condition, order = REVIEW_PAGE_MODES[mode]
+    sign = REVIEW_TYPES[review_type]
+    type_filter = f" AND r.type = '{sign}'" if sign else ""
+    return REVIEW_COLUMNS + f"""
+    WHERE r.to_user = $1{type_filter}{condition}
+    ORDER BY r.created_at {order}, r.id {order}
+    LIMIT $2
+"""
+
+
+# (тип отзывов, режим) -> Statement
+REVIEW_PAGES = {
+    (review_type, mode): Statement(f"review_page_{review_type}_{mode}", _review_page_sql(review_type, mode), Review)
+    for review_type in REVIEW_TYPES
+    for mode in REVIEW_PAGE_MODES
+}
+
+
+def stats():
+    # {запрос: {"calls": вызовов, "avg_ms": среднее время}} - только вызывавшиеся
+    return {
+        name: {"calls": statement.calls, "avg_ms": round(statement.seconds / statement.calls * 1000, 3)}
+        for name, statement in STATEMENTS.items()
+        if statement.calls
+    }
+
+
+async def run(args):
+    conn = await asyncpg.connect(args.database_url)
+    try:
+        await conn.execute(GENERIC_PLAN_FUNCTION)
+        for name in args.statement or STATEMENTS:
+            plan = await conn.fetch("SELECT pg_temp.generic_plan($1)", STATEMENTS[name].sql)
+            print(f"{name}:")
+            print("\n".join("  " + row[0] for row in plan))
+    finally:
+        await conn.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Общие планы подготовленных запросов")
+    parser.add_argument("--database-url", default=DATABASE_URL)
+    parser.add_argument("--statement", action="append", choices=sorted(STATEMENTS))
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    # rate - токенов в секунду, capacity - максимальный запас (размер всплеска)
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity, now=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def try_take(self, now=None, amount=1):
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+    def reserve(self, now=None, amount=1):
+        # Забирает токен в долг и возвращает, сколько секунд нужно подождать
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        self.tokens -= amount
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def pause(self, seconds, now=None):
+        # Сервер попросил подождать (RetryAfter): обнуляем запас на это время
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    def is_full(self, now=None):
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class KeyedLimiter:
+    # Token bucket на каждый ключ (user_id, chat_id). Ведра хранятся в порядке
+    # последнего обращения; сверх max_keys и при каждой проверке из начала
+    # выбрасываются простаивающие - полное ведро ничем не отличается от нового.
+    def __init__(self, rate, capacity, max_keys=100000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self.allowed = 0
+        self.limited = 0
+        self._buckets = OrderedDict()
+
+    def allow(self, key, now=None):
+        now = time.monotonic() if now is None else now
+        buckets = self._buckets
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(self.rate, self.capacity, now)
+        else:
+            buckets.move_to_end(key)
+        allowed = bucket.try_take(now)
+        if allowed:
+            self.allowed += 1
+        else:
+            self.limited += 1
+        self._evict(now)
+        return allowed
+
+    def _evict(self, now):
+        buckets = self._buckets
+        while len(buckets) > self.max_keys:
+            buckets.popitem(last=False)
+        # Одной проверки самого давнего ведра за вызов хватает, чтобы память не росла
+        oldest = next(iter(buckets))
+        if buckets[oldest].is_full(now):
+            del buckets[oldest]
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def stats(self):
+        return {"keys": len(self._buckets), "allowed": self.allowed, "limited": self.limited}
+
+
+class LoadShedder:
+    # Режим перегрузки с гистерезисом: включается, когда load() >= 1, и выключается
+    # при load() <= low. Отложенная работа (фабрики корутин) ждет в ограниченной
+    # очереди и выполняется по одной, когда перегрузка проходит.
+    def __init__(self, low=0.5, max_deferred=10000, check_interval=0.5):
+        self.low = low
+        self.max_deferred = max_deferred
+        self.check_interval = check_interval
+        self.load = None
+        self.active = False
+        self.deferred = deque()
+        self.episodes = 0
+        self.dropped = 0
+        self.replayed = 0
+        # dropped на момент последнего сообщения в журнал: о сбросе пишется раз за эпизод
+        self._dropped_reported = 0
+        self._task = None
+
+    @property
+    def overloaded(self):
+        if self.load is None:
+            return False
+        load = self.load()
+        if not self.active and load >= 1:
+            self.active = True
+            self.episodes += 1
+            logger.warning("Перегрузка (%.2f): обрабатываются только запросы профилей", load)
+        elif self.active and load <= self.low:
+            self.active = False
+            logger.info(
+                "Перегрузка закончилась, отложено: %d, отброшено: %d",
+                len(self.deferred), self.dropped - self._dropped_reported,
+            )
+            self._dropped_reported = self.dropped
+        return self.active
+
+    def defer(self, factory):
+        # False - очередь заполнена, работа отброшена
+        if len(self.deferred) >= self.max_deferred:
+            if self.dropped == self._dropped_reported:
+                logger.warning("Очередь отложенной работы заполнена (%d), новая отбрасывается", self.max_deferred)
+            self.dropped += 1
+            return False
+        self.deferred.append(factory)
+        return True
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            while self.deferred and not self.overloaded:
+                factory = self.deferred.popleft()
+                try:
+                    await factory()
+                except Exception:
+                    logger.exception("Ошибка в отложенной обработке")
+                self.replayed += 1
+
+    def start(self, load):
+        # load() -> загрузка в долях порога (1.0 - порог перегрузки)
+        self.load = load
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self):
+        return {
+            "active": int(self.active),
+            "deferred": len(self.deferred),
+            "episodes": self.episodes,
+            "replayed": self.replayed,
+            "dropped": self.dropped,
+        }
@@ -0,0 +1,33 @@
+from cache import LRUCache
+
+
+class ReadRouter:
+    # Выбор пула для чтения: read-пул (реплика или отдельные соединения к primary),
+    # но primary - для пользователей, чьи данные менялись за последние window секунд,
+    # чтобы автор отзыва сразу видел его в профиле, несмотря на задержку репликации.
+    def __init__(self, window=5.0, max_tracked=100000):
+        self.primary = None
+        self.replica = None
+        self.window = window
+        # user_id -> True, пока не истекло окно read-your-writes
+        self.recent = LRUCache(max_tracked, ttl=window)
+        self.primary_reads = 0
+        self.replica_reads = 0
+
+    def wrote(self, *user_ids):
+        for user_id in user_ids:
+            self.recent.set(user_id, True)
+
+    def pool_for(self, *user_ids):
+        if self.replica is None or any(user_id in self.recent for user_id in user_ids):
+            self.primary_reads += 1
+            return self.primary
+        self.replica_reads += 1
+        return self.replica
+
+    def start(self, primary, replica=None):
+        self.primary = primary
+        self.replica = replica
+
+    def stats(self):
+        return {"primary_reads": self.primary_reads, "replica_reads": self.replica_reads, "recent": len(self.recent)}
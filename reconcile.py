@@ -0,0 +1,129 @@
+import asyncio
+import logging
+
+from migrations import RECENT_WINDOW_SQL
+
+logger = logging.getLogger(__name__)
+
+STAT_COLUMNS = ("positive", "negative", "unique_reviewers", "recent_positive", "recent_negative", "last_review_at")
+
+# Фактические значения для пачки user_id; пишутся только отличающиеся строки.
+# Отзывы, перенесенные в архив (partitions.py), берутся из archived_* и reviewer_pairs.
+FIX_CHUNK = f"""
+    WITH actual AS (
+        SELECT ids.user_id,
+               live.positive + COALESCE(a.archived_positive, 0) AS positive,
+               live.negative + COALESCE(a.archived_negative, 0) AS negative,
+               (SELECT COUNT(*) FROM (
+                    SELECT COALESCE(r.from_user, 0) FROM reputation_log r WHERE r.to_user = ids.user_id
+                    UNION
+                    SELECT p.from_user FROM reviewer_pairs p WHERE p.to_user = ids.user_id AND p.archived > 0
+               ) reviewers) AS unique_reviewers,
+               live.recent_positive,
+               live.recent_negative,
+               COALESCE(live.last_review_at, a.archived_last_review_at) AS last_review_at
+        FROM unnest($1::bigint[]) AS ids(user_id)
+        LEFT JOIN user_stats a ON a.user_id = ids.user_id
+        CROSS JOIN LATERAL (
+            SELECT COUNT(*) FILTER (WHERE r.type = '+') AS positive,
+                   COUNT(*) FILTER (WHERE r.type = '-') AS negative,
+                   COUNT(*) FILTER (WHERE r.type = '+' AND r.created_at > NOW() - {RECENT_WINDOW_SQL}) AS recent_positive,
+                   COUNT(*) FILTER (WHERE r.type = '-' AND r.created_at > NOW() - {RECENT_WINDOW_SQL}) AS recent_negative,
+                   MAX(r.created_at) AS last_review_at
+            FROM reputation_log r
+            WHERE r.to_user = ids.user_id
+        ) live
+    )
+    INSERT INTO user_stats AS s ({", ".join(STAT_COLUMNS)}, user_id, reconciled_at)
+    SELECT {", ".join(STAT_COLUMNS)}, user_id, NOW() FROM actual
+    WHERE positive + negative > 0
+       OR EXISTS (SELECT 1 FROM user_stats WHERE user_stats.user_id = actual.user_id)
+    ON CONFLICT (user_id) DO UPDATE SET
+        {", ".join(f"{c} = EXCLUDED.{c}" for c in STAT_COLUMNS)},
+        reconciled_at = NOW()
+    WHERE ({", ".join(f"s.{c}" for c in STAT_COLUMNS)})
+          IS DISTINCT FROM ({", ".join(f"EXCLUDED.{c}" for c in STAT_COLUMNS)})
+    RETURNING s.user_id
+"""
+
+
+class StatsReconciler:
+    # Фоновая сверка user_stats с reputation_log: проходит всех пользователей
+    # пачками по chunk_size с паузой pause между пачками, затем ждет interval.
+    # Заодно "состаривает" recent_* - триггер их только увеличивает.
+    def __init__(self, chunk_size=500, pause=1.0, interval=3600):
+        self.pool = None
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.interval = interval
+        self.passes = 0
+        self.checked = 0
+        self.fixed = 0
+        self._task = None
+
+    async def reconcile_chunk(self, after_id):
+        # -> (последний user_id пачки или None, если пользователи кончились; исправленные user_id).
+        # Строки user_stats пачки блокируются до подсчета: триггер отзыва, пришедшего во время
+        # сверки, дождется ее и прибавит свой +1 уже к исправленному значению.
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                ids = await conn.fetch(
+                    "SELECT user_id FROM users WHERE user_id > $1 ORDER BY user_id LIMIT $2",
+                    after_id, self.chunk_size,
+                )
+                if not ids:
+                    return None, []
+                ids = [row['user_id'] for row in ids]
+                await conn.execute(
+                    "SELECT 1 FROM user_stats WHERE user_id = ANY($1::bigint[]) ORDER BY user_id FOR UPDATE",
+                    ids,
+                )
+                fixed = await conn.fetch(FIX_CHUNK, ids)
+        self.checked += len(ids)
+        self.fixed += len(fixed)
+        return ids[-1], [row['user_id'] for row in fixed]
+
+    async def reconcile_all(self, on_fixed=None):
+        after_id = -(2 ** 63)
+        fixed_total = 0
+        while True:
+            after_id, fixed = await self.reconcile_chunk(after_id)
+            if after_id is None:
+                break
+            if fixed:
+                fixed_total += len(fixed)
+                if on_fixed is not None:
+                    await on_fixed(fixed)
+            await asyncio.sleep(self.pause)
+        self.passes += 1
+        return fixed_total
+
+    async def _run(self, on_fixed):
+        while True:
+            try:
+                fixed = await self.reconcile_all(on_fixed)
+                if fixed:
+                    logger.info("Сверка user_stats: обновлено %d пользователей", fixed)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Сверка user_stats прервана, повтор через %d с", self.interval)
+            await asyncio.sleep(self.interval)
+
+    def start(self, pool, on_fixed=None):
+        # await on_fixed(user_ids) - сброс кэшей с исправленной статистикой
+        self.pool = pool
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run(on_fixed))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self):
+        return {"passes": self.passes, "checked": self.checked, "fixed": self.fixed}
@@ -0,0 +1,86 @@
+import asyncio
+
+from cache import LRUCache
+
+
+class UsernameResolver:
+    # username -> user_id с негативным кэшем и объединением одновременных запросов
+    def __init__(self, maxsize=50000, negative_ttl=600):
+        self.positive = LRUCache(maxsize)
+        self.negative = LRUCache(maxsize, ttl=negative_ttl)
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.shared = 0
+        self.api_calls = 0
+        self._inflight = {}
+        self._bot_username = None
+
+    async def resolve(self, username, fetch_by_id, load, cache_negative=True):
+        # fetch_by_id(user_id) - чтение по известному ID,
+        # load(username) - полный поиск (БД, затем Telegram API)
+        key = username.lower()
+
+        if key in self.negative:
+            self.negative_hits += 1
+            return None
+
+        user_id = self.positive.get(key)
+        if user_id is not None:
+            user = await fetch_by_id(user_id)
+            if user and (user['username'] or "").lower() == key:
+                self.hits += 1
+                return user
+            # Пользователь переименован или удален - ищем заново
+            self.positive.pop(key)
+
+        future = self._inflight.get(key)
+        if future is not None:
+            self.shared += 1
+            return await asyncio.shield(future)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            user = await load(username)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Исключение уже передано ожидающим - помечаем его полученным
+            future.exception()
+            raise
+        else:
+            future.set_result(user)
+        finally:
+            self._inflight.pop(key, None)
+
+        if user:
+            self.remember(user['user_id'], user['username'])
+        elif cache_negative:
+            self.negative.set(key, True)
+        return user
+
+    def remember(self, user_id, username):
+        if username:
+            key = username.lower()
+            self.positive.set(key, user_id)
+            self.negative.pop(key)
+
+    async def bot_username(self, bot):
+        if self._bot_username is None:
+            self._bot_username = (await bot.get_me()).username
+        return self._bot_username
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "negative_hits": self.negative_hits,
+            "shared": self.shared,
+            "api_calls": self.api_calls,
+            "positive_size": len(self.positive),
+            "negative_size": len(self.negative),
+        }
@@ -0,0 +1,97 @@
+import sys
+import time
+from array import array
+from collections import OrderedDict
+
+# Примерные накладные расходы на ключ и записи в словарях, байт
+_ENTRY_OVERHEAD = 200
+
+
+class ReviewPage:
+    # Страница отзывов, которую сейчас видит пользователь: только ключи отзывов и курсоры.
+    # created - created_at отзывов в микросекундах: по нему запрос отзыва идет в одну секцию
+    __slots__ = ("ids", "created", "first_cursor", "has_prev", "next_cursor", "expires", "nbytes")
+
+    def __init__(self, ids, created, first_cursor, has_prev, next_cursor, expires):
+        self.ids = ids
+        self.created = created
+        self.first_cursor = first_cursor
+        self.has_prev = has_prev
+        self.next_cursor = next_cursor
+        self.expires = expires
+        self.nbytes = (
+            sys.getsizeof(self)
+            + sys.getsizeof(ids)
+            + sys.getsizeof(created)
+            + sys.getsizeof(first_cursor)
+            + (sys.getsizeof(next_cursor) if next_cursor else 0)
+            + _ENTRY_OVERHEAD
+        )
+
+
+class ReviewPageStore:
+    # LRU страниц отзывов с лимитом записей на пользователя и общим лимитом памяти
+    def __init__(self, per_user=8, budget_bytes=8 * 1024 * 1024, ttl=300):
+        self.per_user = per_user
+        self.budget_bytes = budget_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._pages = OrderedDict()
+        self._by_user = {}
+        self._bytes = 0
+
+    def get(self, user_id, key):
+        page = self._pages.get((user_id, key))
+        if page is None or page.expires < time.monotonic():
+            if page is not None:
+                self._remove(user_id, key)
+            self.misses += 1
+            return None
+        self._pages.move_to_end((user_id, key))
+        self._by_user[user_id].move_to_end(key)
+        self.hits += 1
+        return page
+
+    def put(self, user_id, key, ids, created, first_cursor, has_prev, next_cursor):
+        if (user_id, key) in self._pages:
+            self._remove(user_id, key)
+
+        page = ReviewPage(
+            array('q', ids), array('q', created), first_cursor, has_prev, next_cursor, time.monotonic() + self.ttl
+        )
+        self._pages[(user_id, key)] = page
+        user_keys = self._by_user.setdefault(user_id, OrderedDict())
+        user_keys[key] = None
+        self._bytes += page.nbytes
+
+        while len(user_keys) > self.per_user:
+            self._remove(user_id, next(iter(user_keys)))
+            self.evictions += 1
+        while self._bytes > self.budget_bytes and self._pages:
+            (old_user, old_key), _ = next(iter(self._pages.items()))
+            self._remove(old_user, old_key)
+            self.evictions += 1
+        return page
+
+    def _remove(self, user_id, key):
+        page = self._pages.pop((user_id, key))
+        self._bytes -= page.nbytes
+        user_keys = self._by_user[user_id]
+        del user_keys[key]
+        if not user_keys:
+            del self._by_user[user_id]
+
+    def memory_usage(self):
+        return self._bytes
+
+    def stats(self):
+        return {
+            "pages": len(self._pages),
+            "users": len(self._by_user),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,41 @@
+import asyncio
+import json
+from collections import Counter
+
+from telegram.request import BaseRequest
+
+# Bot API без сети для тестов: getMe и getUpdates по-настоящему,
+# остальные методы (setWebhook, sendMessage, ...) просто отвечают "ok"
+
+BOT_ID = 1
+
+
+class FakeBotRequest(BaseRequest):
+    def __init__(self, updates=()):
+        # updates - JSON апдейтов, которые отдаст первый getUpdates (для polling)
+        self.updates = list(updates)
+        self.calls = Counter()
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        self.calls[api_method] += 1
+        if api_method == "getMe":
+            result = {"id": BOT_ID, "is_bot": True, "first_name": "TESS", "username": "tess_test_bot"}
+        elif api_method == "getUpdates":
+            result, self.updates = self.updates, []
+            if not result:
+                await asyncio.sleep(0.01)
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
@@ -0,0 +1,73 @@
+import pytest
+
+import callbacks
+from callbacks import FIRST_PAGE, MAX_CALLBACK_DATA, ROUTES, Route
+
+USER_ID = 7_000_000_001
+
+# Крайние значения полей struct: кнопка не должна выйти за лимит и на них
+EXTREMES = {
+    "q": (-(2 ** 63), 2 ** 63 - 1),
+    "B": (0, 255),
+    "H": (0, 65535),
+    "?": (False, True),
+    # ранг поиска, float4: значения, точно представимые в нем
+    "f": (0.0, 0.5),
+}
+
+
+def route_values(route, pick):
+    fmt = route._struct.format.lstrip("<")[1:]
+    return tuple(EXTREMES[char][pick] for char in fmt)
+
+
+@pytest.mark.parametrize("route", list(ROUTES.values()), ids=repr)
+@pytest.mark.parametrize("pick", (0, 1))
+def test_round_trip(route, pick):
+    values = route_values(route, pick)
+    data = route.encode(*values)
+    assert data.startswith(callbacks.PREFIX)
+    assert len(data.encode()) <= MAX_CALLBACK_DATA
+    assert callbacks.decode(data) == (route, values)
+
+
+def test_route_over_limit_is_rejected():
+    with pytest.raises(ValueError):
+        Route(250, "too_long", "q" * 6)
+    assert 250 not in ROUTES
+
+
+def test_duplicate_code_is_rejected():
+    with pytest.raises(ValueError):
+        Route(callbacks.PROFILE.code, "duplicate", "q")
+
+
+@pytest.mark.parametrize("data", ["", "garbage", "~", "~!!!", "~AA", callbacks.PROFILE.encode(USER_ID)[:-2]])
+def test_damaged_data(data):
+    assert callbacks.decode(data) is None
+
+
+# Кнопки, которые исходная версия бота отправляла до перехода на "~" + base64
+LEGACY = [
+    ("back_to_main", callbacks.MAIN_MENU, ()),
+    ("find_user", callbacks.FIND_USER, ()),
+    ("send_rep", callbacks.SEND_REP, ()),
+    ("my_profile", callbacks.MY_PROFILE, ()),
+    (f"back_to_profile_{USER_ID}", callbacks.PROFILE, (USER_ID,)),
+    (f"back_to_review_menu_{USER_ID}", callbacks.REVIEW_MENU, (USER_ID,)),
+    (f"profile_reviews_{USER_ID}", callbacks.REVIEW_MENU, (USER_ID,)),
+    (f"reviews_pos_{USER_ID}", callbacks.REVIEW_PAGE, (0, USER_ID, *FIRST_PAGE, False)),
+    (f"reviews_all_{USER_ID}", callbacks.REVIEW_PAGE, (2, USER_ID, *FIRST_PAGE, False)),
+    (f"review_12345_{USER_ID}_neg_3", callbacks.REVIEW, (1, USER_ID, *FIRST_PAGE, 3)),
+    (f"review_12345_{USER_ID}_other_3", callbacks.REVIEW_MENU, (USER_ID,)),
+]
+
+
+@pytest.mark.parametrize("data, route, values", LEGACY, ids=[data for data, _, _ in LEGACY])
+def test_legacy_buttons(data, route, values):
+    assert callbacks.decode(data) == (route, values)
+
+
+@pytest.mark.parametrize("data", ["reviews_pos_x", "review_1_2", "back_to_profile_", "rvp_pos_1_0_0_n"])
+def test_unknown_legacy_buttons(data):
+    assert callbacks.decode(data) is None
@@ -0,0 +1,14 @@
+import random
+
+from bench_classifier import EDGE_CASES, legacy_classify, make_message
+from classifier import MessageClassifier
+
+# Классификатор должен совпадать с прежней логикой handle_message на корпусе bench_classifier
+
+
+def test_matches_legacy_parser():
+    rng = random.Random(42)
+    classifier = MessageClassifier()
+    for text in [make_message(rng) for _ in range(5000)] + EDGE_CASES:
+        result = classifier.classify(text)
+        assert ((result.mentions, result.rep_sign) if result.is_rep else None) == legacy_classify(text), text
@@ -0,0 +1,140 @@
+import asyncio
+import socket
+import time
+from collections import defaultdict
+
+import httpx
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+
+from fake_bot import FakeBotRequest
+from processing import PerChatUpdateProcessor
+
+# Апдейты проходят через Application и PerChatUpdateProcessor без сети:
+# Bot API (в том числе getUpdates) отвечает FakeBotRequest, webhook - настоящий
+# HTTP-сервер Updater на локальном порту
+
+MAX_CONCURRENT = 4
+CHATS = 10
+PER_CHAT = 5
+WEBHOOK_PATH = "webhook"
+WEBHOOK_SECRET = "test-secret"
+
+
+def make_update(update_id, chat_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "user"},
+            "text": text,
+        },
+    }
+
+
+def make_updates():
+    # По PER_CHAT апдейтов на чат вперемешку: номер внутри чата - в тексте
+    return [
+        make_update(1 + seq * CHATS + chat, 1000 + chat, str(seq))
+        for seq in range(PER_CHAT)
+        for chat in range(CHATS)
+    ]
+
+
+class Recorder:
+    # Хендлер: запоминает порядок апдейтов каждого чата и максимум одновременных
+    def __init__(self):
+        self.seen = defaultdict(list)
+        self.running = 0
+        self.max_running = 0
+        self.done = asyncio.Event()
+        self.expected = 0
+
+    async def __call__(self, update, context):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(0.005)
+            self.seen[update.effective_chat.id].append(int(update.message.text))
+        finally:
+            self.running -= 1
+        if sum(map(len, self.seen.values())) == self.expected:
+            self.done.set()
+
+
+def build_app(request, recorder):
+    app = (
+        Application.builder()
+        .token("1:TEST")
+        .request(request)
+        .get_updates_request(request)
+        .concurrent_updates(PerChatUpdateProcessor(MAX_CONCURRENT))
+        .build()
+    )
+    app.add_handler(TypeHandler(Update, recorder))
+    return app
+
+
+def check(app, recorder):
+    processor = app.update_processor
+    assert recorder.seen == {1000 + chat: list(range(PER_CHAT)) for chat in range(CHATS)}
+    # Очередь одного чата ждет до семафора, так что параллельно - не больше лимита,
+    # но и не по одному: разные чаты обрабатываются одновременно
+    assert 1 < recorder.max_running <= MAX_CONCURRENT
+    assert processor.pending == 0
+    assert processor.active_chats == 0
+
+
+def test_polling_keeps_chat_order():
+    async def run():
+        updates = make_updates()
+        recorder = Recorder()
+        recorder.expected = len(updates)
+        app = build_app(FakeBotRequest(updates), recorder)
+        async with app:
+            await app.updater.start_polling(poll_interval=0)
+            await app.start()
+            await asyncio.wait_for(recorder.done.wait(), 10)
+            await app.updater.stop()
+            await app.stop()
+        check(app, recorder)
+
+    asyncio.run(run())
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_webhook_updates_keep_chat_order():
+    # Как в main() при WEBHOOK_URL: апдейты приходят POST-запросами на webhook Updater
+    async def run():
+        updates = make_updates()
+        recorder = Recorder()
+        recorder.expected = len(updates)
+        request = FakeBotRequest()
+        app = build_app(request, recorder)
+        port = free_port()
+        url = f"http://127.0.0.1:{port}/{WEBHOOK_PATH}"
+        async with app:
+            await app.updater.start_webhook(
+                listen="127.0.0.1", port=port, url_path=WEBHOOK_PATH, webhook_url=url, secret_token=WEBHOOK_SECRET,
+            )
+            await app.start()
+            async with httpx.AsyncClient() as client:
+                denied = await client.post(url, json=updates[0])
+                assert denied.status_code == 403
+                for data in updates:
+                    response = await client.post(url, json=data, headers={"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET})
+                    assert response.status_code == 200
+            await asyncio.wait_for(recorder.done.wait(), 10)
+            await app.updater.stop()
+            await app.stop()
+        assert request.calls["setWebhook"] == 1
+        check(app, recorder)
+
+    asyncio.run(run())
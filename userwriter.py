@@ -0,0 +1,134 @@
+import asyncio
+import logging
+from datetime import datetime
+
+from cache import LRUCache
+from migrations import is_valid_user_id
+
+logger = logging.getLogger(__name__)
+
+UPSERT_ONE = """
+    INSERT INTO users (user_id, username, registered)
+    VALUES ($1, $2, $3)
+    ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username
+"""
+
+UPSERT_MANY = """
+    INSERT INTO users (user_id, username, registered)
+    SELECT u.user_id, u.username, $3
+    FROM unnest($1::bigint[], $2::text[]) AS u(user_id, username)
+    ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username
+"""
+
+
+class UserWriter:
+    # Кэш известных пользователей (user_id -> последний username) и
+    # отложенная пакетная запись новых/переименованных пользователей
+    def __init__(self, max_known=50000, batch_size=200, flush_interval=0.5):
+        self.pool = None
+        self.known = LRUCache(max_known)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = {}
+        # Вызывается для каждого нового/переименованного пользователя (сброс зависимых кэшей)
+        self.on_change = None
+        self.flushed_rows = 0
+        self.flushes = 0
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self._flush_tasks = set()
+
+    def touch(self, user_id, username):
+        # Синхронно: без await, только память. True, если запись поставлена в очередь
+        if not is_valid_user_id(user_id):
+            return False
+        if self.known.get(user_id) == username:
+            return False
+        if self.pending.get(user_id) == username:
+            return False
+        self.pending[user_id] = username
+        if self.on_change is not None:
+            self.on_change(user_id, username)
+        if len(self.pending) >= self.batch_size:
+            task = asyncio.get_running_loop().create_task(self.flush())
+            self._flush_tasks.add(task)
+            task.add_done_callback(self._flush_tasks.discard)
+        return True
+
+    def remember(self, user_id, username):
+        # Строка прочитана из БД - повторный upsert не нужен
+        if user_id not in self.pending:
+            self.known.set(user_id, username)
+
+    async def write(self, user_id, username):
+        # Немедленная запись (нужна, когда строка должна существовать сразу)
+        if not is_valid_user_id(user_id):
+            return
+        if self.known.get(user_id) == username:
+            return
+        self.pending.pop(user_id, None)
+        async with self.pool.acquire() as conn:
+            await conn.execute(UPSERT_ONE, user_id, username, datetime.now())
+        self.known.set(user_id, username)
+        if self.on_change is not None:
+            self.on_change(user_id, username)
+
+    async def ensure_flushed(self, user_id):
+        if user_id in self.pending:
+            await self.flush()
+
+    async def ensure_flushed_username(self, username):
+        username = username.lower()
+        for name in self.pending.values():
+            if name and name.lower() == username:
+                await self.flush()
+                return
+
+    async def ensure_flushed_many(self, user_ids, usernames):
+        if not self.pending:
+            return
+        user_ids = set(user_ids)
+        usernames = set(usernames)
+        for user_id, name in self.pending.items():
+            if user_id in user_ids or (name and name.lower() in usernames):
+                await self.flush()
+                return
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self.pending:
+                return
+            batch = self.pending
+            self.pending = {}
+            try:
+                async with self.pool.acquire() as conn:
+                    await conn.execute(UPSERT_MANY, list(batch.keys()), list(batch.values()), datetime.now())
+            except Exception:
+                logger.exception("Не удалось записать %d пользователей, повтор позже", len(batch))
+                for user_id, username in batch.items():
+                    self.pending.setdefault(user_id, username)
+                return
+            for user_id, username in batch.items():
+                self.known.set(user_id, username)
+            self.flushes += 1
+            self.flushed_rows += len(batch)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self, pool):
+        self.pool = pool
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()